@@ -54,29 +54,39 @@ class ProcessPool:
         self._job_id_provider   : CounterContext            = CounterContext()
         self._lock              : threading.Lock            = threading.Lock()
 
-    def _cleanup(self):
+    def _cleanup(self) -> pebble.pool.ProcessPool|None:
+        # NB: lock must be acquired when calling this. Returns the stopped pool, if any, which should
+        # be joined after releasing the lock: while stopping, the pool's threads call
+        # _job_done_callback() for the canceled jobs, which needs the lock
         # cancel all pending and running jobs
         self.cancel_all_jobs()
 
         # stop pool
+        pool = None
         if self._pool and self._pool.active:
             self._pool.stop()
-            self._pool.join()
+            pool = self._pool
         self._pool = None
         self._jobs = None
+        return pool
 
     def cleanup(self):
         with self._lock:
-            self._cleanup()
+            pool = self._cleanup()
+        if pool is not None:
+            pool.join()
 
     def cleanup_if_no_jobs(self):
         with self._lock:
-            self._cleanup_if_no_jobs()
+            pool = self._cleanup_if_no_jobs()
+        if pool is not None:
+            pool.join()
 
-    def _cleanup_if_no_jobs(self):
+    def _cleanup_if_no_jobs(self) -> pebble.pool.ProcessPool|None:
         # NB: lock must be acquired when calling this
         if self._pool and not self._jobs:
-            self._cleanup()
+            return self._cleanup()
+        return None
 
     def set_num_workers(self, num_workers: int):
         # NB: doesn't change number of workers on an active pool, only takes effect when pool is restarted
@@ -209,7 +219,7 @@ class JobScheduler(typing.Generic[_UserDataT]):
             self.jobs[job_id]._final_state = process.State.Canceled
             if self.jobs[job_id].done_callback:
                 self.jobs[job_id].done_callback(None, None, self.jobs[job_id].user_data, process.State.Canceled)
-        # TODO: also cancel all jobs that depend on this job
+        # NB: jobs that depend on this job are canceled on the next update()
 
     def cancel_all_jobs(self):
         # cancel any jobs that may still be running
@@ -249,11 +259,16 @@ class JobScheduler(typing.Generic[_UserDataT]):
                 if job.exclusive_id is not None:
                     exclusive_ids.add(job.exclusive_id)
 
+        # cancel pending jobs whose dependencies failed or were canceled, they can never run
+        for job_id in self._pending_jobs.copy():
+            if self._get_dependency_state(job_id) in [process.State.Canceled, process.State.Failed]:
+                self.cancel_job(job_id)
+
         # if we have less than max number of tasks scheduled to the pool, see if anything new to schedule to the pool
         while num_scheduled_to_pool < self._pool.num_workers:
             # find suitable next task to schedule
-            # order tasks by priority, filtering out those who have a colliding exclusive_id
-            job_ids = [i for i in sorted(self._pending_jobs, key=lambda ii: 999 if self.jobs[ii].priority is None else self.jobs[ii].priority) if self.jobs[i].exclusive_id not in exclusive_ids]
+            # order tasks by priority, filtering out those who have a colliding exclusive_id or whose dependencies are not yet met
+            job_ids = [i for i in sorted(self._pending_jobs, key=lambda ii: 999 if self.jobs[ii].priority is None else self.jobs[ii].priority) if self.jobs[i].exclusive_id not in exclusive_ids and self._get_dependency_state(i)==process.State.Completed]
             if not job_ids:
                 break
             job_id = job_ids[0]
@@ -266,6 +281,19 @@ class JobScheduler(typing.Generic[_UserDataT]):
                 exclusive_ids.add(to_schedule.exclusive_id)
             num_scheduled_to_pool += 1
 
+    def _get_dependency_state(self, job_id: int) -> process.State:
+        # Completed if all dependencies are completed (or there are none), Failed or Canceled
+        # if any dependency ended that way, else Pending
+        if not self.jobs[job_id].depends_on:
+            return process.State.Completed
+        states = [self.jobs[d].get_state() if d in self.jobs else process.State.Canceled for d in self.jobs[job_id].depends_on]
+        for s in [process.State.Failed, process.State.Canceled]:
+            if s in states:
+                return s
+        if all(s==process.State.Completed for s in states):
+            return process.State.Completed
+        return process.State.Pending
+
 
 def _get_status_from_future(fut: ProcessFuture) -> process.State:
     if fut.running():
@@ -319,6 +319,9 @@ def draw_process_state(state: process.State, have_hover_popup=True):
         case process.State.Completed:
             imgui.text_colored(colors.ok, ifa6.ICON_FA_CIRCLE_CHECK)
             hover_text = 'Completed'
+        case process.State.Skipped:
+            imgui.text_colored(colors.ok, ifa6.ICON_FA_CIRCLE_MINUS)
+            hover_text = 'Skipped (nothing to do)'
         case process.State.Canceled:
             imgui.text_colored(colors.warning, ifa6.ICON_FA_HAND)
             hover_text = 'Canceled'
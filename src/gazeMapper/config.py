@@ -73,6 +73,7 @@ class Study:
                  import_do_copy_video                           : bool                              = True,
                  import_source_dir_as_relative_path             : bool                              = False,
                  import_known_custom_eye_trackers               : list[str]|None                    = None,
+                 data_file_format                               : Literal['tsv','parquet','feather']= 'tsv',
 
                  sync_ref_recording                             : str|None                          = None,
                  sync_ref_do_time_stretch                       : bool|None                         = None,
@@ -83,6 +84,13 @@ class Study:
                  get_cam_movement_for_et_sync_function          : CamMovementForEtSyncFunction|None = None,
                  sync_et_to_cam_use_average                     : bool                              = True,
 
+                 detect_markers_num_workers                     : int                               = 1,
+                 detect_markers_use_tracking                    : bool                              = False,
+                 detect_markers_full_scan_interval              : int                               = 30,
+                 detect_markers_use_pyramid                     : bool                              = False,
+                 detect_markers_pyramid_max_distance            : float                             = 1000.,
+                 detect_markers_pyramid_check_interval          : int                               = 30,
+
                  auto_code_sync_points                          : AutoCodeSyncPoints|None           = None,
                  auto_code_trial_episodes                       : AutoCodeTrialEpisodes|None        = None,
 
@@ -119,6 +127,17 @@ class Study:
                  video_which_gaze_type_on_plane                 : gaze_worldref.Type                = gaze_worldref.Type.Scene_Video_Position,
                  video_which_gaze_type_on_plane_allow_fallback  : bool                              = True,
                  video_gaze_to_plane_margin                     : float                             = 0.25,
+                 video_frame_cache_size                         : float                             = 1024.,
+                 video_prefetch_frames                          : int                               = 16,
+                 video_encoding_profile                         : Literal['default','preview','archival']   = 'default',
+                 video_mux_audio_in_pass                        : bool                              = False,
+                 video_render_only                              : bool                              = False,
+                 video_render_episodes                          : set[annotation.Event]|None        = None,
+                 video_render_episode_margin_before             : float                             = 0.,
+                 video_render_episode_margin_after              : float                             = 0.,
+                 video_render_episodes_as_clips                 : bool                              = False,
+
+                 gaze_distance_all_pairs                        : bool                              = False,
 
                  gui_num_workers                                : int                               = 2,
 
@@ -135,11 +154,19 @@ class Study:
         self.import_do_copy_video                           = import_do_copy_video
         self.import_source_dir_as_relative_path             = import_source_dir_as_relative_path
         self.import_known_custom_eye_trackers               = import_known_custom_eye_trackers
+        self.data_file_format                               = data_file_format   # format in which plane pose, marker pose, plane gaze and pairwise gaze distance files are stored
 
         self.get_cam_movement_for_et_sync_method            = get_cam_movement_for_et_sync_method
         self.get_cam_movement_for_et_sync_function          = get_cam_movement_for_et_sync_function
         self.sync_et_to_cam_use_average                     = sync_et_to_cam_use_average
 
+        self.detect_markers_num_workers                     = detect_markers_num_workers    # if more than 1, the video is split into segments that are processed in parallel
+        self.detect_markers_use_tracking                    = detect_markers_use_tracking   # if True, only search for markers around where they were in the previous frame
+        self.detect_markers_full_scan_interval              = detect_markers_full_scan_interval # when tracking, number of frames after which the whole frame is searched again
+        self.detect_markers_use_pyramid                     = detect_markers_use_pyramid    # if True, detect markers on a downscaled frame and refine their corners at full resolution
+        self.detect_markers_pyramid_max_distance            = detect_markers_pyramid_max_distance   # mm, largest expected distance between camera and markers. Determines how much frames can be downscaled
+        self.detect_markers_pyramid_check_interval          = detect_markers_pyramid_check_interval # number of frames after which the downscaled detection is compared to full resolution detection
+
         self.sync_ref_recording                             = sync_ref_recording
         self.sync_ref_do_time_stretch                       = sync_ref_do_time_stretch
         self.sync_ref_stretch_which                         = sync_ref_stretch_which
@@ -181,6 +208,17 @@ class Study:
         self.video_which_gaze_type_on_plane                 = video_which_gaze_type_on_plane
         self.video_which_gaze_type_on_plane_allow_fallback  = video_which_gaze_type_on_plane_allow_fallback
         self.video_gaze_to_plane_margin                     = video_gaze_to_plane_margin    # fraction of plane size, added to each side of the plane
+        self.video_frame_cache_size                         = video_frame_cache_size        # MB, per video
+        self.video_prefetch_frames                          = video_prefetch_frames
+        self.video_encoding_profile                         = video_encoding_profile
+        self.video_mux_audio_in_pass                        = video_mux_audio_in_pass       # if True and ffmpeg is available, frames are encoded by ffmpeg which adds the audio while writing
+        self.video_render_only                              = video_render_only             # if True, poses are read from the planePose files instead of detecting markers again
+        self.video_render_episodes                          = video_render_episodes         # if set, only these episodes (of the reference recording) are rendered
+        self.video_render_episode_margin_before             = video_render_episode_margin_before    # s
+        self.video_render_episode_margin_after              = video_render_episode_margin_after     # s
+        self.video_render_episodes_as_clips                 = video_render_episodes_as_clips
+
+        self.gaze_distance_all_pairs                        = gaze_distance_all_pairs   # if True, gaze distance is computed for all pairs of eye tracker recordings and all trial planes
 
         self.gui_num_workers                                = gui_num_workers
 
@@ -721,6 +759,7 @@ study_parameter_doc = {
     }),
     'import_do_copy_video': type_utils.GUIDocInfo('Copy video during import?', 'If not enabled, the scene video of an eye tracker recording, or the video of an external camera is not copied to the gazeMapper recording directory during import. Instead, the video will be loaded from the recording\'s source directory (so do not move it). Ignored when the video must be transcoded to be processed with gazeMapper.'),
     'import_source_dir_as_relative_path': type_utils.GUIDocInfo('Store source directory as relative path?', 'Specifies whether the path to the source directory stored in the recording info file is an absolute path (this option is not enabled) or a relative path (enabled). If a relative path is used, the imported recording and the source directory can be moved to another location, and the source directory can still be found as long as the relative path (e.g., one folder up and in the directory "original recordings": "../original recordings") doesn\'t change.'),
+    'data_file_format': type_utils.GUIDocInfo('Data file format', 'Format in which the plane pose, marker pose, gaze-on-plane and pairwise gaze distance files are stored. "tsv" produces tab-separated text files. "parquet" and "feather" produce binary columnar files, which are smaller and much faster to read, but cannot be opened with a text editor or spreadsheet program. Files in any of these formats can be read, regardless of this setting.'),
     'import_known_custom_eye_trackers': type_utils.GUIDocInfo('Registered custom eye trackers', 'gazeMapper allows importing generic eye trackers for which no specific support is implemented, if their recording data is preprocessed to conform to glassesTools\' generic data format. Here you can define specific known generic eye tracker names that you may import.'),
     'sync_ref_recording': type_utils.GUIDocInfo('Synchronization: Reference recording', 'If there are multiple recordings, sets to which recording all other recordings will be synchronized.'),
     'sync_ref_do_time_stretch': type_utils.GUIDocInfo('Synchronization: Do time stretch?', 'If enabled, multiple sync points are used to calculate a time stretch factor to compensate for clock drift when synchronizing multiple recordings.'),
@@ -744,6 +783,12 @@ study_parameter_doc = {
         'parameters': type_utils.GUIDocInfo('Parameters', 'Set of parameters and values to pass to the function. The frame to process (np.ndarray) is the first (positional) input passed to the function, and should not be specified in this set.'),
     }),
     'sync_et_to_cam_use_average': type_utils.GUIDocInfo('Gaze data synchronization: Use average?', 'Whether to use the average offset of multiple sync episodes. If not enabled, the offset for the first sync episode is used, the rest are ignored.'),
+    'detect_markers_use_tracking': type_utils.GUIDocInfo('Detect markers: Use tracking?', 'If enabled, markers are only searched for in regions around where they were detected in the previous frame, which is faster than searching the whole frame. The whole frame is searched when not all markers are found again, and periodically to pick up markers that came into view (see "Detect markers: Full scan interval"). A summary comparing the speed and detection rate to searching the whole frame is printed, and per frame statistics are stored in markerDetectionStats.tsv in the recording\'s working folder.'),
+    'detect_markers_full_scan_interval': type_utils.GUIDocInfo('Detect markers: Full scan interval', 'When tracking is used, the number of frames after which the whole frame is searched for markers again, regardless of whether all tracked markers were found.'),
+    'detect_markers_use_pyramid': type_utils.GUIDocInfo('Detect markers: Detect on downscaled video?', 'If enabled, markers are detected on a downscaled version of the video frame, after which the marker corners are refined on the full resolution frame. This is faster than detecting markers on the full resolution frame. How much the frame is downscaled is determined for each plane from its marker size and the "Detect markers: Maximum marker distance" setting, such that markers remain large enough in the image to be reliably detected. Requires a calibrated scene camera. Also used when making the videos with detection results.'),
+    'detect_markers_pyramid_max_distance': type_utils.GUIDocInfo('Detect markers: Maximum marker distance', 'Largest expected distance (mm) between the scene camera and the markers. Used to determine how much the video frames can be downscaled when "Detect markers: Detect on downscaled video?" is enabled.'),
+    'detect_markers_pyramid_check_interval': type_utils.GUIDocInfo('Detect markers: Downscaled detection check interval', 'When detecting markers on downscaled video frames, every this number of frames detection is also done on the full resolution frame, to check the accuracy of the downscaled detection. A summary comparing the plane pose reprojection error is printed and per frame results are stored in markerPyramidStats.tsv in the recording\'s working folder. Set to 0 to disable.'),
+    'detect_markers_num_workers': type_utils.GUIDocInfo('Detect markers: Number of parallel workers', 'If set to more than 1, the scene video is split into this number of segments starting at keyframes, and markers are detected in each segment in a separate process. The output is the same as when processing the whole video in one go. Not used when the detection is visualized, or when the action is run by the GUI or batch processing, since actions are then already run in parallel.'),
     'auto_code_sync_points': type_utils.GUIDocInfo('Automated coding of synchronization points','Setup for automatic coding of synchronization timepoints.',{
         'markers': type_utils.GUIDocInfo('Marker(s)', 'Set of marker IDs whose appearance indicates a synchronization timepoint.'),
         'max_gap_duration': type_utils.GUIDocInfo('Maximum gap duration', 'Maximum gap (number of frames) to be filled in sequences of marker detections.'),
@@ -808,6 +853,19 @@ study_parameter_doc = {
     'video_which_gaze_type_on_plane': type_utils.GUIDocInfo('Video export: Which gaze on plane to show?', 'Sets which gaze-on-plane (e.g. from gaze position on the scene video or from gaze vectors projected to the plane) is used for the gaze positions shown in the generated videos.', _gaze_type_doc),
     'video_which_gaze_type_on_plane_allow_fallback': type_utils.GUIDocInfo('Video export: Allow fallback to showing gaze on plane based on scene video gaze?', 'Sets if it is allowed to fall back to using the projection of the gaze position on the plane derived from the gaze position on the video if the gaze-on-plane type specified in the "Video export: Which gaze on plane to show?" setting is not available.'),
     'video_gaze_to_plane_margin': type_utils.GUIDocInfo('Video export: Gaze position margin','Gaze position more than this factor outside a defined plane will not be drawn.'),
+    'video_frame_cache_size': type_utils.GUIDocInfo('Video export: Frame cache size','Amount of memory (MB) per video used for keeping recently decoded video frames, so that frames that are needed again (e.g. when the frames of a recording are repeated to synchronize it to the reference recording) do not have to be decoded again.'),
+    'video_prefetch_frames': type_utils.GUIDocInfo('Video export: Number of frames to decode ahead','Number of video frames that are decoded ahead in the background, while the current frame is being processed. Set to 0 to disable.'),
+    'video_encoding_profile': type_utils.GUIDocInfo('Video export: Encoding profile','Encoder settings used for writing the videos. "default" uses the default codec and settings for the output file format, "preview" encodes fast at lower quality (for review copies), and "archival" encodes slowly at high quality. Requires the libx264 encoder, if it is not available the default settings are used.'),
+    'video_mux_audio_in_pass': type_utils.GUIDocInfo('Video export: Add audio while writing?','If enabled, the audio of the source video is added to the output video while it is being written, instead of rewriting the whole output video afterwards to add the audio. Requires ffmpeg to be available on the path.'),
+    'video_render_only': type_utils.GUIDocInfo('Video export: Render only?','If enabled, the plane poses determined by the "Detect markers" action are used for making the videos, instead of detecting the markers again. This makes making the videos much faster. Only used if "Video export: Process all planes for all frames?", "Video export: Process individual markers for all frames?", "Video export: Show detected markers?" and "Video export: Show rejected markers?" are all disabled. Of the marker visualizations, only the plane axes are drawn.'),
+    'video_render_episodes': type_utils.GUIDocInfo('Video export: Render only episodes','If set, only the episodes of the selected types are rendered, instead of the whole recording. The episodes are taken from the reference recording (or from the recording itself if there is no reference recording). Audio is not added to the videos in this case.',{
+        None: # None indicates the doc specification applies to the contained values
+            dict([_get_annotation_event_doc(a) for a in annotation.Event])
+    }),
+    'video_render_episode_margin_before': type_utils.GUIDocInfo('Video export: Episode margin before (s)','When rendering only episodes, the part of the recording of this duration before each episode is rendered too.'),
+    'video_render_episode_margin_after': type_utils.GUIDocInfo('Video export: Episode margin after (s)','When rendering only episodes, the part of the recording of this duration after each episode is rendered too.'),
+    'video_render_episodes_as_clips': type_utils.GUIDocInfo('Video export: Episodes as separate clips?','When rendering only episodes, if enabled each episode is written to its own video file (numbered in order), else all episodes are written one after the other to a single video file. Episodes that overlap (including their margins) are rendered together.'),
+    'gaze_distance_all_pairs': type_utils.GUIDocInfo('Gaze distance: All pairs of recordings?', 'If enabled, the distance between gaze positions on the plane is computed for each pair of eye tracker recordings in the session and for each plane defined for Trial episodes, and stored in one file per plane. Always used for sessions with more than two eye tracker recordings. If not enabled, the gaze of the first two recordings is compared on the first Trial plane.'),
     'gui_num_workers': type_utils.GUIDocInfo('Number of workers','Each action is processed by a worker and each worker can handle one action at a time. Having more workers means more actions are processed simultaneously, but having too many will not provide any gain and might freeze the program and your whole computer. Since much of the processing utilizes more than one processor thread, set this value to significantly less than the number of threads available in your system. NB: If you currently have running or enqueued jobs, the number of workers will only be changed once all have completed or are cancelled.'),
 }
 if _missing_params:=[k for k in _params if k not in study_parameter_doc and k not in ['self','session_def','planes','individual_markers','working_directory','strict_check']]:
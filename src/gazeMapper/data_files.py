@@ -0,0 +1,235 @@
+import pathlib
+import typing
+from collections import defaultdict
+from typing import Any, Literal, Optional
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from glassesTools import data_files as gt_data_files, gaze_worldref, marker as gt_marker, plane as gt_plane
+
+from . import naming
+
+
+# The per-frame and per-sample data files produced by the processing actions (plane poses, individual
+# marker poses and gaze on planes, see the prefixes in naming.py) can be stored as tab-separated text
+# files (as glassesTools writes them) or in a columnar binary format. The latter are much smaller and
+# faster to read, and allow reading only the columns that are needed.
+Format = Literal['tsv','parquet','feather']
+formats: list[Format] = list(typing.get_args(Format))
+extensions: dict[Format,str] = {'tsv': '.tsv', 'parquet': '.parquet', 'feather': '.feather'}
+
+
+def get_file_path(folder: str|pathlib.Path, stem: str, fmt: Format = 'tsv') -> pathlib.Path:
+    return pathlib.Path(folder) / f'{stem}{extensions[fmt]}'
+
+def find_file(folder: str|pathlib.Path, stem: str) -> pathlib.Path|None:
+    # the file may be stored in any of the supported formats. Should there be more than one, the most recent
+    # one is used
+    candidates = [p for f in formats if (p:=get_file_path(folder, stem, f)).is_file()]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda p: p.stat().st_mtime)
+
+def get_format(path: str|pathlib.Path) -> Format:
+    suffix = pathlib.Path(path).suffix
+    for f in extensions:
+        if extensions[f]==suffix:
+            return f
+    raise ValueError(f'File type "{suffix}" not supported ({path})')
+
+def _remove_other_formats(path: pathlib.Path):
+    # remove files with the same name stored in another format, so that there are no stale copies
+    for f in formats:
+        if (p:=path.with_suffix(extensions[f]))!=path:
+            p.unlink(missing_ok=True)
+
+
+def get_columns(path: str|pathlib.Path) -> list[str]:
+    path = pathlib.Path(path)
+    match get_format(path):
+        case 'tsv':
+            return pd.read_csv(path, sep='\t', nrows=0).columns.to_list()
+        case 'parquet':
+            return list(pl.read_parquet_schema(path).keys())
+        case 'feather':
+            return list(pl.read_ipc_schema(path).keys())
+
+def read_columns(path: str|pathlib.Path, columns: list[str]|None = None, dtypes: dict[str,Any]|None = None) -> pd.DataFrame:
+    # read the indicated columns (all if None) of a file into a pandas DataFrame. For tsv files, dtypes
+    # sets the type of the listed columns, all others are read as float
+    path = pathlib.Path(path)
+    match get_format(path):
+        case 'tsv':
+            dtype = None if dtypes is None else defaultdict(lambda: float, **dtypes)
+            return pd.read_csv(path, sep='\t', index_col=False, usecols=columns, dtype=dtype)
+        case 'parquet':
+            return pl.read_parquet(path, columns=columns).to_pandas()
+        case 'feather':
+            return pl.read_ipc(path, columns=columns).to_pandas()
+
+def iter_columns(path: str|pathlib.Path, columns: list[str], chunk_size: int) -> typing.Iterator[pd.DataFrame]:
+    # read the indicated columns of a file chunk by chunk
+    path = pathlib.Path(path)
+    match get_format(path):
+        case 'tsv':
+            yield from pd.read_csv(path, sep='\t', index_col=False, usecols=columns, chunksize=chunk_size)
+            return
+        case 'parquet':
+            lf = pl.scan_parquet(path).select(columns)
+        case 'feather':
+            lf = pl.scan_ipc(path).select(columns)
+    n_rows = lf.select(pl.len()).collect().item()
+    for offset in range(0, n_rows, chunk_size):
+        yield lf.slice(offset, chunk_size).collect().to_pandas()
+
+def write_dataframe(df: pd.DataFrame|pl.DataFrame, folder: str|pathlib.Path, stem: str, fmt: Format = 'tsv') -> pathlib.Path:
+    path = get_file_path(folder, stem, fmt)
+    if isinstance(df, pd.DataFrame):
+        df = pl.from_pandas(df)
+    match fmt:
+        case 'tsv':
+            df.write_csv(path, separator='\t', null_value='nan', float_precision=8)
+        case 'parquet':
+            df.write_parquet(path)
+        case 'feather':
+            df.write_ipc(path)
+    _remove_other_formats(path)
+    return path
+
+
+# reading and writing lists of glassesTools objects. tsv files are read and written by
+# glassesTools.data_files.read_file and glassesTools.data_files.write_array_to_file. These work on
+# tsv files only, so for the columnar formats, _objects_to_dataframe() and _dataframe_to_objects()
+# do the same conversion between objects and table. They must produce the same result as the
+# glassesTools functions, tests/test_data_files.py checks this
+def write_objects(objects: list[Any]|dict[int,list[Any]], folder: str|pathlib.Path, stem: str, fmt: Format, cols_compressed: dict[str, int], drop_all_nan_cols: list[str]|None = None, skip_all_nan: bool = False) -> pathlib.Path|None:
+    if not objects:
+        return None
+    if fmt!='tsv':
+        return write_dataframe(_objects_to_dataframe(objects, cols_compressed, drop_all_nan_cols, skip_all_nan), folder, stem, fmt)
+    path = get_file_path(folder, stem, fmt)
+    gt_data_files.write_array_to_file(objects, path, cols_compressed, drop_all_nan_cols, skip_all_nan)
+    _remove_other_formats(path)
+    return path
+
+def read_objects(path: str|pathlib.Path,
+                 object: Any,
+                 drop_if_all_nan: bool,
+                 put_none_if_any_nan: bool,
+                 as_list_dict: bool,
+                 make_ori_ts_fridx: bool,
+                 episodes: Optional[list[list[int]]] = None,
+                 ts_fridx_field_suffixes: list[str] = None,
+                 subset_var = 'frame_idx'):
+    path = pathlib.Path(path)
+    if get_format(path)=='tsv':
+        return gt_data_files.read_file(path, object, drop_if_all_nan, put_none_if_any_nan, as_list_dict, make_ori_ts_fridx, episodes, ts_fridx_field_suffixes, subset_var)
+
+    # read only the columns the object knows about
+    available = get_columns(path)
+    df = read_columns(path, [c for cs in gt_data_files.uncompress_columns(object._columns_compressed) for c in cs if c in available])
+    return _dataframe_to_objects(df, object, drop_if_all_nan, put_none_if_any_nan, as_list_dict, make_ori_ts_fridx, episodes, ts_fridx_field_suffixes, subset_var)
+
+def _objects_to_dataframe(objects: list[Any]|dict[int,list[Any]], cols_compressed: dict[str, int], drop_all_nan_cols: list[str]|None, skip_all_nan: bool) -> pd.DataFrame:
+    # the table glassesTools.data_files.write_array_to_file() writes to file
+    if isinstance(objects, dict):
+        objects = [o for olist in objects.values() for o in olist]
+    df = pd.DataFrame.from_records([{k:getattr(p,k) for k in vars(p) if not k.startswith('_')} for p in objects])
+
+    # unpack array columns
+    cols_uncompressed = gt_data_files.uncompress_columns(cols_compressed)
+    for c,ac in zip(cols_compressed,cols_uncompressed):
+        if len(ac)>1:
+            df[ac] = np.vstack([gt_data_files.all_nan_if_none(v,len(ac)).flatten() for v in df[c].values])
+    if drop_all_nan_cols:
+        df = df.drop([c for c in drop_all_nan_cols if c in df and df[c].isnull().all()], axis='columns')
+    # store original timestamp and frame_idx, if any
+    for c in ['timestamp', 'frame_idx']:
+        if f'{c}_ori' in df.columns and not df[f'{c}_ori'].isnull().all():
+            df[c] = df[f'{c}_ori']
+    df = df[[c for cs in cols_uncompressed for c in cs if c in df.columns]]
+    if skip_all_nan:
+        df = df.dropna(how='all', subset=[c for cs in cols_uncompressed if len(cs)>1 for c in cs])
+    return df
+
+def _dataframe_to_objects(df: pd.DataFrame, object: Any, drop_if_all_nan: bool, put_none_if_any_nan: bool, as_list_dict: bool, make_ori_ts_fridx: bool,
+                          episodes: Optional[list[list[int]]], ts_fridx_field_suffixes: list[str]|None, subset_var: str):
+    # the objects glassesTools.data_files.read_file() makes from the table read from file
+    cols_compressed: dict[str, int] = object._columns_compressed
+    cols_uncompressed = gt_data_files.uncompress_columns(cols_compressed)
+    df = df.astype({c:object._non_float[c] for c in object._non_float if c in df.columns and not df[c].isnull().any()})
+    if episodes:
+        sel = np.zeros(len(df), dtype=bool)
+        for e in episodes:
+            sel |= (df[subset_var] >= e[0]).to_numpy() & (df[subset_var] <= e[1]).to_numpy()
+        df = df[sel]
+    if drop_if_all_nan:
+        df = df.dropna(how='all',subset=[c for cs in cols_uncompressed if len(cs)>1 for c in cs if c in df.columns])
+
+    # group columns into numpy arrays, optionally None if any is missing
+    df = df.copy()
+    for c,ac in zip(cols_compressed,cols_uncompressed):
+        if len(ac)>1 and any(a in df.columns for a in ac):
+            df[c] = [gt_data_files.none_if_any_nan(x) if put_none_if_any_nan else x for x in df[ac].values]
+    df = df[[c for c in cols_compressed if c in df.columns]]
+
+    if make_ori_ts_fridx:
+        # keep the original timestamp and frame_idx, and put the first available of the requested
+        # ones in the timestamp and frame_idx columns
+        df['frame_idx_ori'] = df['frame_idx']
+        if 'timestamp' in df.columns:
+            df['timestamp_ori'] = df['timestamp']
+        if ts_fridx_field_suffixes:
+            suf = next((s for s in ts_fridx_field_suffixes if gt_data_files._get_col_name_with_suffix('frame_idx',s) in df.columns), None)
+            if suf is None:
+                raise ValueError("None of the specified suffixes were found, can't continue")
+            df['frame_idx'] = df[gt_data_files._get_col_name_with_suffix('frame_idx',suf)]
+            if 'timestamp' in df.columns:
+                df['timestamp'] = df[gt_data_files._get_col_name_with_suffix('timestamp',suf)]
+
+    if as_list_dict:
+        objs = {}
+        for k,kwargs in zip(df[subset_var].values,df.to_dict(orient='records')):
+            objs.setdefault(k, []).append(object(**kwargs))
+    else:
+        objs = {idx:object(**kwargs) for idx,kwargs in zip(df[subset_var].values,df.to_dict(orient='records'))}
+    return objs, df[subset_var].max()
+
+
+# the specific files
+def find_plane_pose_file(folder: str|pathlib.Path, plane: str) -> pathlib.Path|None:
+    return find_file(folder, f'{naming.plane_pose_prefix}{plane}')
+
+def read_plane_poses(folder: str|pathlib.Path, plane: str, episodes: list[list[int]]|None = None) -> dict[int,gt_plane.Pose]:
+    return read_objects(find_plane_pose_file(folder, plane) or get_file_path(folder, f'{naming.plane_pose_prefix}{plane}'),
+                        gt_plane.Pose, True, True, False, False, episodes=episodes)[0]
+
+def write_plane_poses(poses: list[gt_plane.Pose], folder: str|pathlib.Path, plane: str, fmt: Format = 'tsv', skip_failed=False) -> pathlib.Path|None:
+    return write_objects(poses, folder, f'{naming.plane_pose_prefix}{plane}', fmt, gt_plane.Pose._columns_compressed, skip_all_nan=skip_failed)
+
+def find_marker_pose_file(folder: str|pathlib.Path, marker_id: int) -> pathlib.Path|None:
+    return find_file(folder, f'{naming.marker_pose_prefix}{marker_id}')
+
+def write_marker_poses(poses: list[gt_marker.Pose], folder: str|pathlib.Path, marker_id: int, fmt: Format = 'tsv', skip_failed=False) -> pathlib.Path|None:
+    return write_objects(poses, folder, f'{naming.marker_pose_prefix}{marker_id}', fmt, gt_marker.Pose._columns_compressed, skip_all_nan=skip_failed)
+
+def find_plane_gaze_file(folder: str|pathlib.Path, plane: str) -> pathlib.Path|None:
+    return find_file(folder, f'{naming.world_gaze_prefix}{plane}')
+
+def read_plane_gaze(folder: str|pathlib.Path, plane: str, episodes: list[list[int]]|None = None, ts_column_suffixes: list[str]|None = None) -> dict[int,list[gaze_worldref.Gaze]]:
+    return read_objects(find_plane_gaze_file(folder, plane) or get_file_path(folder, f'{naming.world_gaze_prefix}{plane}'),
+                        gaze_worldref.Gaze, False, False, True, True, episodes=episodes, ts_fridx_field_suffixes=ts_column_suffixes)[0]
+
+def write_plane_gaze(gazes: list[gaze_worldref.Gaze]|dict[int,list[gaze_worldref.Gaze]], folder: str|pathlib.Path, plane: str, fmt: Format = 'tsv', skip_missing=False) -> pathlib.Path|None:
+    return write_objects(gazes, folder, f'{naming.world_gaze_prefix}{plane}', fmt, gaze_worldref.Gaze._columns_compressed, gaze_worldref.Gaze._columns_optional, skip_all_nan=skip_missing)
+
+def find_pairwise_distance_file(folder: str|pathlib.Path, plane: str) -> pathlib.Path|None:
+    return find_file(folder, f'{plane}{naming.pairwise_distance_suffix}')
+
+def read_pairwise_distances(folder: str|pathlib.Path, plane: str, columns: list[str]|None = None) -> pd.DataFrame:
+    return read_columns(find_pairwise_distance_file(folder, plane) or get_file_path(folder, f'{plane}{naming.pairwise_distance_suffix}'), columns)
+
+def write_pairwise_distances(distances: pd.DataFrame|pl.DataFrame, folder: str|pathlib.Path, plane: str, fmt: Format = 'tsv') -> pathlib.Path:
+    return write_dataframe(distances, folder, f'{plane}{naming.pairwise_distance_suffix}', fmt)
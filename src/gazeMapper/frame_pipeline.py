@@ -0,0 +1,333 @@
+import pathlib
+import threading
+import collections
+from typing import Any, Callable
+import numpy as np
+import cv2
+
+from glassesTools import aruco, drawing, gaze_overlay_video, intervals, ocv, plane
+
+from . import video_segments
+
+
+# Consumers of video frames such as glassesTools' aruco.PoseEstimator and gaze_overlay_video.VideoMaker
+# read frames through their own ocv.CV2VideoReader (their video member). The classes here stand in for
+# that reader, leaving the consumers' logic otherwise unchanged:
+# - FrameFeed delivers the frame decoded by a SharedDecoder, so that a video is decoded once and
+#   each frame handed to multiple consumers.
+# - CachedReader keeps recently decoded frames in memory and decodes ahead in a background thread,
+#   for consumers that request frames repeatedly or out of order.
+# StoredPoseEstimator stands in for an aruco.PoseEstimator itself, for when the poses have already
+# been determined.
+
+
+class FrameFeed:
+    # stands in for the ocv.CV2VideoReader of a consumer
+    def __init__(self, reader: ocv.CV2VideoReader, copy: bool):
+        self._reader    = reader
+        self.copy       = copy      # consumers that draw on the frame should get their own copy
+        self.file       = reader.file
+        self.ts         = reader.ts
+        self.nframes    = reader.nframes
+        self.frame_idx  = -1
+        self._current: tuple[bool, np.ndarray, int, float] = None
+
+    def get_prop(self, cv2_prop):
+        return self._reader.get_prop(cv2_prop)
+
+    def set(self, current: tuple[bool, np.ndarray, int, float]):
+        should_exit, frame, frame_idx, frame_ts = current
+        if self.copy and frame is not None:
+            frame = frame.copy()
+        self._current = should_exit, frame, frame_idx, frame_ts
+        if frame_idx is not None:
+            self.frame_idx = frame_idx
+
+    def read_frame(self, report_gap=False, wanted_frame_idx:int=None) -> tuple[bool, np.ndarray, int, float]:
+        # NB: the pipeline drives consumers frame by frame, so the wanted frame is always the current one
+        return self._current
+
+    def report_frame(self):
+        pass    # done once by the pipeline
+
+
+class Consumer:
+    def __init__(self, name: str, feed: FrameFeed, step: Callable[[], bool], finish: Callable[[], Any]|None = None):
+        self.name   = name
+        self.feed   = feed
+        self.step   = step      # processes the frame in the feed, returns False when the consumer is done
+        self.finish = finish    # called once all frames are processed, returns the consumer's output
+        self.done   = False
+
+
+class SharedDecoder:
+    def __init__(self, video_file: str|pathlib.Path, timestamps: list|np.ndarray):
+        self.reader = ocv.CV2VideoReader(video_file, timestamps)
+        self.consumers: dict[str, Consumer] = {}
+
+    def _add(self, name: str, step: Callable[[FrameFeed], bool], finish: Callable[[], Any]|None, copy: bool) -> FrameFeed:
+        if name in self.consumers:
+            raise ValueError(f'Cannot register the consumer "{name}", it is already registered')
+        feed = FrameFeed(self.reader, copy)
+        self.consumers[name] = Consumer(name, feed, lambda: step(feed), finish)
+        return feed
+
+    def add_pose_estimator(self, name: str, estimator: aruco.PoseEstimator):
+        # output: the same as that of estimator.process_video()
+        poses_out               = {p:[] for p in estimator.planes}
+        individual_markers_out  = {i:[] for i in estimator.individual_markers}
+        extra_processing_out    = {e:[] for e in estimator.extra_proc_functions}
+        def _step(_):
+            status, pose, individual_marker, extra_proc, _ = estimator.process_one_frame()
+            if status==aruco.Status.Finished:
+                return False
+            if status==aruco.Status.Ok:
+                for p in pose:
+                    poses_out[p].append(pose[p])
+                for i in individual_marker:
+                    individual_markers_out[i].append(individual_marker[i])
+                for e in extra_proc:
+                    extra_processing_out[e].append(extra_proc[e])
+            return True
+        estimator.video = self._add(name, _step, lambda: (poses_out, individual_markers_out, extra_processing_out), estimator.do_visualize)
+
+    def add_video_maker(self, name: str, video_maker: gaze_overlay_video.VideoMaker):
+        # draws on the frame, so needs its own copy
+        video_maker.video = self._add(name, lambda _: video_maker.process_one_frame()!=gaze_overlay_video.Status.Finished, video_maker.finish_video, True)
+
+    def add_frame_function(self, name: str, func: Callable[..., Any], processing_intervals: list[int]|list[list[int]]|None = None, func_parameters: dict[str]|None = None, copy=False):
+        # e.g. color_blob_localizer.detect_blob_HSV. Output: a list of [frame_idx, *func output] for
+        # all processed frames, like for the estimator's extra processing functions
+        func_parameters = func_parameters or {}
+        out: list[list] = []
+        def _step(feed: FrameFeed):
+            should_exit, frame, frame_idx, _ = feed.read_frame()
+            if should_exit or (processing_intervals and intervals.beyond_last_interval(frame_idx, processing_intervals)):
+                return False
+            if frame is not None and intervals.is_in_interval(frame_idx, processing_intervals):
+                res = func(frame, **func_parameters)
+                out.append([frame_idx, *(res if isinstance(res, (tuple,list)) else [res])])
+            return True
+        self._add(name, _step, lambda: out, copy)
+
+    def run(self) -> dict[str, Any]:
+        # decode until all consumers are done, returns the output of each consumer
+        while (active:=[c for c in self.consumers.values() if not c.done]):
+            current = self.reader.read_frame(report_gap=True)
+            if not current[0]:
+                self.reader.report_frame()
+            for c in active:
+                c.feed.set(current)
+                c.done = not c.step() or current[0]
+        return {n:(c.finish() if c.finish else None) for n,c in self.consumers.items()}
+
+
+class CachedReader:
+    # Frames are kept in a least-recently-used cache bounded by memory_budget (MB). After each
+    # request, the next n_prefetch frames are decoded in a background thread. Requests for frames
+    # earlier than what was already decoded, which are no longer in the cache, are handled by
+    # reopening the video and seeking to the closest preceding keyframe. The same is done for
+    # requests for frames far ahead of what was already decoded, if that skips decoding enough frames.
+    # NB: delivered frames are copies, consumers may draw on them
+    _min_seek_distance = 100    # frames
+    def __init__(self, reader: ocv.CV2VideoReader, memory_budget: float, n_prefetch: int):
+        self._reader    = reader
+        self.file       = reader.file
+        self.ts         = reader.ts
+        self.nframes    = reader.nframes
+        self.frame_idx  = -1    # last delivered frame
+
+        self._budget        = memory_budget*1024*1024
+        self._n_prefetch    = n_prefetch
+        self._frames: collections.OrderedDict[int, tuple[np.ndarray|None, float]] = collections.OrderedDict()
+        self._nbytes        = 0
+        self._last_decoded  = -1
+        self._eof           = False
+        self._keyframe_info: tuple[np.ndarray, np.ndarray]|None|bool = False    # False: not yet determined
+
+        self._decode_lock   = threading.Lock()                  # protects the reader
+        self._cond          = threading.Condition()             # protects the cache and prefetch state
+        self._prefetch_until= -1
+        self._stop          = False
+        self._thread        = None
+        if n_prefetch>0:
+            self._thread = threading.Thread(target=self._prefetch, daemon=True)
+            self._thread.start()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+            self._thread = None
+
+    def get_prop(self, cv2_prop):
+        return self._reader.get_prop(cv2_prop)
+
+    def read_frame(self, report_gap=False, wanted_frame_idx:int=None) -> tuple[bool, np.ndarray, int, float]:
+        if wanted_frame_idx is None:
+            wanted_frame_idx = self.frame_idx+1
+        elif wanted_frame_idx<0 or wanted_frame_idx>=self.nframes:
+            raise ValueError(f'wanted_frame_idx ({wanted_frame_idx}) out of bounds ([0-{self.nframes-1}])')
+
+        with self._cond:
+            cached = self._get(wanted_frame_idx)
+        if cached is None:
+            with self._decode_lock:
+                with self._cond:
+                    if wanted_frame_idx<=self._last_decoded and wanted_frame_idx not in self._frames:
+                        # evicted already, need to go back
+                        self._reopen(wanted_frame_idx)
+                    elif not self._eof and wanted_frame_idx-self._last_decoded>self._min_seek_distance and \
+                        (kf:=self._get_seek_keyframe(wanted_frame_idx)) is not None and kf-self._last_decoded>self._min_seek_distance:
+                        # far ahead, seek instead of decoding all frames in between
+                        self._reopen(wanted_frame_idx)
+                while not self._eof and self._last_decoded<wanted_frame_idx:
+                    self._decode_next()
+            with self._cond:
+                cached = self._get(wanted_frame_idx)
+        if cached is None:
+            return True, None, None, None   # end of video
+
+        self.frame_idx = wanted_frame_idx
+        with self._cond:
+            self._prefetch_until = wanted_frame_idx+self._n_prefetch
+            self._cond.notify_all()
+        frame, ts = cached
+        return False, (None if frame is None else frame.copy()), wanted_frame_idx, ts
+
+    def report_frame(self, interval=100):
+        if self.frame_idx%interval==0:
+            print('  frame {}'.format(self.frame_idx))
+
+    def _get(self, frame_idx: int) -> tuple[np.ndarray|None, float]|None:
+        if frame_idx not in self._frames:
+            return None
+        self._frames.move_to_end(frame_idx)
+        return self._frames[frame_idx]
+
+    def _put(self, frame_idx: int, frame: np.ndarray|None, ts: float):
+        if frame_idx in self._frames:
+            old = self._frames.pop(frame_idx)[0]
+            self._nbytes -= 0 if old is None else old.nbytes
+        self._frames[frame_idx] = frame, ts
+        self._nbytes += 0 if frame is None else frame.nbytes
+        while self._nbytes>self._budget and len(self._frames)>1:
+            old = self._frames.popitem(last=False)[1][0]
+            self._nbytes -= 0 if old is None else old.nbytes
+
+    def _decode_next(self):
+        # NB: self._decode_lock must be held
+        should_exit, frame, frame_idx, frame_ts = self._reader.read_frame(report_gap=True)
+        with self._cond:
+            if should_exit:
+                self._eof = True
+                return
+            # frames skipped because of a discontinuity in the video have no image
+            for i in range(self._last_decoded+1, frame_idx):
+                self._put(i, None, self.ts[i])
+            self._put(frame_idx, frame, frame_ts)
+            self._last_decoded = frame_idx
+
+    def _get_seek_keyframe(self, frame_idx: int) -> int|None:
+        # the closest keyframe at or before the given frame that can be seeked to, None if not known
+        if self._keyframe_info is False:
+            self._keyframe_info = video_segments.get_frame_info(self.file)
+            if self._keyframe_info is not None and self._keyframe_info[0].size!=self.nframes:
+                self._keyframe_info = None
+        if self._keyframe_info is None:
+            return None
+        keyframes = self._keyframe_info[1]
+        if (keyframes:=keyframes[keyframes<=frame_idx]).size and keyframes[-1]>=2:
+            return int(keyframes[-1])
+        return None
+
+    def _reopen(self, frame_idx: int):
+        # NB: self._decode_lock and self._cond must be held
+        kf = self._get_seek_keyframe(frame_idx)
+        self._last_decoded, self._eof = -1, False
+        if kf is not None:
+            if (reader:=video_segments.open_at_keyframe(self.file, self.ts, kf, self._keyframe_info[0])) is not None:
+                self._reader = reader
+                _, frame, kf, ts = reader.read_frame(wanted_frame_idx=kf)
+                self._put(kf, frame, ts)
+                self._last_decoded = kf
+                return
+            # failed, spool from the start. Seeking doesn't work for this file, don't try again
+            self._keyframe_info = None
+        self._reader = ocv.CV2VideoReader(self.file, self.ts)
+
+    def _prefetch(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._stop or (not self._eof and self._last_decoded<self._prefetch_until))
+                if self._stop:
+                    return
+            with self._decode_lock:
+                if not self._eof and self._last_decoded<self._prefetch_until:
+                    self._decode_next()
+
+
+class StoredPoseEstimator:
+    # Delivers frames along with plane poses that were stored before (e.g. by DETECT_MARKERS), without
+    # detecting markers. Has the interface of aruco.PoseEstimator used for making videos. Of the
+    # estimator's visualizations, only the plane axes are drawn, as the detected markers are not known
+    def __init__(self, video: ocv.CV2VideoReader|CachedReader, poses: dict[str, dict[int, plane.Pose]], camera_params: ocv.CameraParams, arm_lengths: dict[str, float]):
+        self.video      = video
+        self.poses      = poses
+        self.cam_params = camera_params
+        self.arm_lengths= arm_lengths       # per plane, length of the drawn plane axes
+
+        self.do_visualize       = False
+        self.show_plane_axes    = True
+        self.sub_pixel_fac      = 8
+        self._do_report_frames  = True
+        self._cache: tuple[aruco.Status, dict[str, plane.Pose], dict, dict, tuple[np.ndarray, int, float]] = None
+
+    def set_visualize_on_frame(self, do_visualize: bool):
+        self.do_visualize = do_visualize
+
+    def set_do_report_frames(self, do_report_frames: bool):
+        self._do_report_frames = do_report_frames
+
+    def get_video_info(self) -> tuple[int, int, float]:
+        return int(self.video.get_prop(cv2.CAP_PROP_FRAME_WIDTH)), \
+               int(self.video.get_prop(cv2.CAP_PROP_FRAME_HEIGHT)), \
+                   self.video.get_prop(cv2.CAP_PROP_FPS)
+
+    def process_one_frame(self, wanted_frame_idx:int = None) -> tuple[aruco.Status, dict[str, plane.Pose], dict, dict, tuple[np.ndarray, int, float]]:
+        # output as aruco.PoseEstimator.process_one_frame(), without individual markers and extra processing
+        if wanted_frame_idx is not None and self._cache is not None and self._cache[4][1]==wanted_frame_idx:
+            return self._cache
+
+        should_exit, frame, frame_idx, frame_ts = self.video.read_frame(report_gap=True, wanted_frame_idx=wanted_frame_idx)
+        if should_exit:
+            self._cache = aruco.Status.Finished, None, None, None, (None, None, None)
+            return self._cache
+        if self._do_report_frames:
+            self.video.report_frame()
+
+        pose_out = {p: self.poses[p][frame_idx] for p in self.poses if frame_idx in self.poses[p]}
+        if frame is None or not pose_out:
+            self._cache = aruco.Status.Skip, None, None, None, (frame, frame_idx, frame_ts)
+            return self._cache
+
+        if self.do_visualize and self.show_plane_axes:
+            # as the plane visualization of aruco.PoseEstimator
+            for p in pose_out:
+                if pose_out[p].pose_successful():
+                    # draw axis indicating plane pose (origin and orientation)
+                    drawing.openCVFrameAxis(frame, self.cam_params.camera_mtx, self.cam_params.distort_coeffs, pose_out[p].pose_R_vec, pose_out[p].pose_T_vec, self.arm_lengths[p], 3, self.sub_pixel_fac)
+                if pose_out[p].homography_successful():
+                    # find where plane origin is expected to be in the image
+                    target = pose_out[p].plane_to_cam_homography([0., 0.], self.cam_params)
+                    # draw target location on image
+                    if target[0] >= 0 and target[0] < frame.shape[1] and target[1] >= 0 and target[1] < frame.shape[0]:
+                        drawing.openCVCircle(frame, target, 3, (0,0,0), -1, self.sub_pixel_fac)
+
+        self._cache = aruco.Status.Ok, pose_out, {}, {}, (frame, frame_idx, frame_ts)
+        return self._cache
@@ -0,0 +1,302 @@
+import numpy as np
+import pandas as pd
+import cv2
+
+from glassesTools import data_files as gt_data_files, gaze_worldref, ocv, plane as gt_plane
+
+from .gaze_store import HeadGazeStore
+
+
+# Vectorized equivalent of glassesTools.gaze_worldref.from_head(). Instead of transforming gaze samples
+# one at a time, the pose of each sample's frame is looked up by frame index and all samples are
+# transformed at once, for one or multiple planes. The result is a set of columns as they would be
+# written to a planeGaze file by gaze_worldref.write_dict_to_file(..., skip_missing=True).
+
+_columns_compressed   = gaze_worldref.Gaze._columns_compressed
+_columns_uncompressed = dict(zip(_columns_compressed, gt_data_files.uncompress_columns(_columns_compressed)))
+_data_columns         = [c for c in _columns_compressed if _columns_compressed[c]>1]
+_ts_columns           = [c for c in _columns_compressed if _columns_compressed[c]==1]
+
+
+class PoseArrays:
+    # the plane poses of a recording, as arrays with one row per frame for which there is a pose
+    def __init__(self, poses: dict[int, gt_plane.Pose]):
+        self.frames = np.array(sorted(poses.keys()), dtype=np.int64)
+        n = self.frames.size
+        self.pose_ok= np.zeros(n, np.bool_)
+        self.R      = np.full((n,3,3), np.nan)
+        self.T      = np.full((n,3), np.nan)
+        self.reprojection_error = np.full(n, np.nan)  # nan if pose not successful
+        self.hom_ok = np.zeros(n, np.bool_)
+        self.H      = np.full((n,3,3), np.nan)
+        r_vecs      = np.full((n,3), np.nan)
+        for i,f in enumerate(self.frames):
+            p = poses[f]
+            self.pose_ok[i] = p.pose_successful()
+            self.hom_ok[i]  = p.homography_successful()
+            if self.pose_ok[i]:
+                self.reprojection_error[i] = p.pose_reprojection_error
+            if p.pose_R_vec is not None and p.pose_T_vec is not None:
+                r_vecs[i]   = np.asarray(p.pose_R_vec).flatten()
+                self.T[i]   = np.asarray(p.pose_T_vec).flatten()
+            if p.homography_mat is not None:
+                self.H[i]   = p.homography_mat
+        self.R = _rodrigues(r_vecs)
+
+    def lookup(self, frame_idx: np.ndarray) -> np.ndarray:
+        # for each frame index, the row of its pose, or -1 if there is no pose for that frame
+        idx = np.searchsorted(self.frames, frame_idx)
+        idx[idx>=self.frames.size] = 0
+        if self.frames.size:
+            idx[self.frames[idx]!=frame_idx] = -1
+        else:
+            idx[:] = -1
+        return idx
+
+
+def _rodrigues(r_vecs: np.ndarray) -> np.ndarray:
+    # rotation vectors (N,3) to rotation matrices (N,3,3), as cv2.Rodrigues
+    theta = np.linalg.norm(r_vecs, axis=1)
+    small = theta<np.finfo(np.float64).eps
+    k = r_vecs/np.where(small, 1., theta)[:,np.newaxis]
+    c = np.cos(theta)[:,np.newaxis,np.newaxis]
+    s = np.sin(theta)[:,np.newaxis,np.newaxis]
+    K = np.zeros((r_vecs.shape[0],3,3))
+    K[:,0,1], K[:,0,2], K[:,1,2] = -k[:,2],  k[:,1], -k[:,0]
+    K[:,1,0], K[:,2,0], K[:,2,1] =  k[:,2], -k[:,1],  k[:,0]
+    R = c*np.eye(3) + (1-c)*(k[:,:,np.newaxis]*k[:,np.newaxis,:]) + s*K
+    R[small] = np.eye(3)
+    return R
+
+def _vector_intersect(normals: np.ndarray, points: np.ndarray, vectors: np.ndarray, origins: np.ndarray|None = None) -> np.ndarray:
+    # as gt_plane.Pose.vector_intersect(), for (N,3) arrays of plane normals, points on the plane, ray
+    # directions and ray origins (camera origin if None)
+    vectors = vectors/np.linalg.norm(vectors, axis=1, keepdims=True)
+    ndotu = np.sum(normals*vectors, axis=1)
+    w = -points if origins is None else origins-points
+    si = -np.sum(normals*w, axis=1)/ndotu
+    out = w + si[:,np.newaxis]*vectors + points
+    out[np.abs(ndotu)<1e-6] = np.nan
+    return out
+
+def _cam_frame_to_world(R: np.ndarray, T: np.ndarray, points: np.ndarray) -> np.ndarray:
+    # as gt_plane.Pose.cam_frame_to_world(): R^T*(p-T)
+    return np.einsum('nji,nj->ni', R, points) - np.einsum('nji,nj->ni', R, T)
+
+def _world_frame_to_cam(R: np.ndarray, T: np.ndarray, points: np.ndarray) -> np.ndarray:
+    # as gt_plane.Pose.world_frame_to_cam()
+    return np.einsum('nij,nj->ni', R, points) + T
+
+def _apply_homography(H: np.ndarray, points: np.ndarray) -> np.ndarray:
+    # as cv2.perspectiveTransform(), with a homography per point
+    x, y = points[:,0], points[:,1]
+    w = H[:,2,0]*x + H[:,2,1]*y + H[:,2,2]
+    w = np.where(np.abs(w)>np.finfo(np.float32).eps, 1./w, 0.)
+    return np.column_stack(((H[:,0,0]*x + H[:,0,1]*y + H[:,0,2])*w,
+                            (H[:,1,0]*x + H[:,1,1]*y + H[:,1,2])*w))
+
+def _undistort_points(points: np.ndarray, camera_params: ocv.CameraParams, reproject: bool) -> np.ndarray:
+    out = np.full_like(points, np.nan)
+    ok = ~np.any(np.isnan(points), axis=1)
+    if np.any(ok):
+        out[ok] = cv2.undistortPoints(points[ok].reshape((1,-1,2)), camera_params.camera_mtx, camera_params.distort_coeffs,
+                                      P=camera_params.camera_mtx if reproject else None).reshape((-1,2))
+    return out
+
+
+def from_head(poses: dict[int, gt_plane.Pose]|PoseArrays, head_gazes: HeadGazeStore, camera_params: ocv.CameraParams) -> dict[str, np.ndarray]:
+    # returns, for each field of gaze_worldref.Gaze, an array with one row per gaze sample in a frame for
+    # which there is a pose. For fields that gaze_worldref.from_head() would leave at None, the array
+    # is all nan
+    return from_head_multi({'': poses}, head_gazes, camera_params)['']
+
+def from_head_multi(poses: dict[str, dict[int, gt_plane.Pose]|PoseArrays], head_gazes: HeadGazeStore, camera_params: ocv.CameraParams) -> dict[str, dict[str, np.ndarray]]:
+    # as from_head(), for multiple planes at once. The gaze samples are gathered and the plane-independent
+    # part of the transformation (undistortion, eye tracker to camera space) is done only once, after
+    # which each sample is projected onto each plane that has a pose for the sample's frame
+    poses = {p:(poses[p] if isinstance(poses[p], PoseArrays) else PoseArrays(poses[p])) for p in poses}
+    planes = list(poses)
+
+    # for each frame with samples and each plane, the row of the plane's pose for that frame (or -1), then
+    # expanded to the samples in the frame
+    frame_rows = np.column_stack([poses[p].lookup(head_gazes.frames) for p in planes]) if planes else np.zeros((head_gazes.frames.size,0), np.int64)
+    sample_rows = np.repeat(frame_rows, head_gazes.counts, axis=0)
+    sel = np.flatnonzero(np.any(sample_rows>=0, axis=1))
+    sample_rows = sample_rows[sel]
+    n = sel.size
+
+    # plane-independent part
+    ts_cols = {c:head_gazes.get_column(c)[sel] for c in _ts_columns+['timestamp_ori', 'frame_idx_ori'] if head_gazes.has_column(c)}
+    gaze_pos_vid = np.asarray(head_gazes.get_column('gaze_pos_vid')[sel], dtype=np.float64)
+    # get transform from ET data's coordinate frame to camera's coordinate frame
+    RCam  = np.eye(3) if camera_params.rotation_vec is None else cv2.Rodrigues(camera_params.rotation_vec)[0]
+    TCam  = np.zeros(3) if camera_params.position is None else np.asarray(camera_params.position, dtype=np.float64).flatten()
+    shared: dict[str, np.ndarray] = {}
+    if camera_params.has_intrinsics():
+        # direction of ray through the video gaze position, and undistorted video gaze position
+        shared['vid_ray'] = np.column_stack((_undistort_points(gaze_pos_vid, camera_params, False), np.ones(n)))
+        shared['vid_pos'] = _undistort_points(gaze_pos_vid, camera_params, True)
+    else:
+        shared['vid_pos'] = gaze_pos_vid
+    if head_gazes.has_column('gaze_pos_3d'):
+        shared['gaze_pos_3d'] = np.asarray(head_gazes.get_column('gaze_pos_3d')[sel], dtype=np.float64) @ RCam.T + TCam
+    for vec,ori in [('gaze_dir_l','gaze_ori_l'),('gaze_dir_r','gaze_ori_r')]:
+        if head_gazes.has_column(vec) and head_gazes.has_column(ori):
+            # transform from ET data coordinate frame into camera coordinate frame
+            shared[vec] = np.asarray(head_gazes.get_column(vec)[sel], dtype=np.float64) @ RCam.T
+            shared[ori] = np.asarray(head_gazes.get_column(ori)[sel], dtype=np.float64) @ RCam.T + TCam
+
+    out: dict[str, dict[str, np.ndarray]] = {}
+    for i,p in enumerate(planes):
+        s = sample_rows[:,i]>=0
+        out[p] = _project(poses[p], sample_rows[s,i], {c:v[s] for c,v in ts_cols.items()}, {c:v[s] for c,v in shared.items()})
+    return out
+
+def _project(poses: PoseArrays, p_idx: np.ndarray, ts_cols: dict[str, np.ndarray], shared: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    n = p_idx.size
+    out: dict[str, np.ndarray] = dict(ts_cols)
+    for c in _data_columns:
+        out[c] = np.full((n,_columns_compressed[c]), np.nan)
+    if not n:
+        return out
+
+    pose_ok = poses.pose_ok[p_idx]
+    hom_ok  = poses.hom_ok [p_idx]
+    R       = poses.R[p_idx]
+    T       = poses.T[p_idx]
+    normals = R[:,:,2]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if 'vid_ray' in shared:
+            # project gaze on video to reference plane using camera pose
+            pos_cam = _vector_intersect(normals, T, shared['vid_ray'])
+            pos_cam[~pose_ok] = np.nan
+            out['gazePosCam_vidPos_ray']     = pos_cam
+            out['gazePosPlane2D_vidPos_ray'] = _cam_frame_to_world(R, T, pos_cam)[:,:2]
+
+        # project world-space gaze point (often binocular gaze point) to plane
+        if 'gaze_pos_3d' in shared:
+            pos_cam = _vector_intersect(normals, T, shared['gaze_pos_3d'])
+            pos_cam[~pose_ok] = np.nan
+            out['gazePosCamWorld']     = pos_cam
+            out['gazePosPlane2DWorld'] = _cam_frame_to_world(R, T, pos_cam)[:,:2]
+
+        # unproject 2D gaze point on video to point on plane using the homography
+        if np.any(hom_ok):
+            pos = _apply_homography(poses.H[p_idx], shared['vid_pos'])
+            pos[~hom_ok] = np.nan
+            out['gazePosPlane2D_vidPos_homography'] = pos
+            # get this point in camera space
+            pos_cam = _world_frame_to_cam(R, T, np.column_stack((pos, np.zeros(n))))
+            pos_cam[~pose_ok] = np.nan
+            out['gazePosCam_vidPos_homography'] = pos_cam
+
+        # project gaze vectors to plane
+        for vec,ori,attrs in [('gaze_dir_l','gaze_ori_l',['gazeOriCamLeft','gazePosCamLeft','gazePosPlane2DLeft']),('gaze_dir_r','gaze_ori_r',['gazeOriCamRight','gazePosCamRight','gazePosPlane2DRight'])]:
+            if vec not in shared:
+                continue
+            # intersect with plane -> yield point on plane in camera reference frame
+            g_ori   = shared[ori]
+            g_plane = _vector_intersect(normals, T, shared[vec], g_ori)
+            g_ori  [~pose_ok] = np.nan
+            g_plane[~pose_ok] = np.nan
+            out[attrs[0]] = g_ori
+            out[attrs[1]] = g_plane
+            # transform intersection with plane from camera space to plane space
+            out[attrs[2]] = _cam_frame_to_world(R, T, g_plane)[:,:2]
+
+    return out
+
+class FramePlaneGazes:
+    # Gaze projected to each plane, for gaze data with one sample per frame (see
+    # HeadGazeStore.get_frame_averaged()), along with, for each frame, the planes in order of how
+    # close gaze is to them. Only planes for which the pose or homography of the frame is successful
+    # are included. Planes where gaze is more than margin (fraction of plane size) outside the plane
+    # come last. Of the others, the plane to which gaze is closest comes first, where for planes with
+    # a successful pose, closeness is the average of the distance from the plane and the pose's
+    # reprojection error.
+    def __init__(self, poses: dict[str, dict[int, gt_plane.Pose]|PoseArrays], head_gazes: HeadGazeStore, camera_params: ocv.CameraParams, planes: dict[str, gt_plane.Plane], margin: float):
+        poses = {p:(poses[p] if isinstance(poses[p], PoseArrays) else PoseArrays(poses[p])) for p in poses}
+        self.planes = list(poses)
+        self.frames = head_gazes.frames
+        self.gazes  = from_head_multi(poses, head_gazes, camera_params)
+
+        n, k = self.frames.size, len(self.planes)
+        self._rows = np.full((n,k), -1, np.int64)   # for each frame and plane, the row in self.gazes[plane]
+        keys = np.full((n,k), np.nan)               # nan: plane not available
+        for i,p in enumerate(self.planes):
+            frame_idx = self.gazes[p]['frame_idx'].astype(np.int64)
+            f_rows = np.searchsorted(self.frames, frame_idx)
+            p_rows = poses[p].lookup(frame_idx)
+            ok = poses[p].pose_ok[p_rows] | poses[p].hom_ok[p_rows]
+            self._rows[f_rows[ok],i] = np.flatnonzero(ok)
+            dist = distance_from_plane(self.gazes[p], planes[p])[ok]
+            err  = poses[p].reprojection_error[p_rows[ok]]
+            keys[f_rows[ok],i] = np.where(dist<=margin, np.where(np.isnan(err), dist, (dist+err)/2), np.inf)
+        # nan sorts last, stable sort keeps ties in the order of the planes
+        self._order = np.argsort(keys, axis=1, kind='stable')
+        self._order[np.take_along_axis(np.isnan(keys), self._order, axis=1)] = -1
+
+    def get_plane_order(self, frame_idx: int) -> list[str]:
+        i = np.searchsorted(self.frames, frame_idx)
+        if i>=self.frames.size or self.frames[i]!=frame_idx:
+            return []
+        return [self.planes[p] for p in self._order[i] if p>=0]
+
+    def get_gaze(self, frame_idx: int, plane: str) -> gaze_worldref.Gaze:
+        i = np.searchsorted(self.frames, frame_idx)
+        return _make_gaze(self.gazes[plane], self._rows[i,self.planes.index(plane)])
+
+
+def distance_from_plane(plane_gazes: dict[str, np.ndarray], plane: gt_plane.Plane) -> np.ndarray:
+    # as gaze_worldref.distance_from_plane(), for all rows
+    gp = plane_gazes['gazePosPlane2D_vidPos_ray']
+    gp = np.where(np.isnan(gp[:,[0]]), plane_gazes['gazePosPlane2D_vidPos_homography'], gp)
+    # as transforms.dist_from_bbox()
+    bbox = plane.bbox
+    x = (gp[:,0]-bbox[0])/(bbox[2]-bbox[0])
+    y = (bbox[1]-gp[:,1])/(bbox[1]-bbox[3])
+    dx = np.where(x<0., x, x-1)
+    dy = np.where(y<0., y, y-1)
+    with np.errstate(invalid='ignore'):
+        inside = (x>=0) & (x<=1) & (y>=0) & (y<=1)
+        return np.where(inside, 0., np.abs(np.where(dy>dx, dy, dx)))
+
+def to_dataframe(plane_gazes: dict[str, np.ndarray], skip_missing=True) -> pd.DataFrame:
+    # the columns as gaze_worldref.write_dict_to_file() would store them
+    df = {}
+    for c in _columns_compressed:
+        if c in ['timestamp', 'frame_idx'] and f'{c}_ori' in plane_gazes:
+            # write out the original timestamp and frame_idx
+            df[c] = plane_gazes[f'{c}_ori']
+        elif c not in plane_gazes:
+            continue
+        elif _columns_compressed[c]==1:
+            if c in gaze_worldref.Gaze._columns_optional and np.all(np.isnan(plane_gazes[c].astype(np.float64))):
+                continue
+            df[c] = plane_gazes[c]
+        else:
+            for i,ac in enumerate(_columns_uncompressed[c]):
+                df[ac] = plane_gazes[c][:,i]
+    df = pd.DataFrame(df)
+    # drop rows where are all data columns are nan
+    if skip_missing:
+        df = df.dropna(how='all', subset=[ac for c in _data_columns for ac in _columns_uncompressed[c]])
+    return df
+
+def to_gaze_dict(plane_gazes: dict[str, np.ndarray]) -> dict[int, list[gaze_worldref.Gaze]]:
+    # gaze_worldref.Gaze objects, organized by frame index, as gaze_worldref.from_head() returns them
+    out: dict[int, list[gaze_worldref.Gaze]] = {}
+    for i in range(plane_gazes['frame_idx'].size):
+        g = _make_gaze(plane_gazes, i)
+        out.setdefault(g.frame_idx, []).append(g)
+    return out
+
+def _make_gaze(plane_gazes: dict[str, np.ndarray], row: int) -> gaze_worldref.Gaze:
+    kwargs = {}
+    for c,v in plane_gazes.items():
+        if v.ndim==1:
+            kwargs[c] = int(v[row]) if c.startswith('frame_idx') else float(v[row])
+        elif not np.all(np.isnan(v[row])):
+            kwargs[c] = v[row].copy()
+    return gaze_worldref.Gaze(**kwargs)
@@ -0,0 +1,296 @@
+import pathlib
+import json
+import os
+import collections.abc
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+
+from glassesTools import data_files as gt_data_files, gaze_headref
+
+
+# Array-backed store for head-referenced gaze data (gazeData.tsv). Instead of one gaze_headref.Gaze object
+# per sample, the data is kept as NumPy columns (structure of arrays) along with a frame->row range
+# index. Rows for a frame or an interval of frames are thus O(1) slices of the columns. The store
+# implements the Mapping interface of the dict[int,list[gaze_headref.Gaze]] returned by
+# gaze_headref.read_dict_from_file, where Gaze objects are only created for frames that are looked up,
+# so it can be passed to glassesTools functions that expect such a dict.
+#
+# Reading a gazeData.tsv file is slow. When reading, a binary cache of the file can be stored next to it
+# (<name>_cache.npy, along with a small <name>_cache.json describing it), which is memory mapped the next
+# time the file is read. The cache is rebuilt when the tsv file changes.
+#
+# The timestamps and frame indices determined when synchronizing (timestamp_VOR and frame_idx_VOR by
+# sync_et_to_cam, timestamp_ref and frame_idx_ref by sync_to_ref) are not written into the tsv file, but
+# into small binary sidecar files next to it (<name>_sync_<suffix>.npy, along with a
+# <name>_sync_<suffix>.json describing it), holding a value for each row of the tsv file. They are joined
+# in when reading, so that rerunning a sync does not require rewriting the whole gaze data file (and
+# does not invalidate its cache). A sidecar file is ignored when the tsv file changes.
+
+_cache_suffix = '_cache'
+_sync_suffix  = '_sync_'
+sync_column_suffixes = ['VOR', 'ref']
+_columns_compressed = gaze_headref.Gaze._columns_compressed
+_columns_uncompressed = gt_data_files.uncompress_columns(_columns_compressed)
+
+
+class HeadGazeStore(collections.abc.Mapping):
+    def __init__(self, columns: dict[str, np.ndarray]):
+        # columns: for each field of gaze_headref.Gaze that is available, an (N,) array (timestamps and
+        # frame indices) or (N,k) array (positions and vectors). Rows are grouped by the frame_idx column
+        self.columns = columns
+
+        if np.any(np.diff(self.columns['frame_idx'])<0):
+            order = np.argsort(self.columns['frame_idx'], kind='stable')
+            self.columns = {c:v[order] for c,v in self.columns.items()}
+        frame_idx = self.columns['frame_idx']
+
+        # frame -> row range index. Dense (indexed by frame_idx-first frame), so lookups are O(1)
+        self.frames, starts, self.counts = np.unique(frame_idx, return_index=True, return_counts=True)
+        self._first_frame = int(self.frames[0]) if self.frames.size else 0
+        n_frames = int(self.frames[-1])-self._first_frame+1 if self.frames.size else 0
+        self._starts = np.zeros(n_frames, np.int64)
+        self._ends   = np.zeros(n_frames, np.int64)
+        self._starts[self.frames-self._first_frame] = starts
+        self._ends  [self.frames-self._first_frame] = starts+self.counts
+
+    @property
+    def num_samples(self) -> int:
+        return self.columns['frame_idx'].size
+
+    @property
+    def max_frame_idx(self) -> int:
+        return int(self.frames[-1]) if self.frames.size else -1
+
+    def has_column(self, column: str) -> bool:
+        return column in self.columns
+
+    def rows(self, frame_idx: int) -> slice:
+        # rows in the columns that belong to the given frame (empty slice if none)
+        i = int(frame_idx)-self._first_frame
+        if i<0 or i>=self._starts.size:
+            return slice(0,0)
+        return slice(self._starts[i], self._ends[i])
+
+    def interval_rows(self, start_frame: int, end_frame: int) -> slice:
+        # rows in the columns that belong to the frames start_frame up to and including end_frame
+        # NB: frames without samples have an empty range, so find the first and last frame with samples
+        s = np.searchsorted(self.frames, start_frame, side='left')
+        e = np.searchsorted(self.frames, end_frame, side='right')
+        if s>=e:
+            return slice(0,0)
+        return slice(self._starts[self.frames[s]-self._first_frame], self._ends[self.frames[e-1]-self._first_frame])
+
+    def get_column(self, column: str, frame_idx: int|None = None) -> np.ndarray:
+        # view of the column, for all samples or for the samples of the given frame
+        if frame_idx is None:
+            return self.columns[column]
+        return self.columns[column][self.rows(frame_idx)]
+
+    def get_frame_means(self, column: str) -> tuple[np.ndarray, np.ndarray]:
+        # per frame mean of the column over the frame's samples, along with the frames. A sample with
+        # missing data (NaN) makes the mean of its frame NaN
+        if not self.frames.size:
+            return self.frames, np.zeros((0,)+self.columns[column].shape[1:])
+        sums = np.add.reduceat(self.columns[column], self._starts[self.frames-self._first_frame], axis=0)
+        return self.frames, sums/self.counts.reshape((-1,)+(1,)*(sums.ndim-1))
+
+    def get_frame_averaged(self, column: str = 'gaze_pos_vid') -> 'HeadGazeStore':
+        # new store with one sample per frame: the frame's first sample, with the given column replaced
+        # by its mean over the frame's samples
+        first = self._starts[self.frames-self._first_frame]
+        columns = {c:v[first] for c,v in self.columns.items()}
+        columns[column] = self.get_frame_means(column)[1]
+        return HeadGazeStore(columns)
+
+    def select(self, episodes: list[list[int]]) -> 'HeadGazeStore':
+        # new store with only the samples of frames in the given intervals
+        sel = np.concatenate([np.arange(r.start, r.stop) for e in episodes if (r:=self.interval_rows(*e)).stop>r.start] or [np.zeros(0, np.int64)])
+        return HeadGazeStore({c:v[sel] for c,v in self.columns.items()})
+
+    def make_gaze(self, row: int) -> gaze_headref.Gaze:
+        kwargs = {}
+        for c,v in self.columns.items():
+            if v.ndim==1:
+                kwargs[c] = int(v[row]) if c.startswith('frame_idx') else float(v[row])
+            else:
+                kwargs[c] = np.array(v[row])
+        return gaze_headref.Gaze(**kwargs)
+
+    # Mapping interface
+    def __getitem__(self, frame_idx: int) -> list[gaze_headref.Gaze]:
+        r = self.rows(frame_idx)
+        if r.stop<=r.start:
+            raise KeyError(frame_idx)
+        return [self.make_gaze(i) for i in range(r.start, r.stop)]
+
+    def __contains__(self, frame_idx) -> bool:
+        try:
+            r = self.rows(frame_idx)
+        except (TypeError, ValueError):
+            return False
+        return r.stop>r.start
+
+    def __iter__(self):
+        return (int(f) for f in self.frames)
+
+    def __len__(self) -> int:
+        return self.frames.size
+
+
+def _get_cache_paths(file_name: pathlib.Path) -> tuple[pathlib.Path, pathlib.Path]:
+    stem = file_name.parent / f'{file_name.stem}{_cache_suffix}'
+    return stem.with_suffix('.npy'), stem.with_suffix('.json')
+
+def _get_source_info(file_name: pathlib.Path) -> dict[str,int]:
+    stat = file_name.stat()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def _read_tsv(file_name: pathlib.Path) -> tuple[np.ndarray, list[str]]:
+    # read the gaze columns of the file into a (n_columns x n_samples) array, so that each column
+    # is contiguous
+    df = pd.read_csv(file_name, delimiter='\t', index_col=False, dtype=defaultdict(lambda: float, **gaze_headref.Gaze._non_float))
+    names = [c for cs in _columns_uncompressed for c in cs if c in df.columns]
+    data = np.empty((len(names), len(df)), np.float64)
+    for i,c in enumerate(names):
+        data[i] = df[c].to_numpy()
+    return data, names
+
+def _load_cache(file_name: pathlib.Path) -> tuple[np.ndarray, list[str]]|None:
+    cache_file, info_file = _get_cache_paths(file_name)
+    if not cache_file.is_file() or not info_file.is_file():
+        return None
+    try:
+        with open(info_file, 'r') as f:
+            info = json.load(f)
+        if info['source']!=_get_source_info(file_name):
+            return None
+        data = np.load(cache_file, mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+    if data.shape!=(len(info['columns']), info['num_samples']):
+        return None
+    return data, info['columns']
+
+def _store_cache(file_name: pathlib.Path, data: np.ndarray, names: list[str]):
+    cache_file, info_file = _get_cache_paths(file_name)
+    # write to temporary files and then move them into place, so that a concurrent reader never sees
+    # a partially written cache
+    tmp_cache = cache_file.with_name(f'{cache_file.stem}.{os.getpid()}.tmp.npy')
+    tmp_info  = info_file .with_name(f'{info_file.stem}.{os.getpid()}.tmp.json')
+    try:
+        np.save(tmp_cache, data)
+        with open(tmp_info, 'w') as f:
+            json.dump({'source': _get_source_info(file_name), 'columns': names, 'num_samples': data.shape[1]}, f)
+        os.replace(tmp_cache, cache_file)
+        os.replace(tmp_info, info_file)
+    except OSError:
+        # not being able to store the cache is not an error, it just isn't available next time
+        for f in (tmp_cache, tmp_info):
+            f.unlink(missing_ok=True)
+
+def delete_cache(file_name: str|pathlib.Path):
+    for f in _get_cache_paths(pathlib.Path(file_name)):
+        f.unlink(missing_ok=True)
+
+def _get_sync_paths(file_name: pathlib.Path, suffix: str) -> tuple[pathlib.Path, pathlib.Path]:
+    stem = file_name.parent / f'{file_name.stem}{_sync_suffix}{suffix}'
+    return stem.with_suffix('.npy'), stem.with_suffix('.json')
+
+def write_sync_columns(file_name: str|pathlib.Path, suffix: str, ts: np.ndarray, fridxs: np.ndarray):
+    # store the timestamp_<suffix> and frame_idx_<suffix> columns for the gaze data file, one value per
+    # row of the file
+    file_name = pathlib.Path(file_name)
+    sync_file, info_file = _get_sync_paths(file_name, suffix)
+    data = np.vstack((ts, fridxs)).astype(np.float64)
+    # write to temporary files and then move them into place, so that a concurrent reader never sees
+    # a partially written file
+    tmp_sync = sync_file.with_name(f'{sync_file.stem}.{os.getpid()}.tmp.npy')
+    tmp_info = info_file.with_name(f'{info_file.stem}.{os.getpid()}.tmp.json')
+    try:
+        np.save(tmp_sync, data)
+        with open(tmp_info, 'w') as f:
+            json.dump({'source': _get_source_info(file_name), 'num_samples': data.shape[1]}, f)
+        os.replace(tmp_sync, sync_file)
+        os.replace(tmp_info, info_file)
+    except BaseException:
+        for f in (tmp_sync, tmp_info):
+            f.unlink(missing_ok=True)
+        raise
+
+def _load_sync_columns(file_name: pathlib.Path, suffix: str, num_samples: int) -> np.ndarray|None:
+    sync_file, info_file = _get_sync_paths(file_name, suffix)
+    if not sync_file.is_file() or not info_file.is_file():
+        return None
+    try:
+        with open(info_file, 'r') as f:
+            info = json.load(f)
+        if info['source']!=_get_source_info(file_name) or info['num_samples']!=num_samples:
+            return None
+        data = np.load(sync_file, mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+    if data.shape!=(2, num_samples):
+        return None
+    return data
+
+def read_head_gaze_columns(file_name: str|pathlib.Path, use_cache=True) -> dict[str, np.ndarray]:
+    # the columns of the gaze data file, including the synchronized timestamps and frame indices of
+    # the sidecar files, in the row order of the file. These are views of the (possibly memory mapped)
+    # data
+    file_name = pathlib.Path(file_name)
+    loaded = _load_cache(file_name) if use_cache else None
+    if loaded is None:
+        loaded = _read_tsv(file_name)
+        if use_cache:
+            _store_cache(file_name, *loaded)
+    data, names = loaded
+
+    columns: dict[str, np.ndarray] = {}
+    for c,ac in zip(_columns_compressed, _columns_uncompressed):
+        if ac[0] not in names:
+            continue
+        i = names.index(ac[0])
+        if len(ac)==1:
+            columns[c] = data[i].astype(np.int64) if c in gaze_headref.Gaze._non_float else data[i]
+        else:
+            columns[c] = data[i:i+len(ac)].T
+    # join in sidecar columns. These take precedence over the same columns in the tsv file, which
+    # may have been written there by a previous version
+    for suf in sync_column_suffixes:
+        if (sync:=_load_sync_columns(file_name, suf, data.shape[1])) is not None:
+            columns[f'timestamp_{suf}'] = sync[0]
+            columns[f'frame_idx_{suf}'] = sync[1].astype(np.int64)
+    return columns
+
+def read_head_gaze(file_name: str|pathlib.Path, episodes: list[list[int]]|None = None, ts_column_suffixes: list[str]|None = None, use_cache=True) -> HeadGazeStore:
+    # equivalent of gaze_headref.read_dict_from_file(), returning a HeadGazeStore. As for that function:
+    # - if episodes are provided, only samples whose frame_idx falls in one of the episodes are kept
+    # - if ts_column_suffixes are provided, the timestamp and frame_idx columns are replaced by the
+    #   first available of the timestamp_<suffix> and frame_idx_<suffix> columns, and the original
+    #   timestamp and frame_idx are available as timestamp_ori and frame_idx_ori
+    columns = read_head_gaze_columns(file_name, use_cache)
+
+    if episodes:
+        sel = np.zeros(columns['frame_idx'].size, np.bool_)
+        for e in episodes:
+            sel |= (columns['frame_idx'] >= e[0]) & (columns['frame_idx'] <= e[1])
+        columns = {c:v[sel] for c,v in columns.items()}
+
+    # keep a copy of the original timestamp and frame_idx, and put the requested ones in their place
+    columns['frame_idx_ori'] = columns['frame_idx']
+    if 'timestamp' in columns:
+        columns['timestamp_ori'] = columns['timestamp']
+    if ts_column_suffixes:
+        for suf in ts_column_suffixes:  # these are in order of preference
+            field = gt_data_files._get_col_name_with_suffix('frame_idx',suf)
+            if field not in columns:
+                continue
+            columns['frame_idx'] = columns[field]
+            if 'timestamp' in columns:
+                columns['timestamp'] = columns[gt_data_files._get_col_name_with_suffix('timestamp',suf)]
+            break
+        else:
+            raise ValueError("None of the specified suffixes were found, can't continue")
+
+    return HeadGazeStore(columns)
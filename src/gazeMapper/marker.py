@@ -1,14 +1,13 @@
 import pathlib
 import pandas as pd
 from typing import overload, Any
-from collections import defaultdict
 import typeguard
 import cv2
 import inspect
 
 from glassesTools import marker as gt_marker, utils
 
-from . import naming, type_utils
+from . import data_files, naming, type_utils
 
 
 class Marker:
@@ -44,10 +43,11 @@ def get_marker_dict_from_list(markers: list[Marker]) -> dict[int,dict[str]]:
         out[m.id] = {'marker_size': m.size}
     return out
 
-def load_file(marker_id: int, folder: str|pathlib.Path) -> pd.DataFrame:
+def load_file(marker_id: int, folder: str|pathlib.Path, columns: list[str]|None = None) -> pd.DataFrame:
+    # if columns is provided, only those columns are read
     folder = pathlib.Path(folder)
-    file = folder / f'{naming.marker_pose_prefix}{marker_id}.tsv'
-    return pd.read_csv(file,sep='\t', dtype=defaultdict(lambda: float, **gt_marker.Pose._non_float))
+    file = data_files.find_marker_pose_file(folder, marker_id) or data_files.get_file_path(folder, f'{naming.marker_pose_prefix}{marker_id}')
+    return data_files.read_columns(file, columns, gt_marker.Pose._non_float)
 
 @overload
 def code_marker_for_presence(markers: pd.DataFrame, allow_failed=False) -> pd.DataFrame: ...
@@ -0,0 +1,276 @@
+import time
+from typing import Callable
+import numpy as np
+import pandas as pd
+import cv2
+
+from glassesTools import aruco
+
+
+# Accelerated ArUco marker detection. The classes here stand in for the cv2.aruco.ArucoDetector used by
+# glassesTools' aruco.ArUcoDetector (its _det member) and thus by aruco.PoseEstimator, so that they
+# are used without further changes to the detection and pose estimation logic. Use attach_pyramid()
+# and attach_tracking() to set them up for an estimator. Both can be used together, tracking's
+# full-frame scans are then done with the downscaled detection.
+
+
+class TrackingDetector:
+    # Tracking-assisted detection: markers are expected close to where they were found in the previous
+    # frame, so only padded regions of interest (ROIs) around those locations are searched. A full-frame
+    # scan is done when there is no previous detection, when not all markers of the previous frame
+    # are found again (e.g. fast motion) and every full_scan_interval frames (to pick up markers
+    # that came into view).
+    # On the scheduled full scans, the ROI detection is also run, so that the speed and detection rate
+    # of both modes can be compared on the same frames (see get_stats() and print_stats_summary())
+    def __init__(self, det: cv2.aruco.ArucoDetector, name: str, get_frame_idx: Callable[[], int], full_scan_interval: int, roi_margin: float):
+        self._det       = det
+        self._roi_det   = cv2.aruco.ArucoDetector(det.getDictionary(), det.getDetectorParameters(), det.getRefineParameters())
+        self._roi_params= det.getDetectorParameters()
+        self._perimeter_rates = self._roi_params.minMarkerPerimeterRate, self._roi_params.maxMarkerPerimeterRate
+
+        self.name               = name
+        self._get_frame_idx     = get_frame_idx
+        self.full_scan_interval = full_scan_interval
+        self.roi_margin         = roi_margin    # padding around each predicted marker, as fraction of the marker's size
+
+        self._prev_corners: tuple[np.ndarray]|None  = None
+        self._last_full_scan_frame                  = None
+        self.stats: list[list] = []     # per call: frame_idx, mode, n_predicted, n_roi, n_full, t_roi, t_full
+
+    def detectMarkers(self, image: np.ndarray):
+        frame_idx = self._get_frame_idx()
+        predicted = self._prev_corners
+        scheduled = predicted is None or self._last_full_scan_frame is None or frame_idx-self._last_full_scan_frame>=self.full_scan_interval
+
+        roi_out = full_out = None
+        n_roi = n_full = t_roi = t_full = np.nan
+        if predicted is not None:
+            t0 = time.perf_counter()
+            roi_out = self._detect_in_rois(image, predicted)
+            t_roi = (time.perf_counter()-t0)*1000
+            n_roi = _num_markers(roi_out[1])
+        # miss: a marker of the previous frame was not found again
+        if scheduled or n_roi<len(predicted):
+            t0 = time.perf_counter()
+            full_out = aruco._detect_markers(image, self._det)
+            t_full = (time.perf_counter()-t0)*1000
+            n_full = _num_markers(full_out[1])
+            self._last_full_scan_frame = frame_idx
+
+        mode = 'roi' if full_out is None else 'full' if roi_out is None else 'scheduled' if scheduled else 'miss'
+        self.stats.append([frame_idx, mode, 0 if predicted is None else len(predicted), n_roi, n_full, t_roi, t_full])
+
+        corners, ids, rejected = full_out if full_out is not None else roi_out
+        self._prev_corners = tuple(corners) if ids is not None else None
+        return corners, ids, rejected
+
+    def refineDetectedMarkers(self, *args, **kwargs):
+        return self._det.refineDetectedMarkers(*args, **kwargs)
+
+    def _detect_in_rois(self, image: np.ndarray, predicted: tuple[np.ndarray]):
+        im_size = max(image.shape[:2])
+        corners, ids, rejected = [], [], []
+        for x0,y0,x1,y1 in _merge_boxes([self._get_roi(c, image.shape) for c in predicted]):
+            # scale marker size limits to the ROI so that the same marker sizes (in pixels) are accepted
+            # as for a full-frame scan
+            roi_size = max(x1-x0, y1-y0)
+            self._roi_params.minMarkerPerimeterRate = self._perimeter_rates[0]*im_size/roi_size
+            self._roi_params.maxMarkerPerimeterRate = self._perimeter_rates[1]*im_size/roi_size
+            self._roi_det.setDetectorParameters(self._roi_params)
+
+            c, i, r = aruco._detect_markers(image[y0:y1, x0:x1], self._roi_det)
+            offset = np.array([x0, y0], np.float32)
+            corners .extend(x+offset for x in c)
+            rejected.extend(x+offset for x in r)
+            if i is not None:
+                ids.append(i)
+        return tuple(corners), (np.vstack(ids) if ids else None), tuple(rejected)
+
+    def _get_roi(self, corners: np.ndarray, im_shape: tuple[int,...]) -> list[int]:
+        pts = corners.reshape(-1,2)
+        pad = self.roi_margin*np.max(np.ptp(pts, axis=0))
+        x0, y0 = np.floor(np.min(pts, axis=0)-pad).astype(int)
+        x1, y1 = np.ceil (np.max(pts, axis=0)+pad).astype(int)
+        return [max(x0,0), max(y0,0), min(x1,im_shape[1]), min(y1,im_shape[0])]
+
+    def get_stats(self) -> pd.DataFrame:
+        df = pd.DataFrame(self.stats, columns=['frame_idx', 'mode', 'n_predicted', 'n_markers_roi', 'n_markers_full', 't_roi_ms', 't_full_ms'])
+        df.insert(0, 'detector', self.name)
+        return df
+
+
+class PyramidDetector:
+    # Downscaled-first detection: candidates are detected on a downscaled frame, after which their
+    # corners are refined to sub-pixel accuracy on the full resolution frame. The scale is chosen such
+    # that the smallest marker that is to be detected is still large enough for reliable detection
+    # (see get_pyramid_scale()).
+    # Every check_interval frames, detection is also run on the full resolution frame and the pose
+    # reprojection error for the plane of both is stored, so that the accuracy of the downscaled
+    # detection can be checked (see get_stats() and print_accuracy_summary())
+    def __init__(self, det: cv2.aruco.ArucoDetector, detector: aruco.ArUcoDetector, name: str, get_frame_idx: Callable[[], int], scale: float, check_interval: int|None):
+        self._det           = det
+        self._detector      = detector  # owner of det, for pose estimation when checking accuracy
+        self.name           = name
+        self._get_frame_idx = get_frame_idx
+        self.scale          = scale
+        self.check_interval = check_interval
+
+        params = det.getDetectorParameters()
+        self._refine_win    = int(np.ceil(params.cornerRefinementWinSize/scale))
+        self._refine_crit   = (cv2.TERM_CRITERIA_MAX_ITER | cv2.TERM_CRITERIA_EPS, params.cornerRefinementMaxIterations, params.cornerRefinementMinAccuracy)
+
+        self._last_check_frame  = None
+        self.stats: list[list] = []     # per check: frame_idx, n_pyr, n_full, reprojection error pyr, reprojection error full, corner difference, t_pyr, t_full
+
+    def __getattr__(self, name):
+        # for everything else, behave like the wrapped detector
+        return getattr(self._det, name)
+
+    def detectMarkers(self, image: np.ndarray):
+        frame_idx = self._get_frame_idx()
+        t0 = time.perf_counter()
+        out = self._detect(image)
+        t_pyr = (time.perf_counter()-t0)*1000
+
+        if self.check_interval and (self._last_check_frame is None or frame_idx-self._last_check_frame>=self.check_interval):
+            self._last_check_frame = frame_idx
+            t0 = time.perf_counter()
+            full_out = aruco._detect_markers(image, self._det)
+            t_full = (time.perf_counter()-t0)*1000
+            self.stats.append([frame_idx, _num_markers(out[1]), _num_markers(full_out[1]), self._get_reprojection_error(*out[:2]), self._get_reprojection_error(*full_out[:2]), _get_corner_difference(out, full_out), t_pyr, t_full])
+        return out
+
+    def _detect(self, image: np.ndarray):
+        if self.scale>=1.:
+            return aruco._detect_markers(image, self._det)
+        small = cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        corners, ids, rejected = aruco._detect_markers(small, self._det)
+        # to full resolution coordinates (NB: pixel centers are at integer coordinates)
+        corners  = tuple((c+.5)/self.scale-.5 for c in corners)
+        rejected = tuple((c+.5)/self.scale-.5 for c in rejected)
+        if ids is None:
+            return corners, ids, rejected
+
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim==3 else image
+        for c in corners:
+            # window must stay well within the marker
+            win = max(min(self._refine_win, int(np.min(np.ptp(c.reshape(-1,2), axis=0))/4)), 2)
+            cv2.cornerSubPix(gray, c.reshape(-1,1,2), (win,win), (-1,-1), self._refine_crit)
+        return corners, ids, rejected
+
+    def _get_reprojection_error(self, corners, ids) -> float:
+        if ids is None or not self._detector._camera_params.has_intrinsics():
+            return np.nan
+        objP, imgP = self._detector._match_image_points(corners, ids)
+        n_markers, _, _, err = self._detector._estimate_pose_impl(objP, imgP)
+        return err if n_markers else np.nan
+
+    def get_stats(self) -> pd.DataFrame:
+        df = pd.DataFrame(self.stats, columns=['frame_idx', 'n_markers_pyramid', 'n_markers_full', 'reprojection_error_pyramid', 'reprojection_error_full', 'corner_difference_px', 't_pyramid_ms', 't_full_ms'])
+        df.insert(0, 'detector', self.name)
+        df.insert(1, 'scale', self.scale)
+        return df
+
+
+def _get_corner_difference(out: tuple, ref_out: tuple) -> float:
+    # mean distance between the corners of markers that are detected in both
+    corners, ids, _ = out
+    ref_corners, ref_ids, _ = ref_out
+    if ids is None or ref_ids is None:
+        return np.nan
+    ref = {i:c for i,c in zip(ref_ids.flatten(), ref_corners)}
+    dists = [np.hypot(*(c-ref[i]).reshape(-1,2).T).mean() for i,c in zip(ids.flatten(), corners) if i in ref]
+    return np.mean(dists) if dists else np.nan
+
+def _num_markers(ids: np.ndarray|None) -> int:
+    return 0 if ids is None else len(ids)
+
+def _merge_boxes(boxes: list[list[int]]) -> list[list[int]]:
+    # merge overlapping boxes, so that each marker is detected only once
+    merged = True
+    while merged:
+        merged = False
+        out: list[list[int]] = []
+        for b in boxes:
+            for o in out:
+                if b[0]<o[2] and o[0]<b[2] and b[1]<o[3] and o[1]<b[3]:
+                    o[:] = [min(b[0],o[0]), min(b[1],o[1]), max(b[2],o[2]), max(b[3],o[3])]
+                    merged = True
+                    break
+            else:
+                out.append(list(b))
+        boxes = out
+    return [b for b in boxes if b[2]>b[0] and b[3]>b[1]]
+
+
+def get_pyramid_scale(marker_size: float, camera_params, max_distance: float, min_marker_px: float = 32.) -> float:
+    # scale at which a marker of marker_size (mm) seen at max_distance (mm) has an edge length of
+    # min_marker_px pixels. Without camera intrinsics, the marker's size in the image is unknown and
+    # no downscaling is done
+    if not camera_params.has_intrinsics():
+        return 1.
+    marker_px = camera_params.camera_mtx[0,0]*marker_size/max_distance
+    return min(1., min_marker_px/marker_px)
+
+def attach_pyramid(estimator: aruco.PoseEstimator, max_distance: float, check_interval: int|None = None) -> list[PyramidDetector]:
+    # must be called after all planes and individual markers are added to the estimator
+    detectors = []
+    for p,d in estimator._detectors.items():
+        marker_sizes = [estimator.plane_setups[p]['plane'].marker_size]
+        if p==estimator.planes[0] and (estimator._single_detect_pass or estimator.individual_markers):
+            # this detector finds the markers for all planes and the individual markers
+            marker_sizes += [estimator.plane_setups[q]['plane'].marker_size for q in estimator.planes]
+            marker_sizes += [estimator.individual_markers[i]['marker_size'] for i in estimator.individual_markers]
+        scale = get_pyramid_scale(min(marker_sizes), estimator.cam_params, max_distance)
+        d._det = PyramidDetector(d._det, d, p, lambda: estimator.video.frame_idx, scale, check_interval)
+        detectors.append(d._det)
+    return detectors
+
+def get_pyramid_detectors(estimator: aruco.PoseEstimator) -> list[PyramidDetector]:
+    out = []
+    for d in estimator._detectors.values():
+        det = d._det
+        if isinstance(det, TrackingDetector):
+            det = det._det
+        if isinstance(det, PyramidDetector):
+            out.append(det)
+    return out
+
+def print_accuracy_summary(stats: pd.DataFrame):
+    if stats.empty:
+        return
+    scales = ', '.join(f'{d}: {s:.2f}' for d,s in stats.groupby('detector')['scale'].first().items())
+    print(f"📐 Downscaled detection (scale {scales}) checked on {len(stats)} frames: {stats['t_pyramid_ms'].mean():.2f} ms/frame vs {stats['t_full_ms'].mean():.2f} ms/frame at full resolution")
+    print(f"🎯 Markers: {stats['n_markers_pyramid'].mean():.2f} vs {stats['n_markers_full'].mean():.2f} per frame, reprojection error: {stats['reprojection_error_pyramid'].mean():.3f} vs {stats['reprojection_error_full'].mean():.3f} px, mean corner difference {stats['corner_difference_px'].mean():.3f} px")
+
+def attach_tracking(estimator: aruco.PoseEstimator, full_scan_interval: int, roi_margin: float = 1.) -> list[TrackingDetector]:
+    trackers = []
+    for p,d in estimator._detectors.items():
+        d._det = TrackingDetector(d._det, p, lambda: estimator.video.frame_idx, full_scan_interval, roi_margin)
+        trackers.append(d._det)
+    return trackers
+
+def get_trackers(estimator: aruco.PoseEstimator) -> list[TrackingDetector]:
+    return [d._det for d in estimator._detectors.values() if isinstance(d._det, TrackingDetector)]
+
+def get_stats(detectors: list[TrackingDetector]|list[PyramidDetector]) -> pd.DataFrame:
+    if not detectors:
+        return pd.DataFrame()
+    return pd.concat([d.get_stats() for d in detectors], ignore_index=True).sort_values(['frame_idx','detector'], kind='stable', ignore_index=True)
+
+def print_stats_summary(stats: pd.DataFrame):
+    if stats.empty:
+        return
+    n_calls = len(stats)
+    roi     = stats[stats['mode']=='roi']
+    both    = stats[stats['mode']=='scheduled']     # frames where both modes were run
+    print(f"📈 Tracking: {len(roi)}/{n_calls} detections ({len(roi)/n_calls*100:.1f}%) only searched around tracked markers, {(stats['mode']=='miss').sum()} fell back to a full-frame scan")
+    if both.empty:
+        return
+    t_full = both['t_full_ms'].mean()
+    t_roi  = both['t_roi_ms'].mean()
+    # compared to doing a full-frame scan for each frame
+    saved  = t_full*n_calls-stats['t_roi_ms'].sum()-stats['t_full_ms'].sum()
+    print(f"⏱️ Full frame: {t_full:.2f} ms/frame, tracked: {t_roi:.2f} ms/frame, saved {saved/1000:.1f} s in total ({saved/n_calls:.2f} ms/frame)")
+    missed = both['n_markers_full']-both['n_markers_roi']
+    print(f"🎯 Detection rate on {len(both)} frames with both modes: full frame {both['n_markers_full'].mean():.2f} markers/frame, tracked {both['n_markers_roi'].mean():.2f} markers/frame ({(missed>0).sum()} frames with fewer markers when tracking)")
@@ -2,9 +2,15 @@
 plane_pose_prefix   = 'planePose_'
 marker_pose_prefix  = 'markerPose_'
 world_gaze_prefix   = 'planeGaze_'
+pairwise_distance_suffix = '_pairwise_distance'
 coding_file         = 'coding.tsv'
 target_sync_file    = 'et_sync_target_file.tsv'
 VOR_sync_file       = 'VOR_sync.tsv'
+ref_sync_file       = 'ref_sync.tsv'
+sync_model_file     = 'ref_sync_model.json'
+frame_mapping_file  = 'refFrameMapping.npy'
 validation_prefix   = 'validate_'
 process_video       = 'detectOutput.mp4'
+marker_stats_file   = 'markerDetectionStats.tsv'
+pyramid_stats_file  = 'markerPyramidStats.tsv'
 gaze_export_name    = 'planeGaze'
\ No newline at end of file
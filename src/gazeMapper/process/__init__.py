@@ -8,6 +8,7 @@ class State(enum.IntEnum):
     Pending     = enum.auto()
     Running     = enum.auto()
     Completed   = enum.auto()
+    Skipped     = enum.auto()   # action ran but had nothing to do
     # two more states needed by process_pool
     Canceled    = enum.auto()
     Failed      = enum.auto()
@@ -0,0 +1,222 @@
+import pathlib
+import threading
+import time
+import typing
+import dataclasses
+
+from .. import config, session
+from ..process import Action, State, action_update_and_invalidate, is_session_level_action, _is_recording_action_possible, _is_session_action_possible
+from .pipeline import _run_action_and_check, _run_shared_decode_and_check
+from . import shared_decode
+from gazeMapper.GUI._impl.process_pool import ProcessPool, ProcessFuture
+
+
+# order in which actions are planned. This is a topological order of the action preconditions, and
+# also ensures that actions that invalidate others are planned before the actions they invalidate
+action_order = [
+    Action.MAKE_GAZE_OVERLAY_VIDEO,
+    Action.DETECT_MARKERS,
+    Action.AUTO_CODE_SYNC,
+    Action.AUTO_CODE_TRIALS,
+    Action.SYNC_TO_REFERENCE,
+    Action.GAZE_TO_PLANE,
+    Action.RUN_VALIDATION,
+    Action.EXPORT_TRIALS,
+    Action.COMPUTE_GAZE_DISTANCE,
+    Action.MAKE_MAPPED_GAZE_VIDEO,
+]
+# actions that decode video are limited by the CPU worker budget, the others mostly read and
+# write tsv files and are limited by the I/O worker budget
+video_actions = {Action.MAKE_GAZE_OVERLAY_VIDEO, Action.DETECT_MARKERS, Action.MAKE_MAPPED_GAZE_VIDEO}
+
+
+@dataclasses.dataclass
+class BatchJob:
+    session:    str
+    recording:  typing.Optional[str]    # None for session-level actions
+    action:     Action
+    working_dir:pathlib.Path
+    depends_on: set[int]                = dataclasses.field(default_factory=set)
+    sort_key:   tuple[int,int]          = (0,0)
+    # further actions run in the same job, sharing a single decode of the video
+    shared_actions: list[Action]        = dataclasses.field(default_factory=list)
+
+    state:      State                   = State.Pending
+    error:      typing.Optional[BaseException] = None
+
+    @property
+    def name(self) -> str:
+        return f'{self.session}/{self.recording}' if self.recording else self.session
+
+    @property
+    def action_name(self) -> str:
+        return ' + '.join(a.displayable_name for a in [self.action]+self.shared_actions)
+
+
+def plan_session(sess: session.Session, study_config: config.Study, actions: set[Action], jobs: list[BatchJob], sort_idx: int = 0) -> list[tuple[str|None,Action]]:
+    # Adds jobs for the given session to jobs (job id is the index in that list). Returns list of
+    # (recording, action) that were wanted but cannot be run because preconditions that cannot be
+    # run headless (e.g. manual coding) are not met
+    rec_types = {r:sess.recordings[r].definition.type for r in sess.recordings}
+    # simulated action states: as on disk, updated for each planned job
+    sess_states = dict(sess.state)
+    rec_states  = {r:dict(sess.recordings[r].state) for r in sess.recordings}
+    # for each planned (recording, action), its job id
+    planned: dict[tuple[str|None,Action],int] = {}
+    # for each (recording, action), the planned jobs that reset it to Not_Run and must thus run before it
+    invalidated_by: dict[tuple[str|None,Action],set[int]] = {}
+    not_possible: list[tuple[str|None,Action]] = []
+
+    def _without_planned(states: dict[Action,State], rec: str|None):
+        return {a:(State.Not_Run if (rec,a) in planned else states[a]) for a in states}
+
+    def _apply_mutations(job_id: int, action: Action, rec: str|None):
+        mutations = action_update_and_invalidate(action, State.Completed, study_config)
+        for a in mutations:
+            if a==action:
+                continue
+            if is_session_level_action(a):
+                targets = [(None, sess_states)]
+            else:
+                targets = [(r, rec_states[r]) for r in rec_states if rec is None or r==rec]
+            for r,states in targets:
+                states[a] = mutations[a]
+                invalidated_by.setdefault((r,a), set()).add(job_id)
+        (sess_states if rec is None else rec_states[rec])[action] = State.Completed
+
+    def _add_job(rec: str|None, action: Action, depends_on: set[int]):
+        depends_on |= invalidated_by.get((rec,action), set())
+        if action in shared_decode.actions and (shared:=[planned[(rec,a)] for a in shared_decode.actions if (rec,a) in planned]):
+            # run together with the already planned job that processes the same video, so the video
+            # is decoded only once. NB: these actions do not depend on each other
+            job_id = shared[0]
+            jobs[job_id].shared_actions.append(action)
+            jobs[job_id].depends_on |= depends_on-{job_id}
+            planned[(rec,action)] = job_id
+            _apply_mutations(job_id, action, rec)
+            return
+        job_id = len(jobs)
+        jobs.append(BatchJob(sess.name, rec, action, sess.working_directory if rec is None else sess.working_directory/rec, depends_on, (sort_idx, action_order.index(action))))
+        planned[(rec,action)] = job_id
+        _apply_mutations(job_id, action, rec)
+
+    for action in action_order:
+        if action not in actions:
+            continue
+        if is_session_level_action(action):
+            if sess_states[action]==State.Completed:
+                continue
+            possible, missing = _is_session_action_possible(sess_states, rec_states, study_config, rec_types, action)
+            if missing is None:
+                continue    # not applicable to this study
+            if not possible:
+                not_possible.append((None, action))
+                continue
+            # preconditions that are only met thanks to planned jobs are our dependencies
+            _, missing = _is_session_action_possible(_without_planned(sess_states, None), {r:_without_planned(rec_states[r], r) for r in rec_states}, study_config, rec_types, action)
+            depends_on = set()
+            for p in missing or {}:
+                if is_session_level_action(p):
+                    depends_on.add(planned[(None,p)])
+                else:
+                    depends_on.update(planned[(r,p)] for r in missing[p] if (r,p) in planned)
+            _add_job(None, action, depends_on)
+        else:
+            for r in rec_states:
+                if rec_states[r][action]==State.Completed:
+                    continue
+                merged = sess_states|rec_states[r]
+                possible, missing = _is_recording_action_possible(r, merged, study_config, rec_types[r], action)
+                if missing is None:
+                    continue    # not applicable to this recording or study
+                if not possible:
+                    not_possible.append((r, action))
+                    continue
+                merged = _without_planned(sess_states, None)|_without_planned(rec_states[r], r)
+                _, missing = _is_recording_action_possible(r, merged, study_config, rec_types[r], action)
+                depends_on = {planned[(None if is_session_level_action(p) else r, p)] for p in missing}
+                _add_job(r, action, depends_on)
+
+    return not_possible
+
+
+def run(project_dir: str|pathlib.Path, actions: set[Action]|None = None, cpu_workers: int|None = None, io_workers: int|None = None):
+    # Headless batch processing of all sessions in a project. Builds a job graph of all to be run
+    # (session, recording, action) combinations and executes it with bounded concurrency: video decoding
+    # actions and tsv processing actions each have their own worker budget, so that e.g. marker
+    # detection for one session overlaps with the tsv-heavy stages of another
+    project_dir = pathlib.Path(project_dir)
+    study_config = config.Study.load_from_json(config.guess_config_dir(project_dir))
+    if actions is None:
+        actions = {a for a in action_order if not a.needs_GUI}
+    if cpu_workers is None:
+        cpu_workers = study_config.gui_num_workers
+    if io_workers is None:
+        io_workers = study_config.gui_num_workers
+
+    # plan
+    sessions = sorted(session.get_sessions_from_project_directory(project_dir, study_config.session_def), key=lambda s: s.name)
+    jobs: list[BatchJob] = []
+    for i,sess in enumerate(sessions):
+        for rec,action in plan_session(sess, study_config, actions, jobs, i):
+            print(f'{sess.name}{"/"+rec if rec else ""}: cannot run {action.displayable_name}, its preconditions are not met')
+    if not jobs:
+        print('Nothing to do')
+        return
+    sessions_with_jobs = {j.session for j in jobs}
+    print(f'Running {len(jobs)} jobs for {len(sessions_with_jobs)} sessions')
+
+    # execute
+    pools = {True: ProcessPool(cpu_workers), False: ProcessPool(io_workers)}
+    running: dict[bool,int] = {True: 0, False: 0}
+    job_done = threading.Event()
+    lock = threading.Lock()
+    def _done_callback(future: ProcessFuture, _: int, job_id: int, state: State):
+        with lock:
+            if state==State.Completed:
+                # the job returns the final state of its action(s), which may be Skipped
+                state = future.result()
+            jobs[job_id].state = state
+            if state==State.Failed:
+                jobs[job_id].error = future.exception()
+            running[jobs[job_id].action in video_actions] -= 1
+        job_done.set()
+
+    t0 = time.perf_counter()
+    try:
+        while True:
+            job_done.clear()
+            with lock:
+                # propagate failures to jobs that can now never run
+                for j in jobs:
+                    if j.state==State.Pending and any(jobs[d].state in [State.Failed, State.Canceled] for d in j.depends_on):
+                        j.state = State.Canceled
+                ready = sorted((i for i,j in enumerate(jobs) if j.state==State.Pending and all(jobs[d].state in [State.Completed, State.Skipped] for d in j.depends_on)), key=lambda i: jobs[i].sort_key)
+                for job_id in ready:
+                    is_video = jobs[job_id].action in video_actions
+                    if running[is_video]>=pools[is_video].num_workers:
+                        continue
+                    jobs[job_id].state = State.Running
+                    running[is_video] += 1
+                    if jobs[job_id].shared_actions:
+                        pools[is_video].run(_run_shared_decode_and_check, job_id, _done_callback, [jobs[job_id].action]+jobs[job_id].shared_actions, jobs[job_id].working_dir, jobs[job_id].name)
+                    else:
+                        pools[is_video].run(_run_action_and_check, job_id, _done_callback, jobs[job_id].action, jobs[job_id].working_dir, jobs[job_id].name)
+                if not any(j.state in [State.Pending, State.Running] for j in jobs):
+                    break
+            job_done.wait()
+    finally:
+        for p in pools.values():
+            p.cleanup()
+    elapsed = time.perf_counter()-t0
+
+    # report
+    for j in jobs:
+        if j.state==State.Failed:
+            print(f'{j.name}: {j.action_name} failed: {j.error}')
+        elif j.state==State.Canceled:
+            print(f'{j.name}: {j.action_name} not run because an action it depends on failed')
+        elif j.state==State.Skipped:
+            print(f'{j.name}: {j.action_name} skipped, nothing to do')
+    n_ok = len([s for s in sessions_with_jobs if all(j.state in [State.Completed, State.Skipped] for j in jobs if j.session==s)])
+    print(f'Processed {n_ok}/{len(sessions_with_jobs)} sessions successfully in {elapsed:.1f} s ({n_ok/elapsed*3600:.1f} sessions/hour)')
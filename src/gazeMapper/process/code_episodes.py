@@ -10,11 +10,11 @@ isMacOS = sys.platform.startswith("darwin")
 if isMacOS:
     import AppKit
 
-from glassesTools import annotation, drawing, gaze_headref, gaze_worldref, naming as gt_naming, ocv, plane as gt_plane, propagating_thread, timestamps, transforms
+from glassesTools import annotation, drawing, gaze_worldref, naming as gt_naming, ocv, propagating_thread, timestamps, transforms
 from glassesTools.gui.video_player import GUI
 
 
-from .. import config, episode, naming, plane, process, session, synchronization
+from .. import config, data_files, episode, gaze_store, naming, plane, process, session, synchronization
 
 # This script shows a video player that is used to indicate the interval(s)
 # during which the poster should be found in the video and in later
@@ -70,7 +70,7 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
     elif rec_def.type==session.RecordingType.Eye_Tracker:
         # Read gaze data
         has_gaze = True
-        gazes = gaze_headref.read_dict_from_file(working_dir / gt_naming.gaze_data_fname, ts_column_suffixes=['VOR',''])[0]
+        gazes = gaze_store.read_head_gaze(working_dir / gt_naming.gaze_data_fname, ts_column_suffixes=['VOR',''])
 
         planes: set[str] = set()
         for e in [annotation.Event.Validate, annotation.Event.Trial]:
@@ -80,8 +80,7 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
             planes.update(study_config.planes_per_episode[annotation.Event.Sync_ET_Data])
 
         # Read gaze on poster data, if available
-        plane_files = [working_dir/f'{naming.world_gaze_prefix}{p}.tsv' for p in planes]
-        plane_gazes = {p:gaze_worldref.read_dict_from_file(f) for p,f in zip(planes,plane_files) if f.is_file()}
+        plane_gazes = {p:data_files.read_plane_gaze(working_dir, p) for p in planes if data_files.find_plane_gaze_file(working_dir, p)}
         has_plane_gaze = not not plane_gazes
 
         if has_plane_gaze:
@@ -91,8 +90,7 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
                 planes_setup[p] = plane.get_plane_from_definition(p_def, config_dir/p)
 
         # Read plane poses, if available
-        plane_files = [working_dir/f'{naming.plane_pose_prefix}{p}.tsv' for p in planes]
-        poses = {p:gt_plane.read_dict_from_file(f) for p,f in zip(planes,plane_files) if f.is_file()}
+        poses = {p:data_files.read_plane_poses(working_dir, p) for p in planes if data_files.find_plane_pose_file(working_dir, p)}
         has_plane_pose = not not poses
     else:
         raise ValueError(f'recording type "{rec_def.type}" is not understood')
@@ -1,8 +1,9 @@
 import pathlib
+import typing
 import pandas as pd
 import numpy as np
-from .. import process, config, session, naming as gm_naming
-from glassesTools import annotation
+from .. import process, config, data_files, session, synchronization, naming as gm_naming
+from glassesTools import annotation, naming, timestamps
 
 
 def run(working_dir: str | pathlib.Path, config_dir: str | pathlib.Path = None, **study_settings):
@@ -12,9 +13,9 @@ def run(working_dir: str | pathlib.Path, config_dir: str | pathlib.Path = None,
     config_dir = pathlib.Path(config_dir)
     print(f"\n Start compute_gaze_distance for: {working_dir}")
 
-    ref_sync_path = working_dir / "ref_sync.tsv"
+    ref_sync_path = working_dir / gm_naming.ref_sync_file
     if not ref_sync_path.exists():
-        raise FileNotFoundError(f"ref_sync.tsv niet gevonden in: {working_dir}")
+        raise FileNotFoundError(f"{gm_naming.ref_sync_file} niet gevonden in: {working_dir}")
 
     ref_sync_df = pd.read_csv(ref_sync_path, sep="\t")
     mean_offset = ref_sync_df["mean_off"].iloc[0]
@@ -28,9 +29,21 @@ def run(working_dir: str | pathlib.Path, config_dir: str | pathlib.Path = None,
         session_info = session.Session.from_definition(study_cfg.session_def, working_dir)
         rec_names = list(session_info.recordings.keys())
 
-        if len(rec_names) != 2:
-            raise ValueError("Compute gaze distance vereist exact 2 recordings")
-        rec_a, rec_b = rec_names
+        et_recs = [r for r in rec_names if session_info.recordings[r].definition.type==session.RecordingType.Eye_Tracker]
+        if len(et_recs) < 2:
+            raise ValueError(f"Compute gaze distance vereist minstens 2 eye tracker recordings, gevonden: {et_recs}")
+        if study_cfg.gaze_distance_all_pairs or len(et_recs) > 2:
+            trial_planes = sorted(study_cfg.planes_per_episode.get(annotation.Event.Trial, []))
+            if not trial_planes:
+                raise ValueError("Geen plane gevonden in planes_per_episode voor 'Trial'")
+            print(f"Comparing gaze for all pairs of: {et_recs}")
+            for plane in trial_planes:
+                output_path, n_samples = compute_pairwise_distances(working_dir, study_cfg, rec_names, et_recs, plane)
+                print(f"Pairwise distances for plane {plane} ({n_samples} samples) saved to: {output_path}")
+            session.update_action_states(working_dir, process.Action.COMPUTE_GAZE_DISTANCE, process.State.Completed, study_cfg)
+            return
+
+        rec_a, rec_b = et_recs
         print(f"Comparing gaze from: {rec_a} vs {rec_b}")
 
         trial_planes = study_cfg.planes_per_episode.get(annotation.Event.Trial, [])
@@ -39,76 +52,31 @@ def run(working_dir: str | pathlib.Path, config_dir: str | pathlib.Path = None,
         plane = list(trial_planes)[0]
         print(f"Using plane: {plane}")
 
-        path_a = working_dir / rec_a / f"{gm_naming.world_gaze_prefix}{plane}.tsv"
-        path_b = working_dir / rec_b / f"{gm_naming.world_gaze_prefix}{plane}.tsv"
+        path_a = data_files.find_plane_gaze_file(working_dir / rec_a, plane)
+        path_b = data_files.find_plane_gaze_file(working_dir / rec_b, plane)
 
-        if not path_a.exists() or not path_b.exists():
+        if path_a is None or path_b is None:
             raise FileNotFoundError("Een van de gaze-bestanden bestaat niet.")
 
-        print(f"Loading TSV A: {path_a}")
-        print(f"Loading TSV B: {path_b}")
-
-        df_a = pd.read_csv(path_a, sep="\t")
-        df_b = pd.read_csv(path_b, sep="\t")
-        print(f"Rows in {rec_a}: {len(df_a)}")
-        print(f"Rows in {rec_b}: {len(df_b)}")
-
-        if "timestamp_VOR" not in df_b.columns or "timestamp_ref" not in df_b.columns:
-            raise ValueError("data mist 'timestamp_VOR' of 'timestamp_ref'.")
-
-        
-        df_b["timestamp_VOR"] += mean_offset
-        df_b_sorted = df_b.sort_values("timestamp_ref").reset_index(drop=True)
-        df_a_sorted = df_a.sort_values("timestamp_VOR").reset_index(drop=True)
-
-        print(f"\nEerste timestamps A: {df_a_sorted['timestamp_VOR'].head(5).tolist()}")
-        print(f"Eerste timestamps B: {df_b_sorted['timestamp_ref'].head(5).tolist()}")
-
-        merged = pd.merge_asof(
-            df_a_sorted,
-            df_b_sorted,
-            left_on="timestamp_VOR",
-            right_on="timestamp_ref",
-            direction="nearest",
-            tolerance=0.25,
-            suffixes=("_a", "_b")
-        )
-        print(f"Merged rows: {len(merged)}")
-
-        # Validatie gaze kolommen
-        for col in ["gazePosPlane2D_vidPos_homography_x_b", "gazePosPlane2D_vidPos_homography_y_b"]:
-            if col not in merged.columns:
-                raise KeyError(f"Kolom ontbreekt na merge: {col}")
-
-        valid = merged[
-            merged["gazePosPlane2D_vidPos_homography_x_a"].notna() &
-            merged["gazePosPlane2D_vidPos_homography_y_a"].notna() &
-            merged["gazePosPlane2D_vidPos_homography_x_b"].notna() &
-            merged["gazePosPlane2D_vidPos_homography_y_b"].notna()
-        ]
-        #print(f"Valid gaze points: {len(valid)}")
-
-        if len(valid) == 0:
+        print(f"Loading A: {path_a}")
+        print(f"Loading B: {path_b}")
+
+        output_path = working_dir / f"{rec_a}_vs_{rec_b}_{plane}_merged_distance.tsv"
+        try:
+            n_a, n_b, n_valid = compute_distances(path_a, path_b, output_path, mean_offset, streaming=True)
+        except _NotSortedError:
+            print("Gaze data niet gesorteerd op tijd, wordt in het geheugen gesorteerd.")
+            n_a, n_b, n_valid = compute_distances(path_a, path_b, output_path, mean_offset, streaming=False)
+        print(f"Rows in {rec_a}: {n_a}")
+        print(f"Rows in {rec_b}: {n_b}")
+        #print(f"Valid gaze points: {n_valid}")
+
+        if n_valid == 0:
             print("Geen geldige samengevoegde gaze data gevonden. Bestand wordt niet geschreven.")
+            output_path.unlink(missing_ok=True)
             session.update_action_states(working_dir, process.Action.COMPUTE_GAZE_DISTANCE, process.State.Skipped, study_cfg)
             return
 
-        distances_mm = np.linalg.norm(
-            valid[["gazePosPlane2DWorld_x_a", "gazePosPlane2DWorld_y_a"]].values -
-            valid[["gazePosPlane2DWorld_x_b", "gazePosPlane2DWorld_y_b"]].values,
-            axis=1
-        )
-        valid["gaze_distance_mm"] = distances_mm
-
-        if "timestamp_VOR_a" in valid.columns:
-            valid["timestamp"] = valid["timestamp_VOR_a"]
-        else:
-            valid["timestamp"] = merged["timestamp_VOR"]
-
-    
-
-        output_path = working_dir / f"{rec_a}_vs_{rec_b}_{plane}_merged_distance.tsv"
-        valid.to_csv(output_path, sep="\t", index=False, float_format="%.8f")
         print(f"Merged TSV with distances saved to: {output_path}")
 
         session.update_action_states(
@@ -123,8 +91,152 @@ def run(working_dir: str | pathlib.Path, config_dir: str | pathlib.Path = None,
         raise
 
 
-
-
-
-
-
+# columns of the planeGaze files needed for the distance analysis, and the timestamp
+# columns on which the recordings are aligned
+_data_columns = ['timestamp', 'frame_idx', 'gazePosPlane2D_vidPos_homography_x', 'gazePosPlane2D_vidPos_homography_y', 'gazePosPlane2DWorld_x', 'gazePosPlane2DWorld_y']
+_columns_a = ['timestamp_VOR'] + _data_columns
+_columns_b = ['timestamp_VOR', 'timestamp_ref'] + _data_columns
+_key_a = 'timestamp_VOR'
+_key_b = 'timestamp_ref'
+
+class _NotSortedError(Exception):
+    pass
+
+def _read_chunks(path: pathlib.Path, columns: list[str], key: str, chunk_size: int, streaming: bool) -> typing.Iterator[dict[str,np.ndarray]]:
+    # yields the requested columns of the file in chunks. When streaming, the file must be sorted
+    # on key (_NotSortedError is raised otherwise). When not streaming, the whole file is read and
+    # sorted, and yielded as a single chunk
+    header = data_files.get_columns(path)
+    if (missing := [c for c in columns if c not in header]):
+        raise ValueError(f"{path.name} mist kolom(men): {missing}")
+    if not streaming:
+        df = data_files.read_columns(path, columns)
+        if df[key].isna().any():
+            raise ValueError(f"Merge keys contain null values ({key} in {path.name})")
+        order = np.argsort(df[key].to_numpy(), kind='quicksort')   # NB: same sort as pandas' sort_values
+        yield {c:df[c].to_numpy()[order] for c in columns}
+        return
+
+    last = -np.inf
+    for df in data_files.iter_columns(path, columns, chunk_size):
+        keys = df[key].to_numpy()
+        if np.isnan(keys).any():
+            raise ValueError(f"Merge keys contain null values ({key} in {path.name})")
+        if keys.size and (keys[0]<last or np.any(np.diff(keys)<0)):
+            raise _NotSortedError()
+        if keys.size:
+            last = keys[-1]
+        yield {c:df[c].to_numpy() for c in columns}
+
+def compute_distances(path_a: pathlib.Path, path_b: pathlib.Path, output_path: pathlib.Path, offset_b: float, tolerance: float = 0.25, chunk_size: int = 100_000, streaming: bool = True) -> tuple[int,int,int]:
+    # Aligns each sample of recording A (on timestamp_VOR) to the nearest sample of recording B
+    # (on timestamp_ref) and writes the gaze distance on the plane for all samples where both have
+    # gaze. Gives the same result as pd.merge_asof(direction="nearest") on the full files, but
+    # walks both files chunk by chunk, keeping only the window of B that can match the current
+    # chunk of A in memory. Returns number of samples in A and B, and number of samples written
+    n_a = n_b = n_valid = 0
+    chunks_b = _read_chunks(path_b, _columns_b, _key_b, chunk_size, streaming)
+    window: dict[str,np.ndarray] = {c:np.empty(0) for c in _columns_b}
+    b_exhausted = False
+    with open(output_path, 'w', newline='') as f:
+        for chunk_a in _read_chunks(path_a, _columns_a, _key_a, chunk_size, streaming):
+            keys_a = chunk_a[_key_a]
+            n_a += keys_a.size
+            if not keys_a.size:
+                continue
+            # advance window over B: drop what is too early to match, read until past what can match
+            keep = np.searchsorted(window[_key_b], keys_a[0]-tolerance, side='left')
+            window = {c:v[keep:] for c,v in window.items()}
+            while not b_exhausted and (not window[_key_b].size or window[_key_b][-1]<=keys_a[-1]+tolerance):
+                try:
+                    chunk_b = next(chunks_b)
+                except StopIteration:
+                    b_exhausted = True
+                    break
+                n_b += chunk_b[_key_b].size
+                window = {c:np.concatenate((window[c], chunk_b[c])) if window[c].size else chunk_b[c] for c in _columns_b}
+
+            idx = synchronization.nearest_timestamps(keys_a, window[_key_b], tolerance)
+            valid = (idx>=0) & ~np.isnan(chunk_a['gazePosPlane2D_vidPos_homography_x']) & ~np.isnan(chunk_a['gazePosPlane2D_vidPos_homography_y'])
+            idx_b = idx[valid]
+            valid[valid] = ~np.isnan(window['gazePosPlane2D_vidPos_homography_x'][idx_b]) & ~np.isnan(window['gazePosPlane2D_vidPos_homography_y'][idx_b])
+            idx_b = idx[valid]
+            if not idx_b.size:
+                continue
+
+            out = {'timestamp': chunk_a[_key_a][valid]}
+            out |= {f'{c}_a':chunk_a[c][valid] for c in _columns_a}
+            out |= {f'{c}_b':window[c][idx_b] for c in _columns_b}
+            out['timestamp_VOR_b'] = out['timestamp_VOR_b']+offset_b
+            dx = out['gazePosPlane2DWorld_x_a']-out['gazePosPlane2DWorld_x_b']
+            dy = out['gazePosPlane2DWorld_y_a']-out['gazePosPlane2DWorld_y_b']
+            out['gaze_distance_mm'] = np.sqrt(dx*dx+dy*dy)
+            pd.DataFrame(out).to_csv(f, sep="\t", index=False, header=not n_valid, float_format="%.8f")
+            n_valid += idx_b.size
+
+    # count remainder of B
+    for chunk_b in chunks_b:
+        n_b += chunk_b[_key_b].size
+    return n_a, n_b, n_valid
+
+
+def compute_pairwise_distances(working_dir: pathlib.Path, study_cfg: config.Study, rec_names: list[str], et_recs: list[str], plane: str, tolerance: float = 0.25) -> tuple[pathlib.Path,int]:
+    # Brings gaze on the plane of all eye tracker recordings onto the timeline of the reference
+    # recording, matches each reference sample to the nearest sample of every other recording,
+    # and computes the distance between gaze positions for all pairs of recordings at once.
+    # The result is stored in the session folder in the configured data file format (read it with
+    # data_files.read_pairwise_distances()). Returns the written file and the number of samples in it
+    if len(et_recs) < 2:
+        raise ValueError(f"Compute gaze distance vereist minstens 2 eye tracker recordings, gevonden: {et_recs}")
+    ref = study_cfg.sync_ref_recording if study_cfg.sync_ref_recording in et_recs else et_recs[0]
+    if study_cfg.sync_ref_recording:
+        # NB: all recordings except the reference, as there may be camera recordings in sync_ref_average_recordings
+        sync = synchronization.get_sync_model(working_dir, [r for r in rec_names if r!=study_cfg.sync_ref_recording], study_cfg.sync_ref_recording, study_cfg.sync_ref_do_time_stretch, study_cfg.sync_ref_average_recordings)
+        video_ts_ref = timestamps.VideoTimestamps(working_dir / study_cfg.sync_ref_recording / naming.frame_timestamps_fname)
+
+    columns = ['gazePosPlane2D_vidPos_homography_x', 'gazePosPlane2D_vidPos_homography_y', 'gazePosPlane2DWorld_x', 'gazePosPlane2DWorld_y']
+    ts: dict[str,np.ndarray] = {}
+    pos: dict[str,np.ndarray] = {}
+    for r in et_recs:
+        path = data_files.find_plane_gaze_file(working_dir / r, plane)
+        if path is None:
+            raise FileNotFoundError(f"Gaze-bestand bestaat niet: {working_dir / r / (gm_naming.world_gaze_prefix+plane)}")
+        ts_col = 'timestamp_VOR' if 'timestamp_VOR' in data_files.get_columns(path) else 'timestamp'
+        df = data_files.read_columns(path, [ts_col]+columns)
+        t = df[ts_col].to_numpy()
+        if study_cfg.sync_ref_recording and r!=study_cfg.sync_ref_recording:
+            t = synchronization.apply_sync(r, sync, t, video_ts_ref.timestamps, study_cfg.sync_ref_do_time_stretch, study_cfg.sync_ref_stretch_which, in_place=True)[0]
+        order = np.argsort(t, kind='stable')
+        p = df[['gazePosPlane2DWorld_x', 'gazePosPlane2DWorld_y']].to_numpy()[order]
+        # only samples with gaze on the plane
+        p[np.isnan(df['gazePosPlane2D_vidPos_homography_x'].to_numpy()[order]) | np.isnan(df['gazePosPlane2D_vidPos_homography_y'].to_numpy()[order])] = np.nan
+        ts[r]  = t[order]
+        pos[r] = p
+
+    # align all recordings to the reference's samples: (samples x recordings x 2) array of positions
+    timeline = ts[ref]
+    all_ts  = np.full((timeline.size, len(et_recs)), np.nan)
+    all_pos = np.full((timeline.size, len(et_recs), 2), np.nan)
+    for i,r in enumerate(et_recs):
+        idx = np.arange(timeline.size) if r==ref else synchronization.nearest_timestamps(timeline, ts[r], tolerance)
+        ok = idx>=0
+        all_ts [ok,i]   = ts [r][idx[ok]]
+        all_pos[ok,i,:] = pos[r][idx[ok]]
+
+    # distance between all pairs of recordings, for all samples at once
+    diff = all_pos[:,:,np.newaxis,:]-all_pos[:,np.newaxis,:,:]
+    dist = np.sqrt(np.sum(diff*diff, axis=-1))
+    i_a, i_b = np.triu_indices(len(et_recs), 1)
+    dist = dist[:,i_a,i_b]
+
+    # keep samples for which at least one pair has a distance, and store
+    keep = ~np.all(np.isnan(dist), axis=1)
+    out = {'timestamp': timeline[keep]}
+    for i,r in enumerate(et_recs):
+        out[f'timestamp_{r}'] = all_ts[keep,i]
+        out[f'gazePosPlane2DWorld_x_{r}'] = all_pos[keep,i,0]
+        out[f'gazePosPlane2DWorld_y_{r}'] = all_pos[keep,i,1]
+    for k,(a,b) in enumerate(zip(i_a,i_b)):
+        out[f'gaze_distance_mm_{et_recs[a]}_vs_{et_recs[b]}'] = dist[keep,k]
+    output_path = data_files.write_pairwise_distances(pd.DataFrame(out), working_dir, plane, study_cfg.data_file_format)
+    return output_path, int(np.count_nonzero(keep))
@@ -1,4 +1,6 @@
 import pathlib
+import concurrent.futures
+import multiprocessing
 import pandas as pd
 import numpy as np
 from typing import Any, Callable
@@ -8,7 +10,7 @@ from glassesTools import annotation, aruco, drawing, marker as gt_marker, naming
 from glassesTools.gui.video_player import GUI
 
 
-from .. import config, episode, marker, naming, plane, process, session, synchronization
+from .. import config, data_files, episode, marker, marker_detection, naming, plane, process, session, synchronization, video_segments
 
 
 def run(working_dir: str|pathlib.Path, config_dir: str|pathlib.Path = None, show_visualization=False, visualization_show_rejected_markers=False, **study_settings):
@@ -46,6 +48,65 @@ def run(working_dir: str|pathlib.Path, config_dir: str|pathlib.Path = None, show
 def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, visualization_show_rejected_markers: bool, **study_settings):
     print(f"🛠️ Start Detect Markers: {working_dir.name}")
 
+    study_config, estimator, episodes = _setup_estimator(working_dir, config_dir, **study_settings)
+
+    estimator.attach_gui(gui)
+    if gui:
+        print("🖼️ GUI setup")
+        gui.set_show_timeline(True, timestamps.VideoTimestamps(working_dir / gt_naming.frame_timestamps_fname),
+                              annotation.flatten_annotation_dict(episodes), window_id=gui.main_window_id)
+        estimator.show_rejected_markers = visualization_show_rejected_markers
+
+    # NB: processes of the GUI's and batch processing's worker pools are not allowed to start
+    # processes of their own, and there the actions are already run in parallel anyway
+    segments = None
+    if gui is None and study_config.detect_markers_num_workers>1 and not multiprocessing.current_process().daemon:
+        segments = _get_segments(estimator, study_config.detect_markers_num_workers)
+
+    if segments:
+        print(f"▶️ Start processing video in {len(segments)} segments...")
+        del estimator   # close video, workers open their own
+        poses, individual_markers, sync_target_signal, detection_stats, pyramid_stats = _process_segments(working_dir, config_dir, segments, **study_settings)
+    else:
+        print("▶️ Start processing video...")
+        poses, individual_markers, sync_target_signal = estimator.process_video()
+        detection_stats = marker_detection.get_stats(marker_detection.get_trackers(estimator))
+        pyramid_stats   = marker_detection.get_stats(marker_detection.get_pyramid_detectors(estimator))
+    print("✅ Finished processing video")
+
+    _write_output(working_dir, study_config, poses, individual_markers, sync_target_signal, detection_stats, pyramid_stats)
+
+
+def _write_output(working_dir: pathlib.Path, study_config: config.Study,
+                  poses: dict[str, list[gt_plane.Pose]], individual_markers: dict[int, list[gt_marker.Pose]], sync_target_signal: dict[str, list[list[int, Any]]],
+                  detection_stats: pd.DataFrame, pyramid_stats: pd.DataFrame):
+    if study_config.detect_markers_use_pyramid and study_config.detect_markers_pyramid_check_interval:
+        marker_detection.print_accuracy_summary(pyramid_stats)
+        print(f"💾 Writing downscaled marker detection accuracy to {working_dir / naming.pyramid_stats_file}")
+        pyramid_stats.to_csv(working_dir / naming.pyramid_stats_file, sep='\t', index=False, na_rep='nan', float_format="%.4f")
+
+    if study_config.detect_markers_use_tracking:
+        marker_detection.print_stats_summary(detection_stats)
+        print(f"💾 Writing marker detection statistics to {working_dir / naming.marker_stats_file}")
+        detection_stats.to_csv(working_dir / naming.marker_stats_file, sep='\t', index=False, na_rep='nan', float_format="%.3f")
+
+    for p in poses:
+        print(f"💾 Writing plane poses for '{p}' to {working_dir}")
+        data_files.write_plane_poses(poses[p], working_dir, p, study_config.data_file_format, skip_failed=True)
+
+    for i in individual_markers:
+        print(f"💾 Writing marker poses for ID {i} to {working_dir}")
+        data_files.write_marker_poses(individual_markers[i], working_dir, i, study_config.data_file_format, skip_failed=False)
+
+    if sync_target_signal:
+        df = pd.DataFrame(sync_target_signal['sync'], columns=['frame_idx', 'target_x', 'target_y'])
+        target_path = working_dir / naming.target_sync_file
+        print(f"💾 Writing sync target signal to {target_path}")
+        df.to_csv(target_path, sep='\t', index=False, na_rep='nan', float_format="%.8f")
+
+
+def _setup_estimator(working_dir: pathlib.Path, config_dir: pathlib.Path, verbose=True, **study_settings) -> tuple[config.Study, aruco.PoseEstimator, dict[annotation.Event,list[list[int]]]]:
+    log = print if verbose else lambda *_: None
     study_config = config.read_study_config_with_overrides(config_dir, {
         config.OverrideLevel.Session: working_dir.parent,
         config.OverrideLevel.Recording: working_dir
@@ -53,23 +114,23 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, v
 
     rec_def = study_config.session_def.get_recording_def(working_dir.name)
     in_video = session.read_recording_info(working_dir, rec_def.type)[1]
-    print(f"🎥 Video path: {in_video}")
+    log(f"🎥 Video path: {in_video}")
 
     has_auto_code = bool(study_config.auto_code_sync_points or study_config.auto_code_trial_episodes)
     episode_file = working_dir / naming.coding_file
-    print(f"📄 Coding file: {episode_file}")
+    log(f"📄 Coding file: {episode_file}")
 
     if episode_file.is_file():
         episodes = episode.list_to_marker_dict(episode.read_list_from_file(episode_file), study_config.episodes_to_code)
-        print(f"✅ Loaded episodes: {[k.name for k in episodes]}")
+        log(f"✅ Loaded episodes: {[k.name for k in episodes]}")
     else:
         if not has_auto_code:
             raise RuntimeError(f"❌ Coding is missing, cannot run Detect Markers\n{episode_file}")
         episodes = episode.get_empty_marker_dict(list(study_config.episodes_to_code))
-        print(f"⚠️ No coding file found, using empty marker dict")
+        log(f"⚠️ No coding file found, using empty marker dict")
 
     if study_config.sync_ref_recording and rec_def.name != study_config.sync_ref_recording:
-        print("🔁 Getting synced trial episodes from reference recording")
+        log("🔁 Getting synced trial episodes from reference recording")
         all_recs = [r.name for r in study_config.session_def.recordings]
         episodes[annotation.Event.Trial] = synchronization.get_episode_frame_indices_from_ref(
             working_dir, annotation.Event.Trial, rec_def.name,
@@ -81,67 +142,110 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, v
         )
 
     sync_target_function = _get_sync_function(study_config, rec_def, episodes.get(annotation.Event.Sync_ET_Data, None))
-    print("📦 Getting plane setup...")
+    log("📦 Getting plane setup...")
     planes_setup, analyze_frames = _get_plane_setup(study_config, config_dir, episodes)
 
-    print(f"🧭 Planes to detect: {list(planes_setup.keys())}")
+    log(f"🧭 Planes to detect: {list(planes_setup.keys())}")
     for p, setup in planes_setup.items():
-        print(f" - {p}: {len(analyze_frames[p]) if analyze_frames[p] else 'ALL'} frames")
+        log(f" - {p}: {len(analyze_frames[p]) if analyze_frames[p] else 'ALL'} frames")
 
     estimator = aruco.PoseEstimator(in_video, working_dir / gt_naming.frame_timestamps_fname, working_dir / gt_naming.scene_camera_calibration_fname)
 
     for p in planes_setup:
-        print(f"➕ Adding plane '{p}' to estimator")
+        log(f"➕ Adding plane '{p}' to estimator")
         estimator.add_plane(p, planes_setup[p], analyze_frames[p])
 
     individual_markers = marker.get_marker_dict_from_list(study_config.individual_markers)
     for i in individual_markers:
-        print(f"➕ Adding individual marker {i} to estimator")
+        log(f"➕ Adding individual marker {i} to estimator")
         estimator.add_individual_marker(i, individual_markers[i])
 
     if individual_markers and has_auto_code:
         estimator.proc_individual_markers_all_frames = True
 
     if sync_target_function:
-        print("📌 Registering sync function")
+        log("📌 Registering sync function")
         estimator.register_extra_processing_fun('sync', *sync_target_function)
 
-    estimator.attach_gui(gui)
-    if gui:
-        print("🖼️ GUI setup")
-        gui.set_show_timeline(True, timestamps.VideoTimestamps(working_dir / gt_naming.frame_timestamps_fname),
-                              annotation.flatten_annotation_dict(episodes), window_id=gui.main_window_id)
-        estimator.show_rejected_markers = visualization_show_rejected_markers
+    if study_config.detect_markers_use_pyramid:
+        log("🔍 Using downscaled marker detection")
+        marker_detection.attach_pyramid(estimator, study_config.detect_markers_pyramid_max_distance, study_config.detect_markers_pyramid_check_interval)
+    if study_config.detect_markers_use_tracking:
+        log("🔍 Using tracking-assisted marker detection")
+        marker_detection.attach_tracking(estimator, study_config.detect_markers_full_scan_interval)
 
-    print("▶️ Start processing video...")
-    poses, individual_markers, sync_target_signal = estimator.process_video()
-    print("✅ Finished processing video")
+    return study_config, estimator, episodes
 
-    for p in poses:
-        out_path = working_dir / f'{naming.plane_pose_prefix}{p}.tsv'
-        print(f"💾 Writing plane poses for '{p}' to {out_path}")
-        gt_plane.write_list_to_file(poses[p], out_path, skip_failed=True)
-
-    for i in individual_markers:
-        out_path = working_dir / f'{naming.marker_pose_prefix}{i}.tsv'
-        print(f"💾 Writing marker poses for ID {i} to {out_path}")
-        gt_marker.write_list_to_file(individual_markers[i], out_path, skip_failed=False)
-
-    if sync_target_signal:
-        df = pd.DataFrame(sync_target_signal['sync'], columns=['frame_idx', 'target_x', 'target_y'])
-        target_path = working_dir / naming.target_sync_file
-        print(f"💾 Writing sync target signal to {target_path}")
-        df.to_csv(target_path, sep='\t', index=False, na_rep='nan', float_format="%.8f")
-
-    # session.update_action_states(working_dir, process.Action.DETECT_MARKERS, process.State.Completed, study_config)
-    
-
-
-
-
-    print("✅ Updated session state to Completed")
 
+def _get_segments(estimator: aruco.PoseEstimator, n_segments: int) -> list[list[int]]|None:
+    # determine the frames the estimator will process, and split them up into segments starting at a
+    # keyframe. Returns None if the video cannot be split up
+    frame_info = video_segments.get_frame_info(estimator.video.file)
+    if frame_info is None or frame_info[0].size!=estimator.video.nframes:
+        print("⚠️ Keyframes of video could not be determined, processing video in one go")
+        return None
 
+    last_frame = estimator.video.nframes-1
+    ivals = list(estimator.plane_proc_intervals.values())+list(estimator.extra_proc_intervals.values())
+    if estimator.proc_individual_markers_all_frames or not ivals or any(iv is None for iv in ivals):
+        first, last = 0, last_frame
+    else:
+        frames = [f for iv in ivals for f in np.array(iv, dtype=int).flatten()]
+        if not frames:
+            return None     # nothing to process, no need for splitting up
+        first, last = max(min(frames),0), min(max(frames),last_frame)
+
+    segments = video_segments.split(first, last, frame_info[1], n_segments)
+    return segments if len(segments)>1 else None
+
+def _process_segments(working_dir: pathlib.Path, config_dir: pathlib.Path, segments: list[list[int]], **study_settings) -> tuple[dict[str, list[gt_plane.Pose]], dict[int, list[gt_marker.Pose]], dict[str, list[list[int, Any]]], pd.DataFrame, pd.DataFrame]:
+    # each segment is processed in its own process, with its own video reader and estimator. Marker
+    # detection and pose estimation are done for each frame independently, so the concatenated
+    # segment results are the same as the result of processing the video in one go
+    with concurrent.futures.ProcessPoolExecutor(len(segments), mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(_process_segment, working_dir, config_dir, s, **study_settings) for s in segments]
+        results = [f.result() for f in futures]
+
+    poses_out, individual_markers_out, extra_processing_out, _, _ = results[0]
+    for poses, individual_markers, extra_processing, _, _ in results[1:]:
+        for p in poses:
+            poses_out[p].extend(poses[p])
+        for i in individual_markers:
+            individual_markers_out[i].extend(individual_markers[i])
+        for e in extra_processing:
+            extra_processing_out[e].extend(extra_processing[e])
+    detection_stats = pd.concat([r[3] for r in results], ignore_index=True)
+    pyramid_stats   = pd.concat([r[4] for r in results], ignore_index=True)
+    return poses_out, individual_markers_out, extra_processing_out, detection_stats, pyramid_stats
+
+def _process_segment(working_dir: pathlib.Path, config_dir: pathlib.Path, segment: list[int], **study_settings) -> tuple[dict[str, list[gt_plane.Pose]], dict[int, list[gt_marker.Pose]], dict[str, list[list[int, Any]]], pd.DataFrame, pd.DataFrame]:
+    # equivalent of estimator.process_video(), for frames segment[0] up to and including segment[1]
+    _, estimator, _ = _setup_estimator(working_dir, config_dir, verbose=False, **study_settings)
+    if segment[0]>0:
+        frame_pts, _ = video_segments.get_frame_info(estimator.video.file)
+        if (reader:=video_segments.open_at_keyframe(estimator.video.file, estimator.video.ts, segment[0], frame_pts)) is not None:
+            estimator.video = reader
+        else:
+            # seeking failed, spool to the start of the segment
+            estimator.video.read_frame(wanted_frame_idx=segment[0]-1)
+
+    poses_out               : dict[str, list[gt_plane.Pose]]    = {p:[] for p in estimator.planes}
+    individual_markers_out  : dict[int, list[gt_marker.Pose]]   = {i:[] for i in estimator.individual_markers}
+    extra_processing_out    : dict[str, list[list[int, Any]]]   = {e:[] for e in estimator.extra_proc_functions}
+    status, pose, individual_marker, extra_proc, (_, frame_idx, _) = estimator.process_one_frame(segment[0])
+    while status!=aruco.Status.Finished and frame_idx<=segment[1]:
+        if status==aruco.Status.Ok:
+            for p in pose:
+                poses_out[p].append(pose[p])
+            for i in individual_marker:
+                individual_markers_out[i].append(individual_marker[i])
+            for e in extra_proc:
+                extra_processing_out[e].append(extra_proc[e])
+        if frame_idx==segment[1]:
+            break   # don't decode and process the first frame of the next segment
+        status, pose, individual_marker, extra_proc, (_, frame_idx, _) = estimator.process_one_frame()
+
+    return poses_out, individual_markers_out, extra_processing_out, marker_detection.get_stats(marker_detection.get_trackers(estimator)), marker_detection.get_stats(marker_detection.get_pyramid_detectors(estimator))
 
 
 def _get_sync_function(study_config: config.Study,
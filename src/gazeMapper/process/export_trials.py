@@ -3,11 +3,10 @@ import shutil
 import numpy as np
 import pandas as pd
 import polars as pl
-from collections import defaultdict
 
 from glassesTools import annotation, gaze_worldref, naming as gt_naming
 
-from .. import config, episode, marker, naming, process, session
+from .. import config, data_files, episode, marker, naming, process, session
 
 
 def run(working_dir: str|pathlib.Path, export_path: str|pathlib.Path, to_export: list[str], config_dir: str|pathlib.Path = None, **study_settings):
@@ -54,18 +53,17 @@ def export_plane_gaze(export_path: pathlib.Path, working_dir: pathlib.Path, stud
             raise RuntimeError(f'No {annotation.Event.Trial.value} episodes found in the coding file, nothing to export')
         episodes = episodes[annotation.Event.Trial]
 
-        # get all gaze data
-        plane_gazes = {p:pd.read_csv(working_dir / r / f'{naming.world_gaze_prefix}{p}.tsv',sep='\t', dtype=defaultdict(lambda: float, **gaze_worldref.Gaze._non_float)) for p in planes}
-
-        # throw away unwanted columns
-        if not study_config.export_output3D:
-            for p in plane_gazes:
-                # throw away all columns starting with gazePosCam or gazeOriCam
-                plane_gazes[p] = plane_gazes[p].drop(columns=[c for c in plane_gazes[p].columns if c.startswith('gazePosCam') or c.startswith('gazeOriCam')])
-        if not study_config.export_output2D:
-            for p in plane_gazes:
-                # throw away all columns starting with gazePosPlane2D
-                plane_gazes[p] = plane_gazes[p].drop(columns=[c for c in plane_gazes[p].columns if c.startswith('gazePosPlane2D')])
+        # get all gaze data, reading only the wanted columns
+        def _is_wanted(c: str) -> bool:
+            if not study_config.export_output3D and (c.startswith('gazePosCam') or c.startswith('gazeOriCam')):
+                return False
+            if not study_config.export_output2D and c.startswith('gazePosPlane2D'):
+                return False
+            return True
+        plane_gazes: dict[str, pd.DataFrame] = {}
+        for p in planes:
+            gaze_file = data_files.find_plane_gaze_file(working_dir / r, p) or data_files.get_file_path(working_dir / r, f'{naming.world_gaze_prefix}{p}')
+            plane_gazes[p] = data_files.read_columns(gaze_file, [c for c in data_files.get_columns(gaze_file) if _is_wanted(c)], gaze_worldref.Gaze._non_float)
 
         # rename putting plane name in there so that names are unique
         for p in plane_gazes:
@@ -79,7 +77,8 @@ def export_plane_gaze(export_path: pathlib.Path, working_dir: pathlib.Path, stud
 
         # if there are individual markers, add them
         # load
-        markers = {m.id: marker.load_file(m.id, working_dir / r) for m in study_config.individual_markers}
+        # NB: when only coding presence, all that is needed is which frames are in the file
+        markers = {m.id: marker.load_file(m.id, working_dir / r, ['frame_idx'] if study_config.export_only_code_marker_presence else None) for m in study_config.individual_markers}
         # recode to presence/absence if wanted
         if study_config.export_only_code_marker_presence:
             markers = marker.code_marker_for_presence(markers, allow_failed=True)
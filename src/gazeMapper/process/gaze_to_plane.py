@@ -1,11 +1,13 @@
 import pathlib
+import concurrent.futures
+import numpy as np
 
-from glassesTools import annotation, gaze_headref, gaze_worldref, naming as gt_naming, ocv, plane as gt_plane, propagating_thread
+from glassesTools import annotation, naming as gt_naming, ocv, propagating_thread
 from glassesTools.gui import worldgaze as worldgaze_gui
 from glassesTools.gui.video_player import GUI
 
 
-from .. import config, episode, naming, plane, process, session, synchronization
+from .. import config, data_files, episode, gaze_projection, gaze_store, naming, plane, process, session, synchronization
 
 
 def run(working_dir: str|pathlib.Path, config_dir: str|pathlib.Path = None, show_visualization=False, show_planes=True, show_only_intervals=True, **study_settings):
@@ -104,40 +106,40 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, s
     should_load_part = not gui or show_only_intervals
 
     print("📥 Loading head gaze data...")
-    head_gazes = gaze_headref.read_dict_from_file(
+    head_gazes = gaze_store.read_head_gaze(
         working_dir / gt_naming.gaze_data_fname,
         processing_intervals if should_load_part else None,
         ts_column_suffixes=['VOR', '']
-    )[0]
+    )
 
     print("📥 Loading poses for planes...")
-    poses = {}
-    for p in mapping_setup:
-        pose_path = working_dir / f'{naming.plane_pose_prefix}{p}.tsv'
-        print(f"🔹 Loading poses from {pose_path}")
-        poses[p] = gt_plane.read_dict_from_file(
-            pose_path,
-            mapping_setup[p] if should_load_part else None
-        )
+    # NB: the pose files of the planes are read concurrently
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        pose_futures = {p: executor.submit(data_files.read_plane_poses, working_dir, p, mapping_setup[p] if should_load_part else None) for p in mapping_setup}
+        poses = {p: pose_futures[p].result() for p in pose_futures}
 
     camera_params = ocv.CameraParams.read_from_file(working_dir / gt_naming.scene_camera_calibration_fname)
 
-    plane_gazes: dict[str, dict[int, list[gaze_worldref.Gaze]]] = {}
-    for p in planes:
-        print(f"🚀 Mapping gaze to plane: {p}")
-        plane_gazes[p] = gaze_worldref.from_head(poses[p], head_gazes, camera_params)
-
-        # 🔍 DEBUGGING: Check hoeveel gaze entries er zijn
-        n_gaze = sum(len(g) for g in plane_gazes[p].values())
-        print(f"🔢 Aantal gaze punten voor '{p}': {n_gaze}")
-        if n_gaze == 0:
-            print(f"⚠️ Geen gaze punten gevonden voor plane '{p}', bestand wordt niet geschreven.")
-            continue
-
-        output_path = working_dir / f'{naming.world_gaze_prefix}{p}.tsv'
-        print(f"💾 Writing to: {output_path}")
-        gaze_worldref.write_dict_to_file(plane_gazes[p], output_path, skip_missing=True)
-        print(f"✅ Bestand geschreven? {output_path.exists()} --> {output_path}")
+    # map gaze to all planes in one pass over the gaze data
+    print(f"🚀 Mapping gaze to planes: {list(planes)}")
+    plane_gazes: dict[str, dict[str, np.ndarray]] = gaze_projection.from_head_multi({p:poses[p] for p in planes}, head_gazes, camera_params)
+
+    # and write the per-plane files concurrently
+    def _write(p: str):
+        return data_files.write_dataframe(gaze_projection.to_dataframe(plane_gazes[p], skip_missing=True), working_dir, f'{naming.world_gaze_prefix}{p}', study_config.data_file_format)
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        write_futures: dict[str, concurrent.futures.Future] = {}
+        for p in planes:
+            # 🔍 DEBUGGING: Check hoeveel gaze entries er zijn
+            n_gaze = plane_gazes[p]['frame_idx'].size
+            print(f"🔢 Aantal gaze punten voor '{p}': {n_gaze}")
+            if n_gaze == 0:
+                print(f"⚠️ Geen gaze punten gevonden voor plane '{p}', bestand wordt niet geschreven.")
+                continue
+            write_futures[p] = executor.submit(_write, p)
+        for p in write_futures:
+            output_path = write_futures[p].result()
+            print(f"✅ Bestand geschreven? {output_path.exists()} --> {output_path}")
 
     
 
@@ -153,7 +155,7 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, s
     worldgaze_gui.show_visualization(
         in_video, working_dir / gt_naming.frame_timestamps_fname,
         working_dir / gt_naming.scene_camera_calibration_fname,
-        planes, poses, head_gazes, plane_gazes,
+        planes, poses, head_gazes, {p:gaze_projection.to_gaze_dict(plane_gazes[p]) for p in plane_gazes},
         {e: episodes[e] for e in episodes_to_proc if e in episodes},
         gui, show_planes, show_only_intervals, 8
     )
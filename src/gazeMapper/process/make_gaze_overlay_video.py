@@ -36,18 +36,11 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
     # get settings for the study
     study_config = config.read_study_config_with_overrides(config_dir, {config.OverrideLevel.Session: working_dir.parent, config.OverrideLevel.Recording: working_dir}, **study_settings)
 
-    # get info about recording
-    rec_def = study_config.session_def.get_recording_def(working_dir.name)
-    if rec_def.type!=session.RecordingType.Eye_Tracker:
-        raise ValueError(f'You can only run gaze_overlay_video on eye tracker recordings, not on a {str(rec_def.type).split(".")[1]} recording')
-    in_video = session.read_recording_info(working_dir, rec_def.type)[1]
-    video_ts = timestamps.VideoTimestamps(working_dir / gt_naming.frame_timestamps_fname)
-
     # set up gaze overlay video maker and run it
-    video_maker = gaze_overlay_video.VideoMaker(working_dir, in_video, video_ts, working_dir / gt_naming.gaze_data_fname)
+    video_maker = _get_video_maker(working_dir, study_config)
     video_maker.attach_gui(gui)
     if gui is not None:
-        gui.set_show_timeline(True, video_ts, window_id=gui.main_window_id)
+        gui.set_show_timeline(True, video_maker.video_ts, window_id=gui.main_window_id)
 
     # update state: set to not run so that if we crash or cancel below the task is correctly marked as not run (video files are corrupt)
     session.update_action_states(working_dir, process.Action.MAKE_GAZE_OVERLAY_VIDEO, process.State.Not_Run, study_config)
@@ -57,3 +50,14 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
 
     # update state
     session.update_action_states(working_dir, process.Action.MAKE_GAZE_OVERLAY_VIDEO, process.State.Completed, study_config)
+
+
+def _get_video_maker(working_dir: pathlib.Path, study_config: config.Study) -> gaze_overlay_video.VideoMaker:
+    # get info about recording
+    rec_def = study_config.session_def.get_recording_def(working_dir.name)
+    if rec_def.type!=session.RecordingType.Eye_Tracker:
+        raise ValueError(f'You can only run gaze_overlay_video on eye tracker recordings, not on a {str(rec_def.type).split(".")[1]} recording')
+    in_video = session.read_recording_info(working_dir, rec_def.type)[1]
+    video_ts = timestamps.VideoTimestamps(working_dir / gt_naming.frame_timestamps_fname)
+
+    return gaze_overlay_video.VideoMaker(working_dir, in_video, video_ts, working_dir / gt_naming.gaze_data_fname)
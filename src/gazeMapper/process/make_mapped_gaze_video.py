@@ -5,19 +5,14 @@ import math
 import cv2
 import numpy as np
 import copy
-import subprocess
 import pandas as pd
 
-from glassesTools import annotation, aruco, drawing, intervals, gaze_headref, gaze_worldref, naming as gt_naming, ocv, plane, propagating_thread, timestamps, transforms, utils
+from glassesTools import annotation, aruco, drawing, intervals, gaze_worldref, naming as gt_naming, ocv, plane, propagating_thread, timestamps, transforms, utils
 from glassesTools.gui.video_player import GUI
 
-from .. import config, episode, marker, naming, process, session, synchronization
+from .. import config, data_files, episode, frame_pipeline, gaze_projection, gaze_store, marker, marker_detection, naming, process, session, synchronization, video_writer
 from .detect_markers import _get_plane_setup, _get_sync_function
 
-from ffpyplayer.writer import MediaWriter
-from ffpyplayer.pic import Image
-import ffpyplayer.tools
-from fractions import Fraction
 
 
 def run(working_dir: str|pathlib.Path, config_dir: str|pathlib.Path = None, show_visualization=False, **study_settings):
@@ -66,21 +61,19 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
         print("🔍 Eerste rijen uit merged TSV:")
         print(merged_df.head(10))
 
-        # Maak dictionary met timestamp -> afstand
-        distances_by_time = {
-            round(row["timestamp_VOR_a"], 3): f"{row['gaze_distance_mm']:.1f} mm"
-            for _, row in merged_df.iterrows()
-            if not pd.isna(row["timestamp_VOR_a"]) and not pd.isna(row["gaze_distance_mm"])
-        }
+        # afstanden op volgorde van tijd, zodat per frame met een binary search gezocht kan worden
+        # NB: bij dubbele timestamps (na afronden) telt de laatste rij
+        valid = merged_df[["timestamp_VOR_a", "gaze_distance_mm"]].dropna()
+        valid = valid.assign(timestamp_VOR_a=valid["timestamp_VOR_a"].round(3)).drop_duplicates("timestamp_VOR_a", keep="last").sort_values("timestamp_VOR_a")
+        distance_ts   = valid["timestamp_VOR_a"].to_numpy()
+        distance_vals = valid["gaze_distance_mm"].to_numpy()
     else:
         print(f"⚠️ Merged distance file niet gevonden op pad: {merged_tsv_path}")
-        distances_by_time = {}
+        distance_ts, distance_vals = np.zeros(0), np.zeros(0)
 
-    # DEBUG: Laat de eerste keys in de afstandsdata zien
+    # DEBUG: Laat de eerste timestamps in de afstandsdata zien
     print("🔍 Eerste 10 timestamps met afstand uit merged TSV:")
-    print(distances_by_time.keys())
-    print("🔍 Eerste 10 frame timestamps in video:")
-    
+    print(distance_ts[:10])
 
 
 
@@ -89,7 +82,7 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
     episodes_as_ref : dict[str, dict[annotation.Event, list[list[int]]]]            = {}
     episodes_seq_nrs: dict[str, dict[annotation.Event, list[str]]]                  = {}
     episode_colors  : dict[str, dict[annotation.Event, tuple[float, float, float]]] = {}
-    gazes_head      : dict[str, dict[int, list[gaze_headref.Gaze]]]                 = {}
+    gazes_head      : dict[str, gaze_store.HeadGazeStore]                           = {}
     in_videos       : dict[str, pathlib.Path]                                       = {}
     camera_params   : dict[str, ocv.CameraParams]                                   = {}
     videos_ts       : dict[str, timestamps.VideoTimestamps]                         = {}
@@ -112,10 +105,10 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
         # Read gaze data
         if rec_def.type==session.RecordingType.Eye_Tracker:
             # NB: we want to use synced gaze data for these videos, if available
-            gazes_head[rec]     = gaze_headref.read_dict_from_file(rec_working_dir / gt_naming.gaze_data_fname, ts_column_suffixes=['ref', 'VOR', ''])[0]
+            gazes_head[rec]     = gaze_store.read_head_gaze(rec_working_dir / gt_naming.gaze_data_fname, ts_column_suffixes=['ref', 'VOR', ''])
             # check we have timestamps synced to ref, if relevant
             if study_config.sync_ref_recording and rec!=study_config.sync_ref_recording:
-                if gazes_head[rec][next(iter(gazes_head[rec]))][0].timestamp_ref is None:
+                if not gazes_head[rec].has_column('timestamp_ref'):
                     raise ValueError(f'This study has a reference recording ({study_config.sync_ref_recording}) to synchronize the recordings to, but the gaze data for this recording ({rec}) has not been synchronized. Run sync_to_ref before running this.')
 
         # get camera calibration info
@@ -127,26 +120,24 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
     
     # get frame sync info, and recording's episodes expressed in the reference video's frame indices
     if study_config.sync_ref_recording:
-        sync = synchronization.get_sync_for_recs(working_dir, [r for r in recs if r!=study_config.sync_ref_recording], study_config.sync_ref_recording, study_config.sync_ref_do_time_stretch, study_config.sync_ref_average_recordings)
+        sync = synchronization.get_sync_model(working_dir, [r for r in recs if r!=study_config.sync_ref_recording], study_config.sync_ref_recording, study_config.sync_ref_do_time_stretch, study_config.sync_ref_average_recordings)
         ref_frame_idxs: dict[str, list[int]] = {}
         episodes_as_ref[study_config.sync_ref_recording] = copy.deepcopy(episodes[study_config.sync_ref_recording])
-        for r in sync.index.get_level_values('recording').unique():
+        # frame mapping between each recording and the reference recording, computed once and then
+        # used for all frame and episode lookups
+        frame_maps: dict[str, synchronization.FrameMapping] = {}
+        for r in sync.recs:
+            frame_maps[r] = sync.get_frame_mapping(r, videos_ts[r].timestamps, videos_ts[study_config.sync_ref_recording].timestamps,
+                                                   study_config.sync_ref_stretch_which, working_dir / r / naming.frame_mapping_file)
             # for each frame in the reference video, get the corresponding frame in this recording
-            ref_frame_idxs[r] = synchronization.reference_frames_to_video(r, sync, videos_ts[study_config.sync_ref_recording].indices,
-                                                                              videos_ts[r].timestamps, videos_ts[study_config.sync_ref_recording].timestamps,
-                                                                              study_config.sync_ref_do_time_stretch, study_config.sync_ref_stretch_which)
+            ref_frame_idxs[r] = frame_maps[r].reference_frames_to_video(videos_ts[study_config.sync_ref_recording].indices)
             ref_frame_idxs[r] = synchronization.smooth_video_frames_indices(ref_frame_idxs[r])
             # make sure episodes has a trial annotation, which comes from the reference recording
-            episodes[r][annotation.Event.Trial] = synchronization.reference_frames_to_video(r, sync, episodes[study_config.sync_ref_recording][annotation.Event.Trial],
-                                                                                            videos_ts[r].timestamps, videos_ts[study_config.sync_ref_recording].timestamps,
-                                                                                            study_config.sync_ref_do_time_stretch, study_config.sync_ref_stretch_which)
+            episodes[r][annotation.Event.Trial] = frame_maps[r].reference_frames_to_video(episodes[study_config.sync_ref_recording][annotation.Event.Trial])
             episodes_seq_nrs[r][annotation.Event.Trial] = episodes_seq_nrs[study_config.sync_ref_recording][annotation.Event.Trial]
             episode_colors[r] = {k:c for k,c in zip(episodes[r], colors)}
             # also get this recording's coded events in the reference's frames idxs
-            episodes_as_ref[r] = {e: synchronization.video_frames_to_reference(r, sync, episodes[r][e],
-                                                                        videos_ts[r].timestamps, videos_ts[study_config.sync_ref_recording].timestamps,
-                                                                        study_config.sync_ref_do_time_stretch, study_config.sync_ref_stretch_which)
-                           for e in episodes[r]}
+            episodes_as_ref[r] = {e: frame_maps[r].video_frames_to_reference(episodes[r][e]) for e in episodes[r]}
 
         if study_config.video_process_annotations_for_all_recordings:
             # go through all planes for all episodes and apply them to all recordings
@@ -162,9 +153,7 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
                                 eps = inp
                             else:
                                 inp = [[max(0,ep[0]), min(ep[1],videos_ts[study_config.sync_ref_recording].indices[-1])] if not all([x==-1 for x in ep]) else ep for ep in episodes_as_ref[rec][e]]
-                                eps = synchronization.reference_frames_to_video(r, sync, inp,
-                                                                                videos_ts[r].timestamps, videos_ts[study_config.sync_ref_recording].timestamps,
-                                                                                study_config.sync_ref_do_time_stretch, study_config.sync_ref_stretch_which)
+                                eps = frame_maps[r].reference_frames_to_video(inp)
                             # insert, but skip if:
                             # 1. ref episode or resulting are equal to [-1 -1]
                             # 2. episode is already in the set (one frame leeway for round trip errors)
@@ -190,7 +179,7 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
 
 
         # fix episodes with start or end points outside the reference video
-        for r in sync.index.get_level_values('recording').unique():
+        for r in sync.recs:
             for e in episodes_as_ref[r]:
                 new_iv = []
                 for i,iv in reversed(list(enumerate(episodes_as_ref[r][e]))):
@@ -214,7 +203,7 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
 
     if study_config.sync_ref_recording:
         # check that all camera sync point frames of a recording are in the reference recordings sync frames (a recording may miss some, but the ones it has must be equal)
-        for r in sync.index.get_level_values('recording').unique():
+        for r in sync.recs:
             ref_sync_points = episodes_as_ref_flat[study_config.sync_ref_recording][annotation.Event.Sync_Camera]
             rec_sync_points = episodes_as_ref_flat[r][annotation.Event.Sync_Camera]
             # NB: allow one frame leeway to allow for small offsets due to conversion, or cameras not running completely in sync
@@ -226,37 +215,66 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
             for r in to_load:
                 all_poses[r] = {}
                 for p in plane_names:
-                    all_poses[r][p] = plane.read_dict_from_file(working_dir/r/f'{naming.plane_pose_prefix}{p}.tsv')
+                    all_poses[r][p] = data_files.read_plane_poses(working_dir/r, p)
+
+    # render only: if no marker detection is needed for the video, read the poses stored by
+    # DETECT_MARKERS instead of detecting the markers again
+    render_only = study_config.video_render_only
+    if render_only and (study_config.video_process_planes_for_all_frames or study_config.video_process_individual_markers_for_all_frames or study_config.video_show_detected_markers or study_config.video_show_rejected_markers):
+        print('⚠️ Render only mode not used: it requires that video_process_planes_for_all_frames, video_process_individual_markers_for_all_frames, video_show_detected_markers and video_show_rejected_markers are all disabled')
+        render_only = False
 
     # build pose estimator
     for rec in recs:
         if rec not in study_config.video_make_which and not (study_config.video_process_planes_for_all_frames or study_config.video_process_individual_markers_for_all_frames):
             continue
         in_videos[rec] = session.get_video_path(session_info.recordings[rec].info)     # get video file to process
-        pose_estimators[rec] = aruco.PoseEstimator(in_videos[rec], videos_ts[rec], camera_params[rec])
-        pose_estimators[rec].set_allow_early_exit(False)    # make sure we run through the whole video
-        planes_setup, analyze_frames = _get_plane_setup(study_config, config_dir, episodes[rec], want_analyze_frames=True)
-        for p in planes_setup:
-            planes[p] = planes_setup[p]['plane']
-            pose_estimators[rec].add_plane(p, planes_setup[p], None if study_config.video_process_planes_for_all_frames else analyze_frames[p])
-        for i in (markers:=marker.get_marker_dict_from_list(study_config.individual_markers)):
-            pose_estimators[rec].add_individual_marker(i, markers[i])
-        sync_target_function = _get_sync_function(study_config, session_info.recordings[rec].definition, None if annotation.Event.Sync_ET_Data not in episodes[rec] else episodes[rec][annotation.Event.Sync_ET_Data])
-        if sync_target_function is not None:
-            pose_estimators[rec].register_extra_processing_fun('sync', *sync_target_function)
-        if study_config.sync_ref_recording and rec!=study_config.sync_ref_recording:
-            pose_estimators[rec].set_do_report_frames(False)
-
-        if rec in study_config.video_make_which:
+        if render_only and session_info.recordings[rec].state[process.Action.DETECT_MARKERS]==process.State.Completed:
+            planes_setup, _ = _get_plane_setup(study_config, config_dir, episodes[rec])
+            for p in planes_setup:
+                planes[p] = planes_setup[p]['plane']
+            # NB: no file is written for a plane if there are no successful poses for it
+            poses = {p: (data_files.read_plane_poses(working_dir/rec, p) if data_files.find_plane_pose_file(working_dir/rec, p) else {}) for p in planes_setup}
+            video = frame_pipeline.CachedReader(ocv.CV2VideoReader(in_videos[rec], videos_ts[rec].timestamps), study_config.video_frame_cache_size, study_config.video_prefetch_frames)
+            pose_estimators[rec] = frame_pipeline.StoredPoseEstimator(video, poses, camera_params[rec], {p: planes[p].marker_size/2 for p in planes_setup})
+            if study_config.sync_ref_recording and rec!=study_config.sync_ref_recording:
+                pose_estimators[rec].set_do_report_frames(False)
+            # NB: in render only mode, we only get here for recordings for which a video is made
             pose_estimators[rec].set_visualize_on_frame(True)
-            pose_estimators[rec].sub_pixel_fac                      = sub_pixel_fac
-            pose_estimators[rec].show_detected_markers              = study_config.video_show_detected_markers
-            pose_estimators[rec].show_plane_axes                    = study_config.video_show_plane_axes
-            pose_estimators[rec].proc_individual_markers_all_frames = study_config.video_process_individual_markers_for_all_frames
-            pose_estimators[rec].show_individual_marker_axes        = study_config.video_show_individual_marker_axes
-            pose_estimators[rec].show_sync_func_output              = study_config.video_show_sync_func_output
-            pose_estimators[rec].show_unexpected_markers            = study_config.video_show_unexpected_markers
-            pose_estimators[rec].show_rejected_markers              = study_config.video_show_rejected_markers
+            pose_estimators[rec].sub_pixel_fac      = sub_pixel_fac
+            pose_estimators[rec].show_plane_axes    = study_config.video_show_plane_axes
+        else:
+            if render_only:
+                print(f'⚠️ Detect markers has not been run for recording {rec}, detecting markers while making the video')
+            pose_estimators[rec] = aruco.PoseEstimator(in_videos[rec], videos_ts[rec], camera_params[rec])
+            pose_estimators[rec].set_allow_early_exit(False)    # make sure we run through the whole video
+            # frames of the other videos may be requested repeatedly and out of order, keep recently
+            # decoded frames around and decode ahead
+            pose_estimators[rec].video = frame_pipeline.CachedReader(pose_estimators[rec].video, study_config.video_frame_cache_size, study_config.video_prefetch_frames)
+            planes_setup, analyze_frames = _get_plane_setup(study_config, config_dir, episodes[rec], want_analyze_frames=True)
+            for p in planes_setup:
+                planes[p] = planes_setup[p]['plane']
+                pose_estimators[rec].add_plane(p, planes_setup[p], None if study_config.video_process_planes_for_all_frames else analyze_frames[p])
+            for i in (markers:=marker.get_marker_dict_from_list(study_config.individual_markers)):
+                pose_estimators[rec].add_individual_marker(i, markers[i])
+            sync_target_function = _get_sync_function(study_config, session_info.recordings[rec].definition, None if annotation.Event.Sync_ET_Data not in episodes[rec] else episodes[rec][annotation.Event.Sync_ET_Data])
+            if sync_target_function is not None:
+                pose_estimators[rec].register_extra_processing_fun('sync', *sync_target_function)
+            if study_config.detect_markers_use_pyramid:
+                marker_detection.attach_pyramid(pose_estimators[rec], study_config.detect_markers_pyramid_max_distance)
+            if study_config.sync_ref_recording and rec!=study_config.sync_ref_recording:
+                pose_estimators[rec].set_do_report_frames(False)
+
+            if rec in study_config.video_make_which:
+                pose_estimators[rec].set_visualize_on_frame(True)
+                pose_estimators[rec].sub_pixel_fac                      = sub_pixel_fac
+                pose_estimators[rec].show_detected_markers              = study_config.video_show_detected_markers
+                pose_estimators[rec].show_plane_axes                    = study_config.video_show_plane_axes
+                pose_estimators[rec].proc_individual_markers_all_frames = study_config.video_process_individual_markers_for_all_frames
+                pose_estimators[rec].show_individual_marker_axes        = study_config.video_show_individual_marker_axes
+                pose_estimators[rec].show_sync_func_output              = study_config.video_show_sync_func_output
+                pose_estimators[rec].show_unexpected_markers            = study_config.video_show_unexpected_markers
+                pose_estimators[rec].show_rejected_markers              = study_config.video_show_rejected_markers
 
         if rec in study_config.video_make_which or rec==study_config.sync_ref_recording:
             # get video file info
@@ -279,7 +297,7 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
         if should_exit:
             break
 
-        vid_writer          : dict[str, MediaWriter]                = {}
+        vid_writer          : dict[str, video_writer.ThreadedWriter]= {}
         frame               : dict[str, np.ndarray]                 = {}
         frame_idx           : dict[str, int]                        = {}
         frame_ts            : dict[str, float]                      = {}
@@ -311,15 +329,35 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
                 gui.set_show_play_percentage(True, gui_window_ids[v])
                 gui.set_show_action_tooltip(True, gui_window_ids[v])
 
+        # frame intervals of the lead video to render, if only selected episodes are to be rendered
+        # (None: the whole video). NB: audio is only added when rendering the whole video
+        render_intervals = None
+        if study_config.video_render_episodes:
+            render_intervals = _get_render_intervals(episodes_as_ref[lead_vid], study_config.video_render_episodes,
+                                                     study_config.video_render_episode_margin_before, study_config.video_render_episode_margin_after,
+                                                     vid_info[lead_vid][2], videos_ts[lead_vid].indices[-1])
+            if not render_intervals:
+                print(f'⚠️ No {", ".join(e.value for e in study_config.video_render_episodes)} episodes coded for recording {lead_vid}, no video made')
+                continue
+        as_clips = render_intervals is not None and study_config.video_render_episodes_as_clips
+
         # open output video files
-        for v in write_vids:
-            # get which pixel format
-            codec    = ffpyplayer.tools.get_format_codec(fmt=pathlib.Path(naming.process_video).suffix[1:])
-            pix_fmt  = ffpyplayer.tools.get_best_pix_fmt('bgr24',ffpyplayer.tools.get_supported_pixfmts(codec))
-            fpsFrac  = Fraction(vid_info[lead_vid][2]).limit_denominator(10000).as_integer_ratio()
-            # scene video
-            out_opts = {'pix_fmt_in':'bgr24', 'pix_fmt_out':pix_fmt, 'width_in':vid_info[v][0], 'height_in':vid_info[v][1], 'frame_rate':fpsFrac}
-            vid_writer[v] = MediaWriter(str(working_dir / v / naming.process_video), [out_opts], overwrite=True)
+        mux_in_pass = study_config.video_mux_audio_in_pass and render_intervals is None and shutil.which('ffmpeg') is not None
+        def open_writers(clip: int|None):
+            for v in write_vids:
+                # each video is encoded on its own thread
+                file = working_dir / v / naming.process_video
+                if clip is not None:
+                    file = file.with_stem(f'{file.stem}_{clip+1}')
+                if mux_in_pass:
+                    # ffmpeg adds the audio while writing, so no need to rewrite the file afterwards
+                    audio_source = in_videos[v] if video_writer.has_audio(in_videos[v]) else None
+                    vid_writer[v] = video_writer.FFmpegWriter(file, vid_info[v][0], vid_info[v][1], vid_info[lead_vid][2], study_config.video_encoding_profile,
+                                                              audio_source, None if v==lead_vid else _get_audio_filter(v, lead_vid, ref_frame_idxs, videos_ts))
+                else:
+                    vid_writer[v] = video_writer.ThreadedWriter(file, vid_info[v][0], vid_info[v][1], vid_info[lead_vid][2], study_config.video_encoding_profile)
+        clip = 0
+        open_writers(clip if as_clips else None)
 
         # update state: set to not run so that if we crash or cancel below the task is correctly marked as not run (video files are corrupt)
         session.update_action_states(working_dir, process.Action.MAKE_MAPPED_GAZE_VIDEO, process.State.Not_Run, study_config)
@@ -337,16 +375,32 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
         frame_idx_width |= {v: n_digit(max(ref_frame_idxs[v])) for v in other_vids}
 
         print(f"🔍 Video timestamp range: {min(videos_ts[rec_a].timestamps)} - {max(videos_ts[rec_a].timestamps)}")
-        print(f"🔍 Distance timestamp range: {min(distances_by_time.keys())} - {max(distances_by_time.keys())}")
-
-        distance_lookup = dict()
-        for _, row in merged_df.iterrows():
-            key = round(row["timestamp_a"], 3)
-            distance_lookup[key] = row["gaze_distance_mm"]
-
+        if distance_ts.size:
+            print(f"🔍 Distance timestamp range: {distance_ts[0]} - {distance_ts[-1]}")
+
+        # per frame lookup tables for the reference video, so that the render loop only has to index
+        frame_distance = _get_frame_distances(distance_ts, distance_vals, videos_ts[lead_vid])
+        frame_gazes    = {v: gazes_head[v].get_frame_averaged() for v in proc_vids if v in gazes_head}
+        frame_gaze_pos = {v: _get_frame_gaze_positions(frame_gazes[v], frame_distance.size) for v in frame_gazes}
+        # check if we need gaze on plane for drawing on any of the videos
+        plane_gaze_on_video     = set(study_config.video_show_gaze_on_plane_in_which or [])
+        plane_gaze_or_pose_on_video = plane_gaze_on_video | set(study_config.video_show_gaze_vec_in_which or []) | set(study_config.video_show_camera_in_which or [])
+        plane_gaze_needed = {v: v in plane_gaze_on_video or any(vo!=v for vo in plane_gaze_or_pose_on_video) for v in frame_gazes}
+        # for recordings whose poses are known before rendering, project gaze to the planes for all frames at once
+        known_poses = {v: _get_poses_as_ref(all_poses[v], ref_frame_idxs[v]) for v in all_poses}
+        known_poses |= {v: (e.poses if v==lead_vid else _get_poses_as_ref(e.poses, ref_frame_idxs[v])) for v,e in pose_estimators.items()
+                        if isinstance(e, frame_pipeline.StoredPoseEstimator) and (v==lead_vid or study_config.sync_ref_recording)}
+        frame_plane_gazes = {v: gaze_projection.FramePlaneGazes(known_poses[v], frame_gazes[v], camera_params[v], planes, study_config.video_gaze_to_plane_margin)
+                             for v in frame_gazes if v in known_poses and plane_gaze_needed[v]}
+
+        # when rendering episodes, seek to the start of each, and number output frames from the start
+        # of the clip
+        wanted_frame_idx = None if render_intervals is None else render_intervals[0][0]
+        out_frame_idx = 0
         while True:
             status, pose[lead_vid], _, _, (frame[lead_vid], frame_idx[lead_vid], frame_ts[lead_vid]) = \
-                pose_estimators[lead_vid].process_one_frame()
+                pose_estimators[lead_vid].process_one_frame(wanted_frame_idx)
+            wanted_frame_idx = None
             # TODO: if there is a discontinuity, fill in the missing frames so audio stays in sync
             # check if we're done
             if status==aruco.Status.Finished:
@@ -365,8 +419,13 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
                         None, None, None, None, (None, None, None)
                 else:
                     # read it
+                    prev_frame = frame.get(v, None)
                     _, pose[v], _, _, (frame[v], frame_idx[v], frame_ts[v]) = \
                         pose_estimators[v].process_one_frame(fr_idx_this)
+                    # for a repeated frame, the estimator returns the same image as last time, which
+                    # has been submitted for encoding and must thus not be drawn on
+                    if frame[v] is not None and frame[v] is prev_frame:
+                        frame[v] = frame[v].copy()
 
             for v in write_vids:
                 if frame[v] is None:
@@ -374,78 +433,56 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
                     frame[v] = np.zeros((vid_info[v][1],vid_info[v][0],3), np.uint8)   # black image
 
             for v in proc_vids:
-                if v in gazes_head and frame_idx[lead_vid] in gazes_head[v]:
+                if v in frame_gazes and frame_idx[lead_vid] in frame_gazes[v]:
                     clr = study_config.video_recording_colors[v][::-1]  # RGB -> BGR
-                    gaze_list = gazes_head[v][frame_idx[lead_vid]]
-
-                    if gaze_list:
-                        # Bereken gemiddelde van geldige gaze_pos_vid punten
-                        valid_gazes = [g for g in gaze_list if g.gaze_pos_vid is not None]
-                        xs = [g.gaze_pos_vid[0] for g in valid_gazes]
-                        ys = [g.gaze_pos_vid[1] for g in valid_gazes]
-
-                        if xs and ys:
-                            avg_x = sum(xs) / len(xs)
-                            avg_y = sum(ys) / len(ys)
-
-                            # Maak een nieuwe Gaze-kopie of hergebruik eerste object
-                            g = valid_gazes[0]
-                            g.gaze_pos_vid = [avg_x, avg_y]
-
-                            if v in all_vids:
-                                # Teken alleen de gemiddelde gaze
-                                g.draw(frame[v], sub_pixel_fac=sub_pixel_fac, clr=clr, draw_3d_gaze_point=False)
 
+                    if v in all_vids:
+                        # Teken alleen de gemiddelde gaze
+                        drawing.openCVCircle(frame[v], frame_gaze_pos[v][frame_idx[lead_vid]], 8, clr, 2, sub_pixel_fac)
 
+                    if not pose[v] or not plane_gaze_needed[v]:
+                        continue
 
+                    # gaze on all planes for which pose or homography is available, and the planes in
+                    # order of how close gaze is to them
+                    if v in frame_plane_gazes:
+                        plane_gazes = frame_plane_gazes[v]
+                    else:
+                        # poses only known now, project gaze of this frame
+                        plane_gazes = gaze_projection.FramePlaneGazes({pl: {frame_idx[lead_vid]: pose[v][pl]} for pl in pose[v]},
+                                                                      frame_gazes[v].select([[frame_idx[lead_vid], frame_idx[lead_vid]]]),
+                                                                      camera_params[v], planes, study_config.video_gaze_to_plane_margin)
+                    best = plane_gazes.get_plane_order(frame_idx[lead_vid])
+                    # check if gaze is not too far outside all planes
+                    if not best:
+                        continue
 
+                    # draw on current video
+                    # if v in study_config.video_show_gaze_on_plane_in_which:
+                    #     plane_gazes.get_gaze(frame_idx[lead_vid], best[0]).draw_on_world_video(frame[v], camera_params[v], sub_pixel_fac, pose[v][best[0]], study_config.video_projected_vidPos_color, study_config.video_projected_world_pos_color, study_config.video_projected_left_ray_color, study_config.video_projected_right_ray_color, study_config.video_projected_average_ray_color)
 
-                        # check if we need gaze on plane for drawing on any of the videos
-                        plane_gaze_on_this_video = not not study_config.video_show_gaze_on_plane_in_which and v in study_config.video_show_gaze_on_plane_in_which
-                        plane_gaze_or_pose_on_other_video = (not not study_config.video_show_gaze_on_plane_in_which and any((vo!=v for vo in study_config.video_show_gaze_on_plane_in_which))) or (not not study_config.video_show_gaze_vec_in_which and any((vo!=v for vo in study_config.video_show_gaze_vec_in_which))) or (not not study_config.video_show_camera_in_which and any((vo!=v for vo in study_config.video_show_camera_in_which)))
-                        if not pose[v] or not (plane_gaze_on_this_video or plane_gaze_or_pose_on_other_video):
+                    # also draw on other recordings, if so configured
+                    # depending on configuration also includes camera and gaze vector between the two
+                    for vo in write_vids-set([v]):
+                        if pose[vo] is None:
                             continue
-
-                        # collect gaze on all planes for which pose or homography is available
-                        plane_gazes: dict[str, tuple[float,float,gaze_worldref.Gaze]] = {}
-                        for pl in pose[v]:
-                            if pl in pose[v] and (pose[v][pl].pose_successful() or pose[v][pl].homography_successful()):
-                                # turn into position on board
-                                plane_gaze = gaze_worldref.from_head(pose[v][pl], g, camera_params[v])
-                                plane_gazes[pl] = (gaze_worldref.distance_from_plane(plane_gaze, planes[pl]), pose[v][pl].pose_reprojection_error if pose[v][pl].pose_successful() else np.nan, plane_gaze)
-
-                        # find the plane to which gaze is closest
-                        best = None if not plane_gazes else sorted(plane_gazes.keys(), key=lambda d: (sum(plane_gazes[d][0:2])/2 if not np.isnan(plane_gazes[d][1]) else plane_gazes[d][0]) if plane_gazes[d][0]<=study_config.video_gaze_to_plane_margin else math.inf)
-                        # check if gaze is not too far outside all planes
-                        if best is None:
+                        for pl in best:
+                            if pl in pose[vo] and (pose[vo][pl].pose_successful() or pose[vo][pl].homography_successful()):
+                                break
+                        if pl not in pose[vo] or not (pose[vo][pl].pose_successful() or pose[vo][pl].homography_successful()):
                             continue
-
-                        # draw on current video
-                        # if v in study_config.video_show_gaze_on_plane_in_which:
-                        #     plane_gazes[best[0]][2].draw_on_world_video(frame[v], camera_params[v], sub_pixel_fac, pose[v][best[0]], study_config.video_projected_vidPos_color, study_config.video_projected_world_pos_color, study_config.video_projected_left_ray_color, study_config.video_projected_right_ray_color, study_config.video_projected_average_ray_color)
-
-                        # also draw on other recordings, if so configured
-                        # depending on configuration also includes camera and gaze vector between the two
-                        for vo in write_vids-set([v]):
-                            if pose[vo] is None:
-                                continue
-                            for pl in best:
-                                if pl in pose[vo] and (pose[vo][pl].pose_successful() or pose[vo][pl].homography_successful()):
-                                    break
-                            if pl not in pose[vo] or not (pose[vo][pl].pose_successful() or pose[vo][pl].homography_successful()):
-                                continue
-                            # draw gaze point, camera position, and gaze vector between them on the other video, as configured
-                            # and as possible (camera position and gaze vector require pose, not only homography)
-                            draw_gaze_on_other_video(frame[vo],
-                                                     pose[v][pl], pose[vo][pl],
-                                                     plane_gazes[pl][2],
-                                                     camera_params[vo], clr,
-                                                     study_config.video_which_gaze_type_on_plane,
-                                                     study_config.video_which_gaze_type_on_plane_allow_fallback,
-                                                     vo in study_config.video_show_gaze_on_plane_in_which,
-                                                     vo in study_config.video_show_gaze_vec_in_which,
-                                                     vo in study_config.video_show_camera_in_which,
-                                                     sub_pixel_fac)
+                        # draw gaze point, camera position, and gaze vector between them on the other video, as configured
+                        # and as possible (camera position and gaze vector require pose, not only homography)
+                        draw_gaze_on_other_video(frame[vo],
+                                                 pose[v][pl], pose[vo][pl],
+                                                 plane_gazes.get_gaze(frame_idx[lead_vid], pl),
+                                                 camera_params[vo], clr,
+                                                 study_config.video_which_gaze_type_on_plane,
+                                                 study_config.video_which_gaze_type_on_plane_allow_fallback,
+                                                 vo in study_config.video_show_gaze_on_plane_in_which,
+                                                 vo in study_config.video_show_gaze_vec_in_which,
+                                                 vo in study_config.video_show_camera_in_which,
+                                                 sub_pixel_fac)
 
 
             # print info on frame
@@ -487,19 +524,11 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
                     x_end += x_advance
 
 
-            key = frame_ts[lead_vid]
-            tolerance = 10  # in ms
-
-            # Vind alle keys in de buurt (max ±10 ms verschil)
-            nearby_keys = [k for k in distances_by_time if abs(k - key) <= tolerance]
-
-            if nearby_keys:
-                closest_key = min(nearby_keys, key=lambda x: abs(x - key))
-                distance_text = distances_by_time[closest_key]
-                #print(f"Match gevonden voor timestamp {key:.3f} ms → dichtstbijzijnde: {closest_key:.3f} ms → afstand: {distance_text}")
+            # afstand voor dit frame (max ±10 ms verschil, vooraf opgezocht)
+            if frame_idx[lead_vid]<frame_distance.size and not np.isnan(frame_distance[frame_idx[lead_vid]]):
+                distance_text = f"{frame_distance[frame_idx[lead_vid]]:.1f} mm"
             else:
                 distance_text = "– mm"
-                #print(f"ℹ️ Geen afstand beschikbaar binnen ±{tolerance} ms voor timestamp {key:.3f} ms")
 
 
             # 📐 Voeg distance rechtsboven toe
@@ -514,8 +543,8 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
 
             # submit frame to be encoded
             for v in write_vids:
-                img = Image(plane_buffers=[frame[v].flatten().tobytes()], pix_fmt='bgr24', size=(frame[v].shape[1], frame[v].shape[0]))
-                vid_writer[v].write_frame(img=img, pts=frame_idx[lead_vid]/vid_info[lead_vid][2])
+                vid_writer[v].write_frame(frame[v], (frame_idx[lead_vid] if render_intervals is None else out_frame_idx)/vid_info[lead_vid][2])
+            out_frame_idx += 1
 
             # update gui, if any
             if has_gui:
@@ -528,27 +557,31 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
                         should_exit = True
                         break
 
+            # when rendering episodes, move on to the next one once at the end of the current one
+            if render_intervals is not None and frame_idx[lead_vid]>=render_intervals[clip][1]:
+                clip += 1
+                if clip>=len(render_intervals):
+                    break
+                wanted_frame_idx = render_intervals[clip][0]
+                if as_clips:
+                    for v in write_vids:
+                        vid_writer[v].close()
+                    open_writers(clip)
+                    out_frame_idx = 0
+
         # done with this set of videos
         for v in write_vids:
             vid_writer[v].close()
 
         # if ffmpeg is on path, add audio to scene and optionally board video
-        if shutil.which('ffmpeg') is not None:
+        if render_intervals is None and not mux_in_pass and shutil.which('ffmpeg') is not None:
             for v in write_vids:
                 rec_working_dir = working_dir / v
 
                 file = rec_working_dir / naming.process_video
 
                 # check if source file has audio
-                command = ['ffprobe',
-                    '-loglevel', 'error',
-                    '-select_streams', 'a',
-                    '-show_entries', 'stream=codec_type',
-                    '-of', 'csv=p=0',
-                    f'{in_videos[v]}']
-                proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                out, err = proc.communicate()
-                if err or out.decode().strip()!='audio':
+                if not video_writer.has_audio(in_videos[v]):
                     # file does not have audio, nothing to do, skip
                     continue
                 # move file to temp name
@@ -560,16 +593,7 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
                     cmd_str = ' '.join(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-i', f'"{tempName}"', '-i', f'"{in_videos[v]}"', '-vcodec', 'copy', '-acodec', 'copy', '-map', '0:v:0', '-map', '1:a:0?', '-shortest', f'"{file}"'])
                 else:
                     inputs = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-i', f'"{tempName}"', '-i', f'"{in_videos[v]}"']
-
-                    first_frame = ref_frame_idxs[v][0]
-                    if first_frame==-1:
-                        # video starts later, we need to delay audio when copying
-                        frame_off = np.argmax(np.array(ref_frame_idxs[v])>-1)
-                        t_off = videos_ts[lead_vid].get_timestamp(frame_off, timestamps.Type.Stretched if videos_ts[lead_vid].has_stretched else timestamps.Type.Normal)
-                        filt = f'[1:a]adelay=delays={t_off:.9f}:all=1[a];[a]apad[audio];'
-                    else:
-                        t_off = videos_ts[v].get_timestamp(first_frame)
-                        filt = f'[1:a]atrim=start={t_off/1000},asetpts=PTS-STARTPTS[a];[a]apad[audio];'
+                    filt = _get_audio_filter(v, lead_vid, ref_frame_idxs, videos_ts)
                     cmd_str = ' '.join(inputs + ['-filter_complex', f'"{filt}"', '-map', '0:v', '-map', '[audio]', '-c:v', 'copy', '-shortest', f'"{file}"'])
                 os.system(cmd_str)
 
@@ -581,12 +605,62 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
                     shutil.move(tempName, file)
 
     # done with all videos, clean up
+    for rec in pose_estimators:
+        pose_estimators[rec].video.close()
     if has_gui:
         gui.stop()
 
     # update state
     session.update_action_states(working_dir, process.Action.MAKE_MAPPED_GAZE_VIDEO, process.State.Completed, study_config)
 
+def _get_render_intervals(episodes: dict[annotation.Event, list[list[int]]], which: set[annotation.Event], margin_before: float, margin_after: float, fps: float, last_frame: int) -> list[list[int]]:
+    # frame intervals of the episodes of the given types, extended by the margins (s) and merged
+    # where they overlap or touch
+    ivals = sorted([iv[0], iv[-1]] for e in which if e in episodes for iv in episodes[e] if iv)
+    ivals = [[max(0, s-round(margin_before*fps)), min(last_frame, e+round(margin_after*fps))] for s,e in ivals]
+    merged: list[list[int]] = []
+    for iv in ivals:
+        if merged and iv[0]<=merged[-1][1]+1:
+            merged[-1][1] = max(merged[-1][1], iv[1])
+        else:
+            merged.append(iv)
+    return merged
+
+def _get_frame_distances(distance_ts: np.ndarray, distance_vals: np.ndarray, video_ts: timestamps.VideoTimestamps, tolerance: float = 10.) -> np.ndarray:
+    # for each frame of the video, the distance whose timestamp is closest to the frame's timestamp,
+    # if within tolerance (ms). NaN if there is none. distance_ts must be sorted
+    frame_ts = np.array(video_ts.timestamps, dtype=np.float64)
+    indices  = np.array(video_ts.indices, dtype=np.int64)
+    out = np.full((indices.max()+1) if indices.size else 0, np.nan)
+    if distance_ts.size and frame_ts.size:
+        idx = synchronization.nearest_timestamps(frame_ts, distance_ts, tolerance)
+        out[indices[idx>=0]] = distance_vals[idx[idx>=0]]
+    return out
+
+def _get_frame_gaze_positions(frame_gazes: gaze_store.HeadGazeStore, n_frames: int) -> np.ndarray:
+    # for each frame of the (reference) video, the (average) gaze position on the scene video. NaN for
+    # frames without gaze data. frame_gazes should have one sample per frame
+    out = np.full((max(n_frames, frame_gazes.max_frame_idx+1), 2), np.nan)
+    out[frame_gazes.frames] = frame_gazes.get_column('gaze_pos_vid')
+    return out
+
+def _get_poses_as_ref(poses: dict[str, dict[int, plane.Pose]], ref_frame_idxs: list[int]) -> dict[str, dict[int, plane.Pose]]:
+    # poses of a recording, indexed by frame of the reference video
+    return {p: {fi: poses[p][f] for fi,f in enumerate(ref_frame_idxs) if f in poses[p]} for p in poses}
+
+def _get_audio_filter(v: str, lead_vid: str, ref_frame_idxs: dict[str, list[int]], videos_ts: dict[str, timestamps.VideoTimestamps]) -> str:
+    # ffmpeg filter graph that aligns the audio of a non-lead video with the written video
+    first_frame = ref_frame_idxs[v][0]
+    if first_frame==-1:
+        # video starts later, we need to delay audio when copying
+        frame_off = np.argmax(np.array(ref_frame_idxs[v])>-1)
+        t_off = videos_ts[lead_vid].get_timestamp(frame_off, timestamps.Type.Stretched if videos_ts[lead_vid].has_stretched else timestamps.Type.Normal)
+        return f'[1:a]adelay=delays={t_off:.9f}:all=1[a];[a]apad[audio];'
+    else:
+        t_off = videos_ts[v].get_timestamp(first_frame)
+        return f'[1:a]atrim=start={t_off/1000},asetpts=PTS-STARTPTS[a];[a]apad[audio];'
+
+
 def draw_gaze_on_other_video(frame_other, pose_this: plane.Pose, pose_other: plane.Pose, plane_gaze: gaze_worldref.Gaze, camera_params_other, clr, which_gaze_on_plane, which_gaze_on_plane_allow_fallback, do_draw_gaze, do_draw_gaze_vec, do_draw_camera, sub_pixel_fac):
     if not do_draw_gaze and not do_draw_gaze_vec and not do_draw_camera:
         # nothing to do
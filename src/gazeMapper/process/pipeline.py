@@ -1,79 +1,141 @@
 import pathlib
-import time
+import threading
 from .. import config, session
 from ..process import action_to_func, Action, is_session_level_action, State
-from gazeMapper.GUI._impl.process_pool import ProcessPool
-
-
-
-def wait_until_all_done(working_dir: pathlib.Path, action: Action, only_relevant: bool = False, timeout: int = 900, study_cfg=None):
-    print(f"⏳ Wachten tot '{action.displayable_name}' voltooid is voor {'de relevante recordings' if only_relevant else 'alle recordings'}...")
-    waited = 0
-    interval = 2
-
-    while waited < timeout:
-        session_info = session.Session.from_definition(study_cfg.session_def, working_dir)
-        all_done = True
-
-        if is_session_level_action(action):
-            # ✅ Check status op sessieniveau
-            state = session_info.state.get(action, State.Not_Run)
-            if state != State.Completed:
-                all_done = False
-                print(f"  session: {state.displayable_name}")
-        else:
-            for rec_name, rec in session_info.recordings.items():
-                if only_relevant and study_cfg:
-                    if rec_name != study_cfg.sync_ref_recording:
-                        continue
-                state = rec.state.get(action, State.Not_Run)
-                if state != State.Completed:
-                    all_done = False
-                    print(f"   {rec_name}: {state.displayable_name}")
-
-        if all_done:
-            print(f"{action.displayable_name}' voltooid voor {'relevante recordings' if only_relevant else 'alle recordings'}.")
-            return
-
-        time.sleep(interval)
-        waited += interval
-
-    raise TimeoutError(f"Timeout: '{action.displayable_name}' niet voltooid na {timeout} seconden.")
-
-
-
-
-
-def _run_actions_sequentially(actions: list[Action], working_dir: pathlib.Path, study_cfg):
+from gazeMapper.GUI._impl.process_pool import ProcessPool, ProcessFuture, JobScheduler, JobPayload
+
+
+
+class _CompletionTracker:
+    # collects the action states reported through session.update_action_states() while the
+    # pipeline runs, so that we know an action finished the moment it returns, without polling
+    # the status files on disk
+    def __init__(self):
+        self.states: dict[tuple[pathlib.Path, Action], State] = {}
+
+    def __enter__(self):
+        session.register_action_state_listener(self._on_state_update)
+        return self
+
+    def __exit__(self, *_):
+        session.unregister_action_state_listener(self._on_state_update)
+
+    def _on_state_update(self, working_dir: pathlib.Path, action: Action, state: State):
+        self.states[(working_dir.resolve(), action)] = state
+
+    def reset(self, working_dir: pathlib.Path, action: Action):
+        self.states.pop((working_dir.resolve(), action), None)
+
+    def check_completed(self, working_dir: pathlib.Path, action: Action, name: str) -> State:
+        # an action that had nothing to do reports Skipped, that is a finished state too
+        state = self.states.get((working_dir.resolve(), action), None)
+        if state is None:
+            raise RuntimeError(f"'{action.displayable_name}' heeft geen status gerapporteerd voor {name}")
+        if state not in [State.Completed, State.Skipped]:
+            raise RuntimeError(f"'{action.displayable_name}' niet voltooid voor {name}: {state.displayable_name}")
+        print(f"   {name}: {state.displayable_name}")
+        return state
+
+
+def _run_action_and_check(action: Action, working_dir: pathlib.Path, name: str) -> State:
+    # runs in a worker process. The action reports its state through session.update_action_states()
+    # in that same process, so we can check it there directly. Returns the final state of the action
+    fn = action_to_func(action)
+    with _CompletionTracker() as tracker:
+        tracker.reset(working_dir, action)
+        fn(working_dir, config_dir=None)
+        return tracker.check_completed(working_dir, action, name)
+
+
+def _run_shared_decode_and_check(actions: list[Action], working_dir: pathlib.Path, name: str) -> State:
+    # as _run_action_and_check(), for actions that are run together with a single decode of the video.
+    # Returns Skipped only if all the actions were skipped
+    from .shared_decode import run
+    with _CompletionTracker() as tracker:
+        for action in actions:
+            tracker.reset(working_dir, action)
+        run(working_dir, set(actions), config_dir=None)
+        states = [tracker.check_completed(working_dir, action, name) for action in actions]
+        return State.Skipped if all(s==State.Skipped for s in states) else State.Completed
+
+
+class _JobGraphRunner:
+    # runs the jobs of a JobScheduler to completion, waking up whenever a job finishes, and raises
+    # for the first failed job. The user_data of each job is (action, name), which is unique in the
+    # job graph and identifies the job in the done callback. NB: the job id passed to the done
+    # callback is that of the process pool, not that of the scheduler
+    def __init__(self, scheduler: JobScheduler[tuple[Action, str]]):
+        self.scheduler  = scheduler
+        self.errors     : dict[tuple[Action, str], BaseException] = {}
+        self._job_done  = threading.Event()
+
+    def done_callback(self, future: ProcessFuture, _: int, user_data: tuple[Action, str], state: State):
+        if state==State.Failed and future is not None:
+            self.errors[user_data] = future.exception()
+        self._job_done.set()
+
+    def run(self):
+        reported: set[int] = set()
+        try:
+            while True:
+                self._job_done.clear()
+                self.scheduler.update()
+                finished = True
+                for job_id, job in self.scheduler.jobs.items():
+                    state = job.get_state()
+                    action, name = job.user_data
+                    if state in [State.Pending, State.Running]:
+                        finished = False
+                    elif state==State.Completed:
+                        if job_id not in reported:
+                            print(f"'{action.displayable_name}' voltooid voor {name}.")
+                            reported.add(job_id)
+                    else:
+                        error = self.errors.get(job.user_data, None)
+                        msg = f"Fout tijdens pipeline bij '{action.displayable_name}' ({name}): {error if error is not None else state.displayable_name}"
+                        print(msg)
+                        raise RuntimeError(msg) from error
+                if finished:
+                    break
+                self._job_done.wait()
+        finally:
+            self.scheduler.cancel_all_jobs()
+
+
+def _run_actions(actions: list[Action], working_dir: pathlib.Path, study_cfg):
+    # Recording-level actions are fanned out over a process pool, one job per recording. A recording's
+    # job depends on the previous job for that same recording, and on the last session-level job. Each
+    # session-level job joins all jobs issued since the previous session-level job.
     from ..session import Session
     session_info = Session.from_definition(study_cfg.session_def, working_dir)
     rec_names = list(session_info.recordings.keys())
 
+    pool = ProcessPool(study_cfg.gui_num_workers)
+    scheduler = JobScheduler[tuple[Action, str]](pool)
+    runner = _JobGraphRunner(scheduler)
+
+    # build job graph
+    session_job: int|None = None
+    rec_jobs: dict[str,int] = {}
     for action in actions:
         if action.needs_GUI:
             print(f" {action.displayable_name} vereist GUI en wordt overgeslagen.")
             continue
 
-        print(f"⚙️ Running: {action.displayable_name}")
-        fn = action_to_func(action)
-
-        try:
-            if is_session_level_action(action):
-                fn(working_dir, config_dir=None)
-            else:
-                for rec in rec_names:
-                    if action == Action.AUTO_CODE_TRIALS and rec != study_cfg.sync_ref_recording:
-                        continue
-
-                    rec_path = working_dir / rec
-                    fn(rec_path, config_dir=None)
-
-            wait_until_all_done(working_dir, action, only_relevant=(action == Action.AUTO_CODE_TRIALS), study_cfg=study_cfg)
-        except Exception as e:
-            print(f"Fout tijdens pipeline bij '{action.displayable_name}': {e}")
-            raise
-
+        if is_session_level_action(action):
+            depends_on = set(rec_jobs.values()) | ({session_job} if session_job is not None else set())
+            payload = JobPayload(_run_action_and_check, (action, working_dir, 'session'), {})
+            session_job = scheduler.add_job((action, 'session'), payload, runner.done_callback, depends_on=depends_on)
+            rec_jobs.clear()
+        else:
+            for rec in rec_names:
+                if action == Action.AUTO_CODE_TRIALS and rec != study_cfg.sync_ref_recording:
+                    continue
+                depends_on = ({rec_jobs[rec]} if rec in rec_jobs else set()) | ({session_job} if session_job is not None else set())
+                payload = JobPayload(_run_action_and_check, (action, working_dir / rec, rec), {})
+                rec_jobs[rec] = scheduler.add_job((action, rec), payload, runner.done_callback, depends_on=depends_on)
 
+    runner.run()
 
 
 def run_auto_codes_pipeline(working_dir: pathlib.Path, study_cfg):
@@ -82,7 +144,7 @@ def run_auto_codes_pipeline(working_dir: pathlib.Path, study_cfg):
         Action.AUTO_CODE_SYNC,
         Action.AUTO_CODE_TRIALS
     ]
-    _run_actions_sequentially(actions, working_dir, study_cfg)
+    _run_actions(actions, working_dir, study_cfg)
 
 
 def run_post_coding_pipeline(working_dir: pathlib.Path, study_cfg):
@@ -93,4 +155,4 @@ def run_post_coding_pipeline(working_dir: pathlib.Path, study_cfg):
         Action.COMPUTE_GAZE_DISTANCE,
         Action.MAKE_MAPPED_GAZE_VIDEO
     ]
-    _run_actions_sequentially(actions, working_dir, study_cfg)
+    _run_actions(actions, working_dir, study_cfg)
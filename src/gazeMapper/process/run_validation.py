@@ -3,7 +3,7 @@ import numpy as np
 
 from glassesTools import annotation, fixation_classification
 from glassesTools.validation import config as val_config, assign_fixations, compute_offsets
-from .. import config, episode, naming, plane, process, session
+from .. import config, data_files, episode, naming, plane, process, session
 
 
 stopAllProcessing = False
@@ -74,9 +74,13 @@ def run(working_dir: str | pathlib.Path, config_dir: str | pathlib.Path = None,
                 [validation_plane.bbox[1] - validation_plane.marker_size, validation_plane.bbox[3] + validation_plane.marker_size]
             ]
 
+            # lees gaze en poses eenmalig in (alleen de validatie-episodes), wordt door beide stappen hieronder gebruikt
+            gazes = data_files.read_plane_gaze(working_dir, p, episodes)
+            poses = data_files.read_plane_poses(working_dir, p, episodes)
+
             print(f"👁️ Classificeren van fixaties voor plane {p}...")
             fixation_classification.from_plane_gaze(
-                working_dir / f'{naming.world_gaze_prefix}{p}.tsv',
+                gazes,
                 episodes,
                 working_dir,
                 I2MC_settings_override=study_config.validate_I2MC_settings,
@@ -106,8 +110,8 @@ def run(working_dir: str | pathlib.Path, config_dir: str | pathlib.Path = None,
 
             print(f"📏 Berekenen van offset metrics voor plane {p}")
             compute_offsets.compute(
-                working_dir / f'{naming.world_gaze_prefix}{p}.tsv',
-                working_dir / f'{naming.plane_pose_prefix}{p}.tsv',
+                gazes,
+                poses,
                 working_dir / f'{naming.validation_prefix}{p}_fixation_assignment.tsv',
                 episodes,
                 targets,
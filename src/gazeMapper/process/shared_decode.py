@@ -0,0 +1,52 @@
+import pathlib
+
+from .. import config, frame_pipeline, marker_detection, process, session
+from . import detect_markers, make_gaze_overlay_video
+
+
+# recording-level actions that process the scene video frame by frame, and can thus share a single
+# decode of the video when they are run together
+actions = {process.Action.MAKE_GAZE_OVERLAY_VIDEO, process.Action.DETECT_MARKERS}
+
+
+def run(working_dir: str|pathlib.Path, to_run: set[process.Action], config_dir: str|pathlib.Path = None, **study_settings):
+    # runs the given actions for a recording, decoding the scene video only once. The result is the
+    # same as running each action's own run() function without visualization
+    working_dir = pathlib.Path(working_dir)
+    if config_dir is None:
+        config_dir = config.guess_config_dir(working_dir)
+    config_dir  = pathlib.Path(config_dir)
+    if (not_supported:=set(to_run)-actions):
+        raise ValueError(f'The actions {", ".join(a.displayable_name for a in not_supported)} cannot be run with a shared video decode')
+
+    print(f'processing: {working_dir.parent.name}/{working_dir.name}')
+
+    study_config = config.read_study_config_with_overrides(config_dir, {
+        config.OverrideLevel.Session: working_dir.parent,
+        config.OverrideLevel.Recording: working_dir
+    }, **study_settings)
+
+    decoder: frame_pipeline.SharedDecoder = None
+    if process.Action.DETECT_MARKERS in to_run:
+        _, estimator, _ = detect_markers._setup_estimator(working_dir, config_dir, **study_settings)
+        decoder = frame_pipeline.SharedDecoder(estimator.video.file, estimator.video.ts)
+        decoder.add_pose_estimator('detect_markers', estimator)
+    if process.Action.MAKE_GAZE_OVERLAY_VIDEO in to_run:
+        video_maker = make_gaze_overlay_video._get_video_maker(working_dir, study_config)
+        if decoder is None:
+            decoder = frame_pipeline.SharedDecoder(video_maker.src_video, video_maker.video_ts.timestamps)
+        decoder.add_video_maker('gaze_overlay', video_maker)
+        # set to not run so that if we crash or cancel below the task is correctly marked as not run (video files are corrupt)
+        session.update_action_states(working_dir, process.Action.MAKE_GAZE_OVERLAY_VIDEO, process.State.Not_Run, study_config)
+
+    print(f"▶️ Start processing video for {', '.join(a.displayable_name for a in sorted(to_run))}...")
+    output = decoder.run()
+    print("✅ Finished processing video")
+
+    if process.Action.DETECT_MARKERS in to_run:
+        detect_markers._write_output(working_dir, study_config, *output['detect_markers'],
+                                     marker_detection.get_stats(marker_detection.get_trackers(estimator)),
+                                     marker_detection.get_stats(marker_detection.get_pyramid_detectors(estimator)))
+        session.update_action_states(working_dir, process.Action.DETECT_MARKERS, process.State.Completed, study_config)
+    if process.Action.MAKE_GAZE_OVERLAY_VIDEO in to_run:
+        session.update_action_states(working_dir, process.Action.MAKE_GAZE_OVERLAY_VIDEO, process.State.Completed, study_config)
@@ -1,7 +1,6 @@
 import pathlib
 import numpy as np
 import pandas as pd
-import polars as pl
 from collections import defaultdict
 
 import sys
@@ -13,8 +12,7 @@ from glassesTools import annotation, gaze_headref, naming as gt_naming, ocv, pla
 from glassesTools.gui.signal_sync import GUI, TargetPos
 
 
-from . import _utils
-from .. import config, episode, naming, process, session
+from .. import config, data_files, episode, gaze_store, naming, process, session
 
 
 
@@ -75,10 +73,9 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
             pln = planes[0]
 
             # Read pose w.r.t plane
-            pln_file = working_dir/f'{naming.plane_pose_prefix}{pln}.tsv'
-            if not pln_file.is_file():
+            if not data_files.find_plane_pose_file(working_dir, pln):
                 raise FileNotFoundError(f'A planePose file for the {pln} plane is not found, but is needed. Run detect_markers to create this file.')
-            poses = plane.read_dict_from_file(pln_file, episodes)
+            poses = data_files.read_plane_poses(working_dir, pln, episodes)
 
             # get camera calibration info
             camera_params= ocv.CameraParams.read_from_file(working_dir / gt_naming.scene_camera_calibration_fname)
@@ -157,15 +154,13 @@ def do_the_work(working_dir: pathlib.Path, config_dir: pathlib.Path, gui: GUI, *
         toff = VOR_sync['offset_t'].mean()
     else:
         toff = VOR_sync.iloc[0,'offset_t']
-    # just read whole gaze dataframe so we can apply things vectorized
-    df = pd.read_csv(working_dir / gt_naming.gaze_data_fname, delimiter='\t', index_col=False)
+    # get the gaze timestamps so we can apply things vectorized
+    ts = gaze_store.read_head_gaze_columns(working_dir / gt_naming.gaze_data_fname)['timestamp']
     # resync gaze timestamps using VOR, and get correct scene camera frame numbers
-    ts_VOR = df['timestamp'].to_numpy() + toff*1000.   # s -> ms
+    ts_VOR = ts + toff*1000.   # s -> ms
     fr_VOR = video_utils.timestamps_to_frame_number(ts_VOR,video_ts.timestamps,trim=True)['frame_idx'].to_numpy()
-    # write into df (use polars as that library saves to file waaay faster)
-    df = _utils.insert_ts_fridx_in_df(df, gaze_headref.Gaze, 'VOR', ts_VOR, fr_VOR)
-    df = pl.from_pandas(df)
-    df.write_csv(working_dir / gt_naming.gaze_data_fname, separator='\t', null_value='nan', float_precision=8)
+    # store next to the gaze data file
+    gaze_store.write_sync_columns(working_dir / gt_naming.gaze_data_fname, 'VOR', ts_VOR, fr_VOR)
 
     # update state
     session.update_action_states(working_dir, process.Action.SYNC_ET_TO_CAM, process.State.Completed, study_config)
\ No newline at end of file
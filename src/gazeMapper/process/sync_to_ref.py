@@ -1,12 +1,11 @@
 import pathlib
+import numpy as np
 import pandas as pd
-import polars as pl
 
-from glassesTools import annotation, gaze_headref, naming, timestamps
+from glassesTools import annotation, naming, timestamps
 
 
-from . import _utils
-from .. import config, process, session, synchronization
+from .. import config, gaze_store, process, session, synchronization, naming as gm_naming
 
 
 def run(working_dir: str|pathlib.Path, config_dir: str|pathlib.Path = None, **study_settings):
@@ -51,28 +50,29 @@ def run(working_dir: str|pathlib.Path, config_dir: str|pathlib.Path = None, **st
 
     # prep for sync info
     recs = [r for r in session_info.recordings if r!=study_config.sync_ref_recording]
-    sync = synchronization.get_sync_for_recs(working_dir, recs, study_config.sync_ref_recording, study_config.sync_ref_do_time_stretch, study_config.sync_ref_average_recordings)
+    sync = synchronization.get_sync_model(working_dir, recs, study_config.sync_ref_recording, study_config.sync_ref_do_time_stretch, study_config.sync_ref_average_recordings)
 
     # store sync info
-    sync.to_csv(working_dir / 'ref_sync.tsv', sep='\t', na_rep='nan', float_format="%.16f")
+    sync.to_dataframe().to_csv(working_dir / gm_naming.ref_sync_file, sep='\t', na_rep='nan', float_format="%.16f")
 
     # now that we have determined how to sync, apply
     for r in recs:
         rec_def = study_config.session_def.get_recording_def(r)
         has_gaze_data = rec_def.type==session.RecordingType.Eye_Tracker
 
-        # just read whole gaze dataframe so we can apply things vectorized
+        # get the gaze timestamps so we can apply things vectorized
         if has_gaze_data:
-            df = pd.read_csv(working_dir / r / naming.gaze_data_fname, delimiter='\t', index_col=False)
-            ts_col = 'timestamp_VOR' if 'timestamp_VOR' in df else 'timestamp'
+            gaze_file = working_dir / r / naming.gaze_data_fname
+            columns = gaze_store.read_head_gaze_columns(gaze_file)
+            ts = columns['timestamp_VOR'] if 'timestamp_VOR' in columns else columns['timestamp']
         else:
             # stretch video timestamps instead
             ts_file = working_dir / r / naming.frame_timestamps_fname
             df = pd.read_csv(ts_file, delimiter='\t', index_col='frame_idx')
-            ts_col = 'timestamp'
+            ts = df['timestamp'].to_numpy(copy=True)
         # get gaze timestamps and camera frame numbers _in reference video timeline_
-        ts_ref, ref_vid_ts, fr_ref = synchronization.apply_sync(r, sync, df[ts_col].to_numpy(), video_ts_ref.timestamps,
-                                                                study_config.sync_ref_do_time_stretch, study_config.sync_ref_stretch_which)
+        ts_ref, ref_vid_ts, fr_ref = synchronization.apply_sync(r, sync, ts, video_ts_ref.timestamps,
+                                                                study_config.sync_ref_do_time_stretch, study_config.sync_ref_stretch_which, in_place=True)
 
         # make and store new video time signal
         if study_config.sync_ref_do_time_stretch and study_config.sync_ref_stretch_which=='ref':
@@ -82,18 +82,17 @@ def run(working_dir: str|pathlib.Path, config_dir: str|pathlib.Path = None, **st
                 # doesn't exist, insert
                 vid_ts_df.insert(1,'timestamp_stretched', ref_vid_ts)
                 should_store = True
-            elif max(vid_ts_df['timestamp_stretched'].to_numpy()-ref_vid_ts)<10e-5:
+            elif np.max(np.abs(vid_ts_df['timestamp_stretched'].to_numpy()-ref_vid_ts))>10e-5:
                 # exists but what we just computed is different, update
                 vid_ts_df['timestamp_stretched'] = ref_vid_ts
                 should_store = True
             if should_store:
                 vid_ts_df.to_csv(ref_vid_ts_file, sep='\t', float_format="%.8f")
 
-        # write into df (use polars as that library saves to file waaay faster)
+        # store
         if has_gaze_data:
-            df = _utils.insert_ts_fridx_in_df(df, gaze_headref.Gaze, 'ref', ts_ref, fr_ref)
-            df = pl.from_pandas(df)
-            df.write_csv(working_dir / r / naming.gaze_data_fname, separator='\t', null_value='nan', float_precision=8)
+            # next to the gaze data file
+            gaze_store.write_sync_columns(gaze_file, 'ref', ts_ref, fr_ref)
         else:
             if 'timestamp_ref' not in df.columns:
                 # doesn't exist, insert
@@ -3,6 +3,7 @@ import pathlib
 import json
 import typeguard
 import shutil
+import typing
 
 from glassesTools import camera_recording, importing, naming, utils
 from glassesTools.recording import Recording as EyeTrackerRecording
@@ -369,6 +370,21 @@ def _apply_mutations_and_store(file, action_state_mutations, skip_if_missing=Fal
 
     _write_action_states_to_file(file, action_states)
 
+# in-process listeners that are notified whenever update_action_states() is called, so that
+# e.g. a pipeline runner learns about action completion without having to poll the status files
+_action_state_listeners: list[typing.Callable[[pathlib.Path, process.Action, process.State], None]] = []
+def register_action_state_listener(listener: typing.Callable[[pathlib.Path, process.Action, process.State], None]):
+    if listener not in _action_state_listeners:
+        _action_state_listeners.append(listener)
+
+def unregister_action_state_listener(listener: typing.Callable[[pathlib.Path, process.Action, process.State], None]):
+    if listener in _action_state_listeners:
+        _action_state_listeners.remove(listener)
+
+def _notify_action_state_listeners(working_dir: pathlib.Path, action: process.Action, state: process.State):
+    for l in list(_action_state_listeners):
+        l(working_dir, action, state)
+
 def update_action_states(working_dir: str|pathlib.Path, action: process.Action, state: process.State, study_config: 'config.Study', skip_if_missing=False) -> dict[process.Action, process.State]:
     for_recording = not process.is_session_level_action(action)
 
@@ -394,4 +410,5 @@ def update_action_states(working_dir: str|pathlib.Path, action: process.Action,
             f = working_dir / r / _get_action_status_fname(True)
             _apply_mutations_and_store(f, recording_state_mutations, skip_if_missing=skip_if_missing)
 
+    _notify_action_state_listeners(pathlib.Path(working_dir), action, state)
     return session_state_mutations, recording_state_mutations
\ No newline at end of file
@@ -1,23 +1,280 @@
 import numpy as np
 import pandas as pd
 import pathlib
+import hashlib
+import json
+import os
 from typing import overload
 
 from glassesTools import annotation, naming as gt_naming, timestamps, video_utils
 
 from . import episode, naming
 
+
+_max_stored_sync_models = 8     # number of models (e.g. for different sets of recordings) kept in the sync model file
+
 def get_cols(do_time_stretch: bool):
     cols    = ['t_ref','t_this','offset']
     if do_time_stretch:
         cols += ['t_ref_elapsed','diff_offset','stretch_fac']
     else:
         cols += ['mean_off']
+    return cols
+
+
+# Synchronization of recordings to the reference recording, as determined from the coded camera sync
+# points. For each recording, holds the time (s) of each sync point in the reference recording (t_ref)
+# and in the recording itself (t_this), and when time stretching, the stretch factor for each interval
+# between two consecutive sync points. Use get_sync_model() to get the model for a session: it is
+# built from the coding and frame timestamp files, and stored next to ref_sync.tsv along with a hash
+# of these files, so that it is only rebuilt when they change.
+class SyncModel:
+    def __init__(self, recs: list[str], t_ref: np.ndarray, t_this: np.ndarray, do_time_stretch: bool, stretch_fac: np.ndarray|None = None):
+        self.recs           = list(recs)
+        self.t_ref          = np.asarray(t_ref , dtype=float)           # (n_recs x n_sync_points), s
+        self.t_this         = np.asarray(t_this, dtype=float)           # (n_recs x n_sync_points), s
+        self.offset         = self.t_ref-self.t_this
+        self.mean_off       = self.offset.mean(axis=1)                  # (n_recs,), s
+        self.do_time_stretch= do_time_stretch
+        self.stretch_fac    = None if stretch_fac is None else np.asarray(stretch_fac, dtype=float) # (n_recs x n_sync_points-1)
+        self._rows          = {r:i for i,r in enumerate(self.recs)}
+
+    @staticmethod
+    def from_sync_points(recs: list[str], t_ref: np.ndarray, t_this: np.ndarray, do_time_stretch: bool, average_recordings: list[str]|None = None) -> 'SyncModel':
+        model = SyncModel(recs, t_ref, t_this, do_time_stretch)
+        if do_time_stretch:
+            # get stretch factor for each interval between two sync points
+            model.stretch_fac = model.diff_offset/model.t_ref_elapsed
+            if average_recordings:
+                # one stretch factor for the group of recordings to average over
+                rows = [model._rows[r] for r in average_recordings]
+                model.stretch_fac[rows] = model.diff_offset[rows].mean(axis=0)/model.t_ref_elapsed[rows].mean(axis=0)
+        return model
+
+    @property
+    def num_sync_points(self) -> int:
+        return self.t_ref.shape[1]
+
+    @property
+    def _stretches(self) -> bool:
+        # time stretching needs at least one interval between two sync points. With a single sync
+        # point, only its offset is applied
+        return self.do_time_stretch and self.num_sync_points>1
+
+    @property
+    def t_ref_elapsed(self) -> np.ndarray:
+        return np.diff(self.t_ref, axis=1)
+
+    @property
+    def diff_offset(self) -> np.ndarray:
+        return np.diff(self.offset, axis=1)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        # the sync info in the format of get_sync_for_recs() (and ref_sync.tsv)
+        index = pd.MultiIndex.from_product([self.recs, range(self.num_sync_points)], names=['recording','interval'])
+        cols  = {'t_ref': self.t_ref, 't_this': self.t_this, 'offset': self.offset}
+        if self.do_time_stretch:
+            # only defined for intervals between two sync points, so not for the last sync point
+            pad = np.full((len(self.recs),1), np.nan)
+            cols |= {c:np.hstack((v,pad)) for c,v in zip(['t_ref_elapsed','diff_offset','stretch_fac'],[self.t_ref_elapsed,self.diff_offset,self.stretch_fac])}
+        else:
+            # applies to whole file, stored only for first interval
+            mean_off = np.full(self.t_ref.shape, np.nan)
+            mean_off[:,0] = self.mean_off
+            cols['mean_off'] = mean_off
+        return pd.DataFrame({c:v.reshape(-1) for c,v in cols.items()}, index=index, columns=get_cols(self.do_time_stretch))
+
+    def to_ref(self, rec: str, ts: np.ndarray, stretch_which: str, in_place=False) -> np.ndarray:
+        # transform timestamps (ms) of the recording to the time of the reference recording. Same as
+        # the data timestamps returned by apply_sync(). If in_place, the timestamps are transformed in
+        # the passed array if it is a float64 array
+        row = self._rows[rec]
+        ts  = _as_float_array(ts, in_place)
+        if not self._stretches:
+            ts += self.mean_off[row]*1000.  # s -> ms
+            return ts
+        offset = self.offset[row,:-1]*1000. # s -> ms
+        if stretch_which=='other':
+            pivot = self.t_this[row,:-1]*1000.
+            return _warp_timestamps(ts, self.t_ref[row,1:-1], pivot, 1+self.stretch_fac[row], offset)
+        return _warp_timestamps(ts, self.t_ref[row,1:-1], None, None, offset)
+
+    def stretch_reference(self, rec: str, ts: np.ndarray, stretch_which: str, in_place=False) -> np.ndarray:
+        # transform timestamps (ms) of the reference recording's video, which only changes them when
+        # stretching the reference's time. Same as the reference video timestamps returned by
+        # apply_sync()
+        ts = _as_float_array(ts, in_place)
+        if not self._stretches or stretch_which!='ref':
+            return ts
+        row   = self._rows[rec]
+        pivot = self.t_ref[row,:-1]*1000.   # s -> ms
+        return _warp_timestamps(ts, self.t_ref[row,1:-1], pivot, 1-self.stretch_fac[row], None)
+
+    def from_ref(self, rec: str, ts: np.ndarray, stretch_which: str) -> np.ndarray:
+        # transform timestamps (ms) in the time of the reference recording to the time of the
+        # recording. Inverse of to_ref()
+        row = self._rows[rec]
+        ts  = np.array(ts, dtype=float)
+        if not self._stretches:
+            ts -= self.mean_off[row]*1000.  # s -> ms
+            return ts
+        pivot   = self.t_this[row,:-1]*1000.    # s -> ms
+        offset  = self.offset[row,:-1]*1000.    # s -> ms
+        # interval edges in reference time
+        edges   = self.t_ref[row,1:-1]
+        if stretch_which=='other':
+            edges = (edges-pivot[1:])*(1+self.stretch_fac[row,1:])+pivot[1:]
+        edges   = edges+offset[1:]
+        ival    = np.searchsorted(edges, ts, side='right')
+        ts     -= offset[ival]
+        if stretch_which=='other':
+            ts  = (ts-pivot[ival])/(1+self.stretch_fac[row,ival])+pivot[ival]
+        return ts
+
+    def reference_frames_to_video(self, rec: str, fr_idxs: list[int]|list[list[int]], this_video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, stretch_which: str) -> list[int]|list[list[int]]:
+        return reference_frames_to_video(rec, self, fr_idxs, this_video_ts, video_ts_ref, self.do_time_stretch, stretch_which)
+
+    def video_frames_to_reference(self, rec: str, fr_idxs: list[int]|list[list[int]], this_video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, stretch_which: str) -> list[int]|list[list[int]]:
+        return video_frames_to_reference(rec, self, fr_idxs, this_video_ts, video_ts_ref, self.do_time_stretch, stretch_which)
 
-def get_sync_for_recs(working_dir: str|pathlib.Path, recs: str|list[str], ref_rec: str, do_time_stretch: bool, average_recordings: list[str], missing_ref_coding_ok=False):
+    def get_frame_mapping(self, rec: str, this_video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, stretch_which: str, cache_file: str|pathlib.Path|None = None) -> 'FrameMapping':
+        return get_frame_mapping(rec, self, this_video_ts, video_ts_ref, stretch_which, cache_file)
+
+    @staticmethod
+    def from_dataframe(sync: pd.DataFrame, do_time_stretch: bool) -> 'SyncModel':
+        # from the sync info in the format of get_sync_for_recs()
+        recs = sync.index.get_level_values('recording').unique().tolist()
+        cols = {c:np.vstack([sync.loc[r,c].to_numpy() for r in recs]) for c in get_cols(do_time_stretch)}
+        model = SyncModel(recs, cols['t_ref'], cols['t_this'], do_time_stretch, cols['stretch_fac'][:,:-1] if do_time_stretch else None)
+        model.offset = cols['offset']
+        if not do_time_stretch:
+            model.mean_off = cols['mean_off'][:,0]
+        return model
+
+    def to_json(self) -> dict:
+        return {'recs': self.recs, 't_ref': self.t_ref.tolist(), 't_this': self.t_this.tolist(), 'do_time_stretch': self.do_time_stretch,
+                'stretch_fac': None if self.stretch_fac is None else self.stretch_fac.tolist()}
+
+    @staticmethod
+    def from_json(info: dict) -> 'SyncModel':
+        return SyncModel(info['recs'], info['t_ref'], info['t_this'], info['do_time_stretch'], info['stretch_fac'])
+
+
+def _as_float_array(ts: np.ndarray|list[float], in_place: bool) -> np.ndarray:
+    # a float64 array of the timestamps. Only a copy if needed or if not allowed to work in place
+    if in_place and isinstance(ts, np.ndarray) and ts.dtype==np.float64 and ts.flags.writeable:
+        return ts
+    return np.array(ts, dtype=float)
+
+def _warp_timestamps(ts: np.ndarray, edges: np.ndarray, pivot: np.ndarray|None, scale: np.ndarray|None, offset: np.ndarray|None) -> np.ndarray:
+    # piecewise linear transformation of the timestamps, in place. edges are the sync points
+    # separating the intervals, the first interval extends back to the first timestamp and the last
+    # to the last timestamp. For each interval in turn, the timestamps in it are scaled around the
+    # interval's pivot (overwriting the result for an earlier interval) and then the interval's
+    # offset is added. Edges are inclusive, so a timestamp exactly on the edge between two intervals
+    # is in both. This is the same sequence of operations as the loop over intervals that
+    # apply_sync() used to do, so the result is bit-identical to it
+    lo, hi = np.r_[ts.min(), edges], np.r_[edges, ts.max()]
+    if np.any(np.diff(edges)<=0):
+        # sync points not in temporal order, intervals may overlap. Go through them one by one
+        ori = ts.copy()
+        for i in range(lo.size):
+            sel = (ori>=lo[i]) & (ori<=hi[i])
+            if pivot is not None:
+                ts[sel] = (ori[sel]-pivot[i])*scale[i]+pivot[i]
+            if offset is not None:
+                ts[sel] += offset[i]
+        return ts
+
+    # find interval of each timestamp in one go, timestamps on an edge are also in the interval before
+    ival    = np.searchsorted(edges, ts, side='right')
+    in_ival = (ts>=lo[ival]) & (ts<=hi[ival])
+    on_edge = (ival>0) & (ts==lo[ival]) & (ts>=lo[ival-1])
+    if pivot is not None:
+        # scaling for the later interval overwrites that of the earlier, and so does its offset
+        sel     = in_ival|on_edge
+        ival    = np.where(in_ival, ival, ival-1)[sel]
+        ts[sel] = (ts[sel]-pivot[ival])*scale[ival]+pivot[ival]
+        if offset is not None:
+            ts[sel] += offset[ival]
+    else:
+        # offsets accumulate, the earlier interval's first
+        if np.any(on_edge):
+            ts[on_edge] += offset[ival[on_edge]-1]
+        ts[in_ival] += offset[ival[in_ival]]
+    return ts
+
+
+def nearest_timestamps(left: np.ndarray, right: np.ndarray, tolerance: float) -> np.ndarray:
+    # for each left key the index of the nearest right key within tolerance, -1 if none.
+    # Same semantics as pd.merge_asof(direction="nearest"): the backward candidate is the last
+    # right key <= left, the forward candidate the first right key >= left, and ties go to
+    # the backward candidate
+    bwd = np.searchsorted(right, left, side='right')-1
+    fwd = np.searchsorted(right, left, side='left')
+    b_ok = bwd>=0
+    f_ok = fwd<right.size
+    b_diff = np.full(left.shape, np.inf)
+    f_diff = np.full(left.shape, np.inf)
+    b_diff[b_ok] = left[b_ok]-right[bwd[b_ok]]
+    f_diff[f_ok] = right[fwd[f_ok]]-left[f_ok]
+    b_ok &= b_diff<=tolerance
+    f_ok &= f_diff<=tolerance
+    return np.where(b_ok & (~f_ok | (b_diff<=f_diff)), bwd, np.where(f_ok, fwd, -1))
+
+
+def _get_sync_model_key(working_dir: pathlib.Path, recs: list[str], ref_rec: str, do_time_stretch: bool, average_recordings: list[str]) -> str:
+    # hash of the settings and of the content of the files the sync model is built from
+    h = hashlib.sha256(json.dumps([recs, ref_rec, do_time_stretch, list(average_recordings or [])]).encode())
+    for r in [ref_rec]+recs:
+        for f in (working_dir / r / naming.coding_file, working_dir / r / gt_naming.frame_timestamps_fname):
+            h.update(f'{r}/{f.name}:'.encode())
+            if f.is_file():
+                h.update(f.read_bytes())
+    return h.hexdigest()
+
+def _load_sync_model(working_dir: pathlib.Path, key: str) -> SyncModel|None:
+    model_file = working_dir / naming.sync_model_file
+    if not model_file.is_file():
+        return None
+    try:
+        with open(model_file, 'r') as f:
+            info = json.load(f)
+        return SyncModel.from_json(info['models'][key])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def _store_sync_model(working_dir: pathlib.Path, key: str, model: SyncModel):
+    model_file = working_dir / naming.sync_model_file
+    models = {}
+    if model_file.is_file():
+        try:
+            with open(model_file, 'r') as f:
+                models = json.load(f)['models']
+        except (OSError, ValueError, KeyError):
+            pass
+    # keep models for a few sets of recordings (e.g. with and without the reference recording)
+    models.pop(key, None)
+    models = dict(list(models.items())[-(_max_stored_sync_models-1):]) | {key: model.to_json()}
+    # write to temporary file and then move it into place, so that a concurrent reader never sees a
+    # partially written file
+    tmp_file = model_file.with_name(f'{model_file.stem}.{os.getpid()}.tmp.json')
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump({'models': models}, f)
+        os.replace(tmp_file, model_file)
+    except OSError:
+        # not being able to store the model is not an error, it is just rebuilt next time
+        tmp_file.unlink(missing_ok=True)
+
+def get_sync_model(working_dir: str|pathlib.Path, recs: str|list[str], ref_rec: str, do_time_stretch: bool, average_recordings: list[str], missing_ref_coding_ok=False) -> SyncModel|None:
     working_dir  = pathlib.Path(working_dir)
     if isinstance(recs,str):
         recs = [recs]
+    key = _get_sync_model_key(working_dir, recs, ref_rec, do_time_stretch, average_recordings)
+    if (model:=_load_sync_model(working_dir, key)) is not None:
+        return model
+
     ref_episodes = get_coding_file(working_dir / ref_rec, missing_ref_coding_ok)
     if ref_episodes is None:
         return None
@@ -34,11 +291,10 @@ def get_sync_for_recs(working_dir: str|pathlib.Path, recs: str|list[str], ref_re
             if r==ref_rec:
                 raise ValueError(f'Recording {r} is the reference recording for sync, should not be specified in study_config.sync_average_recordings')
 
-    index = pd.MultiIndex.from_product([recs, range(len(ref_episodes))], names=['recording','interval'])
-    sync  = pd.DataFrame(columns=get_cols(do_time_stretch), dtype=float, index=index)
-
-    # collect timestamps for the recordings
-    for r in recs:
+    # collect timestamps of the sync points for the recordings
+    t_ref  = np.array([video_ts_ref.get_timestamp(i) for i in ref_episodes])/1000.  # ms -> s
+    t_this = np.empty((len(recs),len(ref_episodes)))
+    for i,r in enumerate(recs):
         # get interval coding for this recording
         episodes = get_coding_file(working_dir / r, missing_ref_coding_ok)
         if episodes is None and missing_ref_coding_ok:
@@ -50,94 +306,34 @@ def get_sync_for_recs(working_dir: str|pathlib.Path, recs: str|list[str], ref_re
                 return None
             raise ValueError(f"The number of sync points for this recording ({len(episodes)}, {r}) is not equal to that for the reference recording ({len(ref_episodes)}, {ref_rec}). Cannot continue, fix your coding")
 
-        # get time information
+        # get timestamps corresponding to sync frames
         video_ts = timestamps.VideoTimestamps(working_dir / r / gt_naming.frame_timestamps_fname)
+        t_this[i]= np.array([video_ts.get_timestamp(e) for e in episodes])/1000.        # ms -> s
 
-        # get timestamps corresponding to sync frames
-        for ival in range(len(episodes)):
-            sync.loc[(r,ival),'t_ref']  = video_ts_ref.get_timestamp(ref_episodes[ival])/1000.  # ms -> s
-            sync.loc[(r,ival),'t_this'] =   video_ts  .get_timestamp(    episodes[ival])/1000.  # ms -> s
-            sync.loc[(r,ival),'offset'] = sync.loc[(r,ival),'t_ref']-sync.loc[(r,ival),'t_this']
-        if not do_time_stretch:
-            # no time stretching, get average offset. Applies to whole file, store only for first interval
-            sync.loc[(r,0),'mean_off'] = sync.loc[(r,slice(None)),'offset'].mean()
+    model = SyncModel.from_sync_points(recs, np.tile(t_ref,(len(recs),1)), t_this, do_time_stretch, average_recordings)
+    _store_sync_model(working_dir, key, model)
+    return model
 
-    if do_time_stretch:
-        # get stretch factor for each interval between two sync points
-        if average_recordings:
-            recs_gr = [r for r in recs if r not in average_recordings]
-            recs_gr.append(list(average_recordings))
-        else:
-            recs_gr = recs
-        for r in recs_gr:
-            for ival in range(len(ref_episodes)-1):
-                t_ref = sync.loc[(r,ival+1),'t_ref' ]
-                offset= sync.loc[(r,ival+1),'offset']
-                if not isinstance(t_ref,float) and 'interval' in t_ref.index.names:
-                    t_ref = t_ref .droplevel('interval')
-                    offset= offset.droplevel('interval')
-                sync.loc[(r,ival),'t_ref_elapsed'] = t_ref-sync.loc[(r,ival),'t_ref']
-                sync.loc[(r,ival),'diff_offset']   = offset-sync.loc[(r,ival),'offset']
-                sync.loc[(r,ival),'stretch_fac']   = sync.loc[(r,ival),'diff_offset'].mean()/sync.loc[(r,ival),'t_ref_elapsed'].mean()
-    return sync
+def get_sync_for_recs(working_dir: str|pathlib.Path, recs: str|list[str], ref_rec: str, do_time_stretch: bool, average_recordings: list[str], missing_ref_coding_ok=False) -> pd.DataFrame|None:
+    model = get_sync_model(working_dir, recs, ref_rec, do_time_stretch, average_recordings, missing_ref_coding_ok)
+    return None if model is None else model.to_dataframe()
 
 def apply_sync(rec: str,
-               sync: pd.DataFrame,
+               sync: pd.DataFrame|SyncModel,
                data_timestamps: np.ndarray|None,
                reference_video_timestamps: np.ndarray,
                do_time_stretch,
-               stretch_which: str):
-    reference_video_timestamps  = np.array(reference_video_timestamps).copy()
-    new_reference_video_timestamps = reference_video_timestamps.copy()
-    rt_start, rt_end            = reference_video_timestamps.min(), reference_video_timestamps.max()
-    if has_data_ts := data_timestamps is not None:
-        data_timestamps     = np.array(data_timestamps).copy()
-        dt_start, dt_end    = data_timestamps.min(), data_timestamps.max()
-        new_data_timestamps = data_timestamps.copy()
-    else:
-        dt_start, dt_end    = None, None
-    num_reference_episodes      = sync.loc[rec].shape[0]
-    if do_time_stretch:
-        for ival in range(num_reference_episodes-1):
-            # set up the problem - piecewise linear scale
-            # 1. get known good location for this interval, and the stretch factor
-            pivot       = (sync.loc[(rec,ival),'t_ref'] if stretch_which=='ref' else sync.loc[(rec,ival),'t_this'])*1000.   # s -> ms
-            stretch_fac = sync.loc[(rec,ival),'stretch_fac']
-            # 2. determine data range to apply stretch for this interval to
-            if ival==0:
-                # first interval, apply all the way from start of data
-                d_start = dt_start
-                r_start = rt_start
-            else:
-                d_start = r_start = sync.loc[(rec,ival),'t_ref']
-            if ival==num_reference_episodes-2:  # NB: zero-based indexing
-                # last interval, apply all the way to end of data
-                d_end = dt_end
-                r_end = rt_end
-            else:
-                d_end = r_end = sync.loc[(rec,ival+1),'t_ref']
-            # calculate new timestamps
-            if stretch_which=='ref':
-                # 1. first translate gaze ts to reference timestamps
-                if has_data_ts:
-                    data_sel = (data_timestamps >= d_start) & (data_timestamps <= d_end)
-                    new_data_timestamps[data_sel] += sync.loc[(rec,ival),'offset']*1000.   # s -> ms
-                # 2. apply scaling
-                data_sel = (reference_video_timestamps >= r_start) & (reference_video_timestamps <= r_end)
-                new_reference_video_timestamps[data_sel] = (reference_video_timestamps[data_sel]-pivot)*(1-stretch_fac)+pivot
-            elif stretch_which=='other':
-                if has_data_ts:
-                    data_sel = (data_timestamps >= d_start) & (data_timestamps <= d_end)
-                    new_data_timestamps[data_sel] = (data_timestamps[data_sel]-pivot)*(1+stretch_fac)+pivot
-                    new_data_timestamps[data_sel] += sync.loc[(rec,ival),'offset']*1000.   # s -> ms
-                # else nothing to do...
-    else:
-        if has_data_ts:
-            new_data_timestamps += sync.loc[(rec,0),'mean_off']*1000.   # s -> ms
-    if has_data_ts:
-        fr_ref = video_utils.timestamps_to_frame_number(new_data_timestamps,new_reference_video_timestamps,trim=True)['frame_idx'].to_numpy()
-    else:
-        fr_ref = None
+               stretch_which: str,
+               in_place=False):
+    # NB: if in_place, the data and reference video timestamps are transformed in the passed arrays
+    # if they are float64 arrays, instead of in copies
+    if not isinstance(sync, SyncModel):
+        sync = SyncModel.from_dataframe(sync, do_time_stretch)
+    new_reference_video_timestamps = sync.stretch_reference(rec, reference_video_timestamps, stretch_which, in_place)
+    if data_timestamps is None:
+        return None, new_reference_video_timestamps, None
+    new_data_timestamps = sync.to_ref(rec, data_timestamps, stretch_which, in_place)
+    fr_ref = video_utils.timestamps_to_frame_number(new_data_timestamps,new_reference_video_timestamps,trim=True)['frame_idx'].to_numpy()
     return new_data_timestamps, new_reference_video_timestamps, fr_ref
 
 def get_coding_file(working_dir: str|pathlib.Path, missing_ref_coding_ok=False):
@@ -168,26 +364,29 @@ def get_episode_frame_indices_from_ref(working_dir: str|pathlib.Path, event: ann
             return [[]]
         raise KeyError(f'Trying to get {event.value} episodes from the reference recording ({ref_rec}), but the coding file for this reference recording doesn\'t contain any ({event.value}) episodes')
     # get sync and timestamp info we need to transform reference frames indices to frame indices of this recording
-    sync = get_sync_for_recs(working_dir.parent, all_recs, ref_rec, do_time_stretch, average_recordings, missing_ref_coding_ok)
+    sync = get_sync_model(working_dir.parent, all_recs, ref_rec, do_time_stretch, average_recordings, missing_ref_coding_ok)
     if sync is None:
         return [[]]
     video_ts_ref = timestamps.VideoTimestamps(working_dir.parent / ref_rec / gt_naming.frame_timestamps_fname)
     video_ts     = timestamps.VideoTimestamps(working_dir / gt_naming.frame_timestamps_fname)
     # get frame indices in this recording's video corresponding to each of the reference frames
-    frame_idx = reference_frames_to_video(rec, sync, ref_episodes[event], video_ts.timestamps, video_ts_ref.timestamps, do_time_stretch, stretch_which)
+    frame_idx = sync.reference_frames_to_video(rec, ref_episodes[event], video_ts.timestamps, video_ts_ref.timestamps, stretch_which)
     return [[i+e for i,e in zip(ifs, [-extra_fr, extra_fr])] for ifs in frame_idx]   # expand by extra_fr frames on each edge
 
 @overload
-def reference_frames_to_video(rec: str, sync: pd.DataFrame, fr_idxs: list[int], video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, do_time_stretch: bool, stretch_which: str) -> list[int]: ...
+def reference_frames_to_video(rec: str, sync: pd.DataFrame|SyncModel, fr_idxs: list[int], video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, do_time_stretch: bool, stretch_which: str) -> list[int]: ...
 @overload
-def reference_frames_to_video(rec: str, sync: pd.DataFrame, fr_idxs: list[list[int]], video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, do_time_stretch: bool, stretch_which: str) -> list[list[int]]: ...
-def reference_frames_to_video(rec: str, sync: pd.DataFrame, fr_idxs: list[int]|list[list[int]], this_video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, do_time_stretch: bool, stretch_which: str) -> list[int]|list[list[int]]:
+def reference_frames_to_video(rec: str, sync: pd.DataFrame|SyncModel, fr_idxs: list[list[int]], video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, do_time_stretch: bool, stretch_which: str) -> list[list[int]]: ...
+def reference_frames_to_video(rec: str, sync: pd.DataFrame|SyncModel, fr_idxs: list[int]|list[list[int]], this_video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, do_time_stretch: bool, stretch_which: str) -> list[int]|list[list[int]]:
     if not fr_idxs:
         return []
 
     # get the video's timestamps in time of the reference video
     this_video_ts_ref, video_ts_ref, _ = apply_sync(rec, sync, this_video_ts, video_ts_ref, do_time_stretch, stretch_which)
 
+    return _get_reference_to_video_table(this_video_ts_ref, video_ts_ref)[fr_idxs].tolist()
+
+def _get_reference_to_video_table(this_video_ts_ref: np.ndarray, video_ts_ref: np.ndarray) -> np.ndarray:
     # get where (which frame) each of this video's timestamps occur in the reference video, given the sync info
     # (fr_idx_ref contains the reference frame_idxs corresponding to this video's frames, video_ts)
     fr_idx_ref = video_utils.timestamps_to_frame_number(video_ts_ref, this_video_ts_ref, trim=True)['frame_idx'].to_numpy()
@@ -198,26 +397,119 @@ def reference_frames_to_video(rec: str, sync: pd.DataFrame, fr_idxs: list[int]|l
         # that means, do assign a frame to the first frame if its a usual frame (judged by ifi)
         if video_ts_ref[1]-video_ts_ref[0] < ifi*1.2:
             fr_idx_ref[0] = fr_idx_ref[1]-1
-
-    return fr_idx_ref[fr_idxs].tolist()
+    return fr_idx_ref
 
 @overload
-def video_frames_to_reference(rec: str, sync: pd.DataFrame, fr_idxs: list[int], video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, do_time_stretch: bool, stretch_which: str) -> list[int]: ...
+def video_frames_to_reference(rec: str, sync: pd.DataFrame|SyncModel, fr_idxs: list[int], video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, do_time_stretch: bool, stretch_which: str) -> list[int]: ...
 @overload
-def video_frames_to_reference(rec: str, sync: pd.DataFrame, fr_idxs: list[list[int]], video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, do_time_stretch: bool, stretch_which: str) -> list[list[int]]: ...
-def video_frames_to_reference(rec: str, sync: pd.DataFrame, fr_idxs: list[int]|list[list[int]], this_video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, do_time_stretch: bool, stretch_which: str) -> list[int]|list[list[int]]:
+def video_frames_to_reference(rec: str, sync: pd.DataFrame|SyncModel, fr_idxs: list[list[int]], video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, do_time_stretch: bool, stretch_which: str) -> list[list[int]]: ...
+def video_frames_to_reference(rec: str, sync: pd.DataFrame|SyncModel, fr_idxs: list[int]|list[list[int]], this_video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, do_time_stretch: bool, stretch_which: str) -> list[int]|list[list[int]]:
     if not fr_idxs:
         return []
 
     # get the video's timestamps in time of the reference video
     this_video_ts_ref, video_ts_ref, _ = apply_sync(rec, sync, this_video_ts, video_ts_ref, do_time_stretch, stretch_which)
 
+    return _get_video_to_reference_table(this_video_ts_ref, video_ts_ref)[fr_idxs].tolist()
+
+def _get_video_to_reference_table(this_video_ts_ref: np.ndarray, video_ts_ref: np.ndarray) -> np.ndarray:
     # get where (which frame) each of the reference video frames occur in this video, given the sync info
     # (fr_idx contains this video's frame_idxs corresponding to this reference's frames, video_ts)
     fr_idx = video_utils.timestamps_to_frame_number(this_video_ts_ref, video_ts_ref, trim=True)['frame_idx'].to_numpy()
     fr_idx[this_video_ts_ref<video_ts_ref[0]] = -1
+    return fr_idx
+
+
+# Frame to frame mapping between the video of a recording and the reference video. Holds the full
+# mapping in both directions, so that any number of frame or episode queries are answered by plain
+# indexing, instead of by syncing the timestamps and matching frames for each query as the
+# reference_frames_to_video() and video_frames_to_reference() functions do. Results are identical to
+# those of these functions. Use get_frame_mapping() to get it.
+class FrameMapping:
+    def __init__(self, ref_to_video: np.ndarray, video_to_ref: np.ndarray):
+        self.ref_to_video = ref_to_video    # (n_ref_frames,) int32: for each reference video frame the frame of this video, -1 if none
+        self.video_to_ref = video_to_ref    # (n_frames,) int32: for each frame of this video the reference video frame, -1 if none
+
+    @overload
+    def reference_frames_to_video(self, fr_idxs: list[int]) -> list[int]: ...
+    @overload
+    def reference_frames_to_video(self, fr_idxs: list[list[int]]) -> list[list[int]]: ...
+    def reference_frames_to_video(self, fr_idxs: list[int]|list[list[int]]) -> list[int]|list[list[int]]:
+        if not fr_idxs:
+            return []
+        return self.ref_to_video[fr_idxs].tolist()
+
+    @overload
+    def video_frames_to_reference(self, fr_idxs: list[int]) -> list[int]: ...
+    @overload
+    def video_frames_to_reference(self, fr_idxs: list[list[int]]) -> list[list[int]]: ...
+    def video_frames_to_reference(self, fr_idxs: list[int]|list[list[int]]) -> list[int]|list[list[int]]:
+        if not fr_idxs:
+            return []
+        return self.video_to_ref[fr_idxs].tolist()
+
+def get_frame_mapping(rec: str, sync: SyncModel, this_video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, stretch_which: str, cache_file: str|pathlib.Path|None = None) -> FrameMapping:
+    # If a cache_file (.npy) is provided, the mapping is stored there (along with a .json file
+    # describing it), and memory mapped from there the next time, unless the sync or timestamps
+    # changed
+    if cache_file is not None:
+        cache_file = pathlib.Path(cache_file)
+        key = _get_frame_mapping_key(rec, sync, this_video_ts, video_ts_ref, stretch_which)
+        if (mapping:=_load_frame_mapping(cache_file, key)) is not None:
+            return mapping
+
+    # get the video's timestamps in time of the reference video, and from that the mapping in both directions
+    this_video_ts_ref, video_ts_ref, _ = apply_sync(rec, sync, this_video_ts, video_ts_ref, sync.do_time_stretch, stretch_which)
+    mapping = FrameMapping(_get_reference_to_video_table(this_video_ts_ref, video_ts_ref).astype(np.int32),
+                           _get_video_to_reference_table(this_video_ts_ref, video_ts_ref).astype(np.int32))
+
+    if cache_file is not None:
+        _store_frame_mapping(cache_file, key, mapping)
+    return mapping
+
+def _get_frame_mapping_key(rec: str, sync: SyncModel, this_video_ts: list[float]|np.ndarray, video_ts_ref: list[float]|np.ndarray, stretch_which: str) -> str:
+    # hash of everything the mapping is determined by: the sync of the recording and both videos' timestamps
+    row = sync._rows[rec]
+    h = hashlib.sha256(json.dumps([sync.do_time_stretch, stretch_which]).encode())
+    for a in (sync.t_ref[row], sync.t_this[row], sync.mean_off[row], sync.stretch_fac[row] if sync.do_time_stretch else [], this_video_ts, video_ts_ref):
+        h.update(np.asarray(a, dtype=float).tobytes())
+        h.update(b'|')
+    return h.hexdigest()
+
+def _load_frame_mapping(cache_file: pathlib.Path, key: str) -> FrameMapping|None:
+    info_file = cache_file.with_suffix('.json')
+    if not cache_file.is_file() or not info_file.is_file():
+        return None
+    try:
+        with open(info_file, 'r') as f:
+            info = json.load(f)
+        if info['key']!=key:
+            return None
+        tables = np.load(cache_file, mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+    # both tables are stored concatenated in a single array
+    n_ref = info['num_ref_frames']
+    if tables.dtype!=np.int32 or tables.ndim!=1 or n_ref>tables.size:
+        return None
+    return FrameMapping(tables[:n_ref], tables[n_ref:])
 
-    return fr_idx[fr_idxs].tolist()
+def _store_frame_mapping(cache_file: pathlib.Path, key: str, mapping: FrameMapping):
+    info_file = cache_file.with_suffix('.json')
+    # write to temporary files and then move them into place, so that a concurrent reader never sees
+    # a partially written cache
+    tmp_cache = cache_file.with_name(f'{cache_file.stem}.{os.getpid()}.tmp.npy')
+    tmp_info  = info_file .with_name(f'{info_file.stem}.{os.getpid()}.tmp.json')
+    try:
+        np.save(tmp_cache, np.concatenate((mapping.ref_to_video, mapping.video_to_ref)))
+        with open(tmp_info, 'w') as f:
+            json.dump({'key': key, 'num_ref_frames': mapping.ref_to_video.size}, f)
+        os.replace(tmp_cache, cache_file)
+        os.replace(tmp_info, info_file)
+    except OSError:
+        # not being able to store the cache is not an error, it just isn't available next time
+        for f in (tmp_cache, tmp_info):
+            f.unlink(missing_ok=True)
 
 def smooth_video_frames_indices(fr_idxs: list[int]):
     # detect plateaus of N samples followed by a step of N samples
@@ -0,0 +1,162 @@
+import pathlib
+import subprocess
+import shutil
+import numpy as np
+import cv2
+
+
+# Splitting a video into segments that can be decoded independently, and reading a video starting
+# at such a segment. Segments start at keyframes, so that decoding a segment after seeking to its
+# start yields exactly the same frames as spooling through the video from the beginning.
+
+def get_frame_info(video_file: str|pathlib.Path) -> tuple[np.ndarray, np.ndarray]|None:
+    # returns the presentation timestamps (ms, sorted) of all frames in the video and the indices of
+    # the frames that are keyframes. Returns None if this information cannot be determined
+    if shutil.which('ffprobe') is None:
+        return None
+    command = ['ffprobe',
+               '-v', 'quiet',
+               '-select_streams', 'v:0',
+               '-of', 'compact=p=0:nk=1',
+               '-show_entries', 'packet=pts_time,flags',
+               f'{video_file}']
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if err or proc.returncode:
+        return None
+
+    pts, is_key = [], []
+    for line in out.decode().split():
+        t, flags = line.split('|')[:2]
+        if t=='N/A':
+            return None
+        pts.append(float(t)*1000.)  # s -> ms
+        is_key.append('K' in flags)
+    if not pts:
+        return None
+    # packets are not necessarily stored in presentation order. The frame index of a packet is the
+    # rank of its timestamp
+    pts = np.array(pts)
+    order = np.argsort(pts, kind='stable')
+    frame_idx = np.empty_like(order)
+    frame_idx[order] = np.arange(order.size)
+    return pts[order], np.sort(frame_idx[np.array(is_key)])
+
+def split(first_frame: int, last_frame: int, keyframes: np.ndarray, n_segments: int) -> list[list[int]]:
+    # split the frame range [first_frame, last_frame] into at most n_segments contiguous segments of
+    # about equal length. All segments but the first start at a keyframe
+    boundaries = [first_frame]
+    for i in range(1, n_segments):
+        target = first_frame + i*(last_frame-first_frame+1)/n_segments
+        cands  = keyframes[(keyframes>boundaries[-1]) & (keyframes<=last_frame)]
+        if not cands.size:
+            break
+        k = int(cands[np.argmin(np.abs(cands-target))])
+        if k not in boundaries:
+            boundaries.append(k)
+    boundaries = sorted(boundaries)
+    return [[s, e-1] for s,e in zip(boundaries, boundaries[1:]+[last_frame+1])]
+
+class KeyframeReader:
+    # Video reader that starts at a keyframe, using its own cv2.VideoCapture that is positioned by
+    # seeking. It has the interface of glassesTools' ocv.CV2VideoReader that is used by the pose
+    # estimator and by frame_pipeline.CachedReader (read_frame(), report_frame(), get_prop() and
+    # set_prop()), and detects gaps in the video in the same way, so that it can stand in for that
+    # reader. Use open_at_keyframe() to make one.
+    def __init__(self, file: str|pathlib.Path, timestamps: np.ndarray):
+        self.file       = pathlib.Path(file)
+        self.ts         = np.asarray(timestamps)
+        self.nframes    = len(self.ts)
+        self.frame_idx  = -1
+        self.cap        = cv2.VideoCapture(str(self.file))
+        self._last_good_ts: tuple[int, float, float] = (-1, -1., -1.)   # frame_idx, ts from OpenCV, ts from file
+        self._cache: tuple[bool, np.ndarray|None, int|None, float|None]|None = None
+
+    def __del__(self):
+        self.cap.release()
+
+    def get_prop(self, cv2_prop):
+        return self.cap.get(cv2_prop)
+
+    def set_prop(self, cv2_prop, val):
+        return self.cap.set(cv2_prop, val)
+
+    def seek(self, frame_idx: int, frame_pts: np.ndarray) -> bool:
+        # position the reader at the given frame, which must be a keyframe. Afterwards, the frame is
+        # the reader's last read frame, so that the next read_frame() delivers frame_idx+1. Since
+        # seeking is not reliable for all files, the position after seeking is checked against the
+        # expected timestamp of the frame (frame_pts, as returned by get_frame_info())
+        if frame_idx<2:
+            return self.read_frame(wanted_frame_idx=frame_idx)[2]==frame_idx
+        # read the second frame to get the relationship between OpenCV timestamps and frame
+        # timestamps (same as what is used for detecting gaps)
+        self.read_frame(wanted_frame_idx=1)
+        ref_idx, ref_ocv_ts, _ = self._last_good_ts
+        if ref_idx!=1:
+            return False
+        expected_ocv_ts = ref_ocv_ts + frame_pts[frame_idx] - frame_pts[ref_idx]
+        tolerance = np.min(np.diff(frame_pts[frame_idx-1:frame_idx+2]))/2
+
+        if not self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx):
+            return False
+        ret, frame = self.cap.read()
+        ocv_ts = self.cap.get(cv2.CAP_PROP_POS_MSEC)
+        if not ret or frame is None or abs(ocv_ts-expected_ocv_ts)>tolerance:
+            return False
+
+        self.frame_idx      = frame_idx
+        self._last_good_ts  = (frame_idx, ocv_ts, self.ts[frame_idx])
+        self._cache         = False, frame, frame_idx, self.ts[frame_idx]
+        return True
+
+    def read_frame(self, report_gap=False, wanted_frame_idx: int|None = None) -> tuple[bool, np.ndarray|None, int|None, float|None]:
+        # returns (done, frame, frame_idx, timestamp). Reads forward only, an earlier frame than the
+        # last read one cannot be delivered
+        if wanted_frame_idx is None:
+            wanted_frame_idx = self.frame_idx+1
+        elif wanted_frame_idx<0 or wanted_frame_idx>=self.nframes:
+            raise ValueError(f'wanted_frame_idx ({wanted_frame_idx}) out of bounds ([0-{self.nframes-1}])')
+        if self._cache is not None and (self._cache[2]==wanted_frame_idx or wanted_frame_idx<self.frame_idx):
+            return self._cache
+
+        while True:
+            ret, frame = self.cap.read()
+            ocv_ts = self.cap.get(cv2.CAP_PROP_POS_MSEC)
+            self.frame_idx += 1
+
+            # can't trust ret==False to indicate the end of the video, it may also be returned for
+            # corrupted frames that can be read past
+            if self.frame_idx>=self.nframes or (not ret and (self.frame_idx==0 or self.frame_idx/self.nframes>.99)):
+                self._cache = True, None, None, None
+                return self._cache
+
+            ts = self.ts[self.frame_idx]
+            if self.frame_idx==1 or ocv_ts>0.:
+                # check for a gap (OpenCV timestamp advanced more than ours, with 1 ms leeway), and
+                # if there is one, catch up frame_idx
+                if self._last_good_ts[0]!=-1 and ts-self._last_good_ts[2] < ocv_ts-self._last_good_ts[1]-1:
+                    t_jump = ocv_ts-self._last_good_ts[1]
+                    tss = self.ts-self._last_good_ts[2]
+                    idx = min(int(np.searchsorted(tss, t_jump, side='right')), self.nframes-1)
+                    self.frame_idx = idx-1 if abs(tss[idx-1]-t_jump)<abs(tss[idx]-t_jump) else idx
+                    ts = self.ts[self.frame_idx]
+                    if report_gap and self.frame_idx-self._last_good_ts[0]>1:
+                        print(f'Frame discontinuity detected (jumped from {self._last_good_ts[0]} to {self.frame_idx}), there are probably corrupt frames in your video')
+                self._last_good_ts = (self.frame_idx, ocv_ts, ts)
+
+            if self.frame_idx==wanted_frame_idx:
+                self._cache = False, (frame if ret else None), self.frame_idx, ts
+                return self._cache
+
+    def report_frame(self, interval=100):
+        if self.frame_idx%interval==0:
+            print('  frame {}'.format(self.frame_idx))
+
+
+def open_at_keyframe(file: str|pathlib.Path, timestamps: np.ndarray, frame_idx: int, frame_pts: np.ndarray) -> KeyframeReader|None:
+    # open a reader positioned at the given keyframe (see KeyframeReader.seek()). Returns None if the
+    # file cannot be opened or seeking fails, the caller should then spool to the wanted frame instead
+    reader = KeyframeReader(file, timestamps)
+    if not reader.cap.isOpened() or not reader.seek(frame_idx, frame_pts):
+        return None
+    return reader
@@ -0,0 +1,156 @@
+import pathlib
+import threading
+import queue
+import shutil
+import subprocess
+import numpy as np
+from fractions import Fraction
+from typing import Literal
+
+from ffpyplayer.writer import MediaWriter
+from ffpyplayer.pic import Image
+import ffpyplayer.tools
+
+
+# encoding profiles: codec and encoder options. None means the default codec for the output
+# format, with the encoder's default options
+EncodingProfile = Literal['default','preview','archival']
+encoding_profiles: dict[EncodingProfile, tuple[str, dict[str,str]]|None] = {
+    'default':  None,
+    'preview':  ('libx264', {'preset':'ultrafast', 'crf':'28'}),   # fast, for review copies
+    'archival': ('libx264', {'preset':'slow', 'crf':'17'}),        # slow, visually lossless
+}
+
+def _get_codec(file: pathlib.Path, profile: EncodingProfile) -> tuple[str, str, dict[str,str]]:
+    # returns codec, output pixel format and encoder options
+    if (setting:=encoding_profiles[profile]) is not None and setting[0] in ffpyplayer.tools.codecs_enc:
+        codec, lib_opts = setting[0], dict(setting[1])
+    else:
+        # NB: also used if the codec of the profile is not available
+        codec, lib_opts = ffpyplayer.tools.get_format_codec(fmt=file.suffix[1:]), {}
+    pix_fmt = ffpyplayer.tools.get_best_pix_fmt('bgr24',ffpyplayer.tools.get_supported_pixfmts(codec))
+    return codec, pix_fmt, lib_opts
+
+def has_audio(video_file: str|pathlib.Path) -> bool:
+    if shutil.which('ffprobe') is None:
+        return False
+    command = ['ffprobe',
+        '-loglevel', 'error',
+        '-select_streams', 'a',
+        '-show_entries', 'stream=codec_type',
+        '-of', 'csv=p=0',
+        f'{video_file}']
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    return not err and out.decode().strip()=='audio'
+
+
+class ThreadedWriter:
+    # Encodes and writes video frames on a separate thread, fed through a bounded queue, so that
+    # producing the next frame overlaps with encoding the previous ones. Frames are only converted
+    # to the encoder's input buffer on the writer thread, so a frame must not be modified once it is
+    # submitted.
+    def __init__(self, file: str|pathlib.Path, width: int, height: int, fps: float, profile: EncodingProfile = 'default', queue_size: int = 8):
+        self.file   = pathlib.Path(file)
+        self.width  = width
+        self.height = height
+        self.fps    = fps
+        self._open(profile)
+
+        self._queue: queue.Queue[tuple[np.ndarray, float]|None] = queue.Queue(queue_size)
+        self._error: BaseException|None = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write_frame(self, frame: np.ndarray, pts: float):
+        self._check_error()
+        self._queue.put((frame, pts))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._check_error()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError('Encoding video failed') from self._error
+
+    def _open(self, profile: EncodingProfile):
+        codec, pix_fmt, lib_opts = _get_codec(self.file, profile)
+        fpsFrac  = Fraction(self.fps).limit_denominator(10000).as_integer_ratio()
+        out_opts = {'pix_fmt_in':'bgr24', 'pix_fmt_out':pix_fmt, 'width_in':self.width, 'height_in':self.height, 'frame_rate':fpsFrac, 'codec':codec}
+        self._writer = MediaWriter(str(self.file), [out_opts], lib_opts=lib_opts, overwrite=True)
+
+    def _write(self, frame: np.ndarray, pts: float):
+        img = Image(plane_buffers=[frame.tobytes()], pix_fmt='bgr24', size=(frame.shape[1], frame.shape[0]))
+        self._writer.write_frame(img=img, pts=pts)
+
+    def _finish(self):
+        self._writer.close()
+
+    def _run(self):
+        try:
+            while (item:=self._queue.get()) is not None:
+                frame, pts = item
+                self._write(np.ascontiguousarray(frame), pts)
+        except BaseException as e:
+            self._error = e
+            # keep consuming so that the producer doesn't block, it'll get the error on its next write
+            while self._queue.get() is not None:
+                pass
+        finally:
+            self._finish()
+
+
+class FFmpegWriter(ThreadedWriter):
+    # Pipes the frames to an ffmpeg process which encodes them and, in the same pass, muxes in the
+    # audio of audio_source, so that the written video does not have to be rewritten afterwards to
+    # add audio. audio_filter is an optional ffmpeg filter graph taking [1:a] as input and producing
+    # [audio] (e.g. to delay or trim the audio). If it is not set, the audio is copied unchanged.
+    # NB: ffmpeg must be on the path. The video is written at a constant frame rate, a gap in the
+    # submitted frames' timestamps is filled by repeating the previous frame.
+    def __init__(self, file: str|pathlib.Path, width: int, height: int, fps: float, profile: EncodingProfile = 'default', audio_source: str|pathlib.Path|None = None, audio_filter: str|None = None, queue_size: int = 8):
+        self.audio_source   = audio_source
+        self.audio_filter   = audio_filter
+        super().__init__(file, width, height, fps, profile, queue_size)
+
+    def _open(self, profile: EncodingProfile):
+        codec, pix_fmt, lib_opts = _get_codec(self.file, profile)
+        command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{self.width}x{self.height}', '-framerate', f'{self.fps:.9f}', '-i', '-']
+        if self.audio_source is None:
+            command.extend(['-map', '0:v'])
+        else:
+            command.extend(['-i', f'{self.audio_source}'])
+            if self.audio_filter:
+                command.extend(['-filter_complex', self.audio_filter, '-map', '0:v', '-map', '[audio]'])
+            else:
+                command.extend(['-map', '0:v', '-map', '1:a:0?', '-c:a', 'copy'])
+            command.append('-shortest')
+        command.extend(['-c:v', codec, '-pix_fmt', pix_fmt])
+        for k,v in lib_opts.items():
+            command.extend([f'-{k}', v])
+        command.append(f'{self.file}')
+        self._proc = subprocess.Popen(command, stdin=subprocess.PIPE)
+        self._first_idx: int|None = None
+        self._n_written = 0
+        self._last_frame: np.ndarray|None = None
+
+    def _write(self, frame: np.ndarray, pts: float):
+        idx = round(pts*self.fps)
+        if self._first_idx is None:
+            self._first_idx = idx
+        while self._last_frame is not None and self._n_written<idx-self._first_idx:
+            self._proc.stdin.write(memoryview(self._last_frame).cast('B'))
+            self._n_written += 1
+        self._proc.stdin.write(memoryview(frame).cast('B'))
+        self._n_written += 1
+        self._last_frame = frame
+
+    def _finish(self):
+        try:
+            self._proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self._proc.wait() and self._error is None:
+            self._error = RuntimeError(f'ffmpeg exited with code {self._proc.returncode} while writing {self.file}')
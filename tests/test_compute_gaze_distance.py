@@ -0,0 +1,9 @@
+import pytest
+
+from gazeMapper.process import compute_gaze_distance
+
+
+@pytest.mark.parametrize('et_recs', [[], ['rec1']])
+def test_pairwise_distances_need_two_eye_trackers(tmp_path, et_recs):
+    with pytest.raises(ValueError, match='minstens 2 eye tracker recordings'):
+        compute_gaze_distance.compute_pairwise_distances(tmp_path, None, et_recs+['cam'], et_recs, 'plane')
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from glassesTools import gaze_worldref, plane as gt_plane
+
+from gazeMapper import data_files
+
+
+@pytest.mark.parametrize('fmt', data_files.formats)
+def test_pairwise_distances_round_trip(tmp_path, fmt):
+    df = pd.DataFrame({'timestamp': [0., 4., 8.],
+                       'gazePosPlane2DWorld_x_a': [1.5, np.nan, 3.25],
+                       'gaze_distance_mm_a_vs_b': [0.125, np.nan, 2.]})
+    path = data_files.write_pairwise_distances(df, tmp_path, 'monitor', fmt)
+    assert path==data_files.get_file_path(tmp_path, 'monitor_pairwise_distance', fmt)
+    assert data_files.find_pairwise_distance_file(tmp_path, 'monitor')==path
+
+    pd.testing.assert_frame_equal(data_files.read_pairwise_distances(tmp_path, 'monitor'), df)
+    pd.testing.assert_frame_equal(data_files.read_pairwise_distances(tmp_path, 'monitor', ['gaze_distance_mm_a_vs_b']), df[['gaze_distance_mm_a_vs_b']])
+
+
+# files written in the columnar formats must contain the same table, and be read into the same
+# objects, as the tsv files that glassesTools writes and reads
+def _plane_poses() -> list[gt_plane.Pose]:
+    rng = np.random.default_rng(0)
+    poses = [gt_plane.Pose(i, 4, rng.random(), rng.random(3), rng.random(3), 5, rng.random(9)) for i in range(10)]
+    poses[3] = gt_plane.Pose(3)                                         # failed pose
+    poses[5] = gt_plane.Pose(5, homography_N_markers=3, homography_mat=rng.random(9))
+    return poses
+
+def _plane_gaze() -> dict[int,list[gaze_worldref.Gaze]]:
+    rng = np.random.default_rng(1)
+    gazes: dict[int,list[gaze_worldref.Gaze]] = {}
+    for i in range(20):
+        g = gaze_worldref.Gaze(i*4., i//2, timestamp_ori=i*4., frame_idx_ori=i//2, timestamp_VOR=i*4.+.5, frame_idx_VOR=i//2,
+                               gazePosCam_vidPos_ray=rng.random(3), gazePosPlane2D_vidPos_ray=None if i%7==0 else rng.random(2),
+                               gazePosPlane2DWorld=rng.random(2))
+        gazes.setdefault(i//2, []).append(g)
+    return gazes
+
+def _assert_same_objects(a: dict, b: dict):
+    assert a.keys()==b.keys()
+    for k in a:
+        objs_a, objs_b = (a[k], b[k]) if isinstance(a[k], list) else ([a[k]], [b[k]])
+        assert len(objs_a)==len(objs_b)
+        for oa,ob in zip(objs_a, objs_b):
+            va, vb = vars(oa), vars(ob)
+            assert va.keys()==vb.keys()
+            for f in va:
+                if va[f] is None or vb[f] is None:
+                    assert va[f] is None and vb[f] is None, f
+                else:
+                    np.testing.assert_allclose(np.asarray(va[f], dtype=float), np.asarray(vb[f], dtype=float), atol=1e-7, err_msg=f)
+
+@pytest.mark.parametrize('fmt', ['parquet', 'feather'])
+def test_plane_poses_same_as_glassestools(tmp_path, fmt):
+    poses = _plane_poses()
+    for d in ['tsv', 'col']:
+        (tmp_path/d).mkdir()
+    tsv = data_files.write_plane_poses(poses, tmp_path/'tsv', 'plane', 'tsv', skip_failed=True)
+    col = data_files.write_plane_poses(poses, tmp_path/'col', 'plane', fmt, skip_failed=True)
+    pd.testing.assert_frame_equal(data_files.read_columns(col), data_files.read_columns(tsv), check_dtype=False, atol=1e-7)
+
+    episodes = [[1, 4], [7, 8]]
+    _assert_same_objects(data_files.read_plane_poses(tmp_path/'col', 'plane', episodes), data_files.read_plane_poses(tmp_path/'tsv', 'plane', episodes))
+
+@pytest.mark.parametrize('fmt', ['parquet', 'feather'])
+@pytest.mark.parametrize('ts_column_suffixes', [None, ['VOR', '']])
+def test_plane_gaze_same_as_glassestools(tmp_path, fmt, ts_column_suffixes):
+    gazes = _plane_gaze()
+    for d in ['tsv', 'col']:
+        (tmp_path/d).mkdir()
+    tsv = data_files.write_plane_gaze(gazes, tmp_path/'tsv', 'plane', 'tsv', skip_missing=True)
+    col = data_files.write_plane_gaze(gazes, tmp_path/'col', 'plane', fmt, skip_missing=True)
+    pd.testing.assert_frame_equal(data_files.read_columns(col), data_files.read_columns(tsv), check_dtype=False, atol=1e-7)
+
+    _assert_same_objects(data_files.read_plane_gaze(tmp_path/'col', 'plane', ts_column_suffixes=ts_column_suffixes),
+                         data_files.read_plane_gaze(tmp_path/'tsv', 'plane', ts_column_suffixes=ts_column_suffixes))
@@ -0,0 +1,43 @@
+import math
+import time
+import pytest
+
+from gazeMapper import session
+from gazeMapper.GUI._impl.process_pool import ProcessPool, JobScheduler, JobPayload
+from gazeMapper.process import Action, State
+from gazeMapper.process.pipeline import _CompletionTracker, _JobGraphRunner
+
+
+@pytest.mark.parametrize('state', [State.Completed, State.Skipped])
+def test_check_completed_accepts_finished_states(tmp_path, state):
+    with _CompletionTracker() as tracker:
+        session._notify_action_state_listeners(tmp_path, Action.RUN_VALIDATION, state)
+        assert tracker.check_completed(tmp_path, Action.RUN_VALIDATION, 'rec')==state
+
+
+@pytest.mark.parametrize('state', [State.Not_Run, State.Pending, State.Failed])
+def test_check_completed_raises_on_unfinished_states(tmp_path, state):
+    with _CompletionTracker() as tracker:
+        session._notify_action_state_listeners(tmp_path, Action.RUN_VALIDATION, state)
+        with pytest.raises(RuntimeError):
+            tracker.check_completed(tmp_path, Action.RUN_VALIDATION, 'rec')
+
+
+def test_check_completed_raises_on_missing_state(tmp_path):
+    with _CompletionTracker() as tracker:
+        with pytest.raises(RuntimeError):
+            tracker.check_completed(tmp_path, Action.RUN_VALIDATION, 'rec')
+
+
+def test_job_graph_runner_reports_error_of_failed_job():
+    # two independent jobs. By priority, the slow job that succeeds is sent to the pool first, so
+    # the failing job gets a different job id in the pool than in the scheduler, and it finishes first
+    scheduler = JobScheduler[tuple[Action, str]](ProcessPool(2))
+    runner = _JobGraphRunner(scheduler)
+    scheduler.add_job((Action.GAZE_TO_PLANE, 'rec1'), JobPayload(math.sqrt, (-1.,), {}), runner.done_callback, priority=2)
+    scheduler.add_job((Action.GAZE_TO_PLANE, 'rec2'), JobPayload(time.sleep, (2.,), {}), runner.done_callback, priority=1)
+
+    with pytest.raises(RuntimeError, match=r'\(rec1\): math domain error') as exc_info:
+        runner.run()
+    assert isinstance(exc_info.value.__cause__, ValueError)
+    assert list(runner.errors)==[(Action.GAZE_TO_PLANE, 'rec1')]
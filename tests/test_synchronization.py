@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from gazeMapper import synchronization
+
+
+@pytest.mark.parametrize('stretch_which', ['ref', 'other'])
+def test_single_sync_point_with_time_stretch_applies_offset(stretch_which):
+    # one sync point: 10 s in the reference, 12 s in the recording
+    model = synchronization.SyncModel.from_sync_points(['rec'], np.array([[10.]]), np.array([[12.]]), do_time_stretch=True)
+    data_ts = np.array([0., 5000., 12000., 20000.])
+    ref_ts  = np.array([0., 1000., 2000.])
+
+    new_data_ts, new_ref_ts, _ = synchronization.apply_sync('rec', model, data_ts, ref_ts, True, stretch_which)
+    np.testing.assert_array_equal(new_data_ts, data_ts-2000.)
+    np.testing.assert_array_equal(new_ref_ts, ref_ts)
+    np.testing.assert_array_equal(model.from_ref('rec', new_data_ts, stretch_which), data_ts)
+
+    # same through the dataframe representation
+    new_data_ts, new_ref_ts, _ = synchronization.apply_sync('rec', model.to_dataframe(), data_ts, ref_ts, True, stretch_which)
+    np.testing.assert_array_equal(new_data_ts, data_ts-2000.)
+    np.testing.assert_array_equal(new_ref_ts, ref_ts)
+
+
+def test_nearest_timestamps_matches_merge_asof():
+    left  = np.array([0., 1., 1.5, 2.5, 4., 10.])
+    right = np.array([1., 2., 3., 4.])
+    idx = synchronization.nearest_timestamps(left, right, .6)
+    # ties (1.5, 2.5) go to the earlier key, keys further than the tolerance get -1
+    np.testing.assert_array_equal(idx, [-1, 0, 0, 1, 3, -1])
@@ -0,0 +1,41 @@
+import numpy as np
+import cv2
+import pytest
+
+from glassesTools import ocv
+
+from gazeMapper import video_segments
+
+
+@pytest.fixture
+def video(tmp_path):
+    # MJPG video, every frame is a keyframe. Each frame's brightness encodes its index
+    file = tmp_path / 'video.avi'
+    fps, n_frames = 25., 40
+    writer = cv2.VideoWriter(str(file), cv2.VideoWriter_fourcc(*'MJPG'), fps, (64, 48))
+    for i in range(n_frames):
+        writer.write(np.full((48, 64, 3), i*6, np.uint8))
+    writer.release()
+    return file, np.arange(n_frames)*1000./fps
+
+
+def _frame_values(reader, first: int, last: int) -> list[float]:
+    return [float(reader.read_frame(wanted_frame_idx=i)[1].mean()) for i in range(first, last+1)]
+
+
+@pytest.mark.parametrize('frame_idx', [0, 1, 20])
+def test_open_at_keyframe_matches_spooling(video, frame_idx):
+    file, ts = video
+    reader = video_segments.open_at_keyframe(file, ts, frame_idx, ts)
+    assert reader is not None
+
+    _, frame, idx, frame_ts = reader.read_frame(wanted_frame_idx=frame_idx)
+    assert idx==frame_idx and frame_ts==ts[frame_idx] and frame is not None
+    assert _frame_values(reader, frame_idx, len(ts)-1)==_frame_values(ocv.CV2VideoReader(file, ts), frame_idx, len(ts)-1)
+    assert reader.read_frame()[0]
+
+
+def test_open_at_keyframe_fails_on_wrong_timestamps(video):
+    file, ts = video
+    # frame timestamps that do not match the video, so the seek position can't be verified
+    assert video_segments.open_at_keyframe(file, ts, 20, ts*2) is None
@@ -0,0 +1,24 @@
+import numpy as np
+import cv2
+
+from gazeMapper import video_writer
+
+
+def test_threaded_writer_writes_frames(tmp_path):
+    file = tmp_path / 'out.mp4'
+    width, height, fps, n_frames = 64, 48, 30., 5
+    writer = video_writer.ThreadedWriter(file, width, height, fps)
+    for i in range(n_frames):
+        writer.write_frame(np.full((height, width, 3), i*40, np.uint8), i/fps)
+    writer.close()
+
+    cap = cv2.VideoCapture(str(file))
+    n_read = 0
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        assert frame.shape==(height, width, 3)
+        n_read += 1
+    cap.release()
+    assert n_read==n_frames